@@ -1,35 +1,135 @@
+import collections
 import contextlib
+import fnmatch
+import hashlib
+import io
+import itertools
 import json
 import logging
+import mimetypes
+import multiprocessing
 import os
+import re
 import shutil
-import subprocess
 import tempfile
+import threading
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from urllib.request import Request, urlopen
 from uuid import uuid4
 from zipfile import ZipFile
 
 import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-cloudfront = boto3.client('cloudfront')
-s3 = boto3.client('s3')
-
 CFN_SUCCESS = "SUCCESS"
 CFN_FAILED = "FAILED"
 ENV_KEY_MOUNT_PATH = "MOUNT_PATH"
 ENV_KEY_SKIP_CLEANUP = "SKIP_CLEANUP"
+ENV_KEY_MULTIPART_THRESHOLD = "MULTIPART_THRESHOLD_MB"
+ENV_KEY_MULTIPART_CHUNKSIZE = "MULTIPART_CHUNKSIZE_MB"
+ENV_KEY_MAX_CONCURRENCY = "TRANSFER_MAX_CONCURRENCY"
+ENV_KEY_STREAMING_DEPLOY = "STREAMING_DEPLOY"
+ENV_KEY_CONTENT_HASH_SYNC = "CONTENT_HASH_SYNC"
+ENV_KEY_SOURCE_CACHE_MB = "SOURCE_CACHE_MB"
 
-AWS_CLI_CONFIG_FILE = "/tmp/aws_cli_config"
 CUSTOM_RESOURCE_OWNER_TAG = "aws-cdk:cr-owned"
 
-os.putenv('AWS_CONFIG_FILE', AWS_CLI_CONFIG_FILE)
+# content hashes of the deployed files, kept next to them in the destination prefix
+MANIFEST_KEY = ".deploy-manifest.json"
+MANIFEST_VERSION = 1
+HASH_WORKERS = 8
+
+# CloudFormation rejects responses over 4096 bytes, so changed paths are only
+# reported up to this many bytes of JSON
+RESPONSE_PATHS_BUDGET = 2048
+
+# CloudFront accepts up to 3000 paths per invalidation and at most 15 wildcard
+# paths in progress per distribution
+INVALIDATION_BATCH_SIZE = 3000
+MAX_WILDCARD_PATHS = 15
+
+# tunables for the in-process S3 transfer manager
+MB = 1024 * 1024
+MAX_CONCURRENCY = int(os.getenv(ENV_KEY_MAX_CONCURRENCY, "32"))
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.getenv(ENV_KEY_MULTIPART_THRESHOLD, "8")) * MB,
+    multipart_chunksize=int(os.getenv(ENV_KEY_MULTIPART_CHUNKSIZE, "8")) * MB,
+    max_concurrency=MAX_CONCURRENCY)
+
+# streaming deploys read archives in blocks of this size and keep a few of them cached
+READ_AHEAD_BLOCK_SIZE = 8 * MB
+READ_AHEAD_BLOCKS = 4
+STREAM_CHUNK_SIZE = 1 * MB
+
+# sources fetched, extracted or opened at once
+SOURCE_WORKERS = 8
+
+# markers are only replaced in text files unless a source opts in to binary
+# files with SourceMarkersConfig "binaryFiles". Files with other extensions
+# are classified by sniffing their first bytes.
+TEXT_EXTENSIONS = frozenset((
+    ".css", ".csv", ".env", ".htm", ".html", ".ini", ".js", ".json", ".jsx", ".map", ".md", ".mjs",
+    ".properties", ".svg", ".toml", ".ts", ".tsx", ".txt", ".webmanifest", ".xml", ".yaml", ".yml"))
+BINARY_EXTENSIONS = frozenset((
+    ".7z", ".avif", ".bin", ".bmp", ".br", ".eot", ".gif", ".gz", ".ico", ".jar", ".jpeg", ".jpg",
+    ".mov", ".mp3", ".mp4", ".ogg", ".otf", ".pdf", ".png", ".tar", ".tif", ".tiff", ".ttf", ".wasm",
+    ".wav", ".webm", ".webp", ".woff", ".woff2", ".zip", ".zst"))
+SNIFF_BYTES = 8192
+
+# with jsonEscape, markers in these files are replaced inside string values by
+# parsing the file, rather than by replacing bytes
+JSON_EXTENSIONS = frozenset((".json", ".webmanifest"))
+
+# extracted files are substituted by worker processes once there are enough of them
+REPLACE_WORKERS = os.cpu_count() or 1
+PARALLEL_REPLACE_THRESHOLD = 64
+
+# namespace of the embedded metric format records logged by every invocation
+METRICS_NAMESPACE = "CDK/BucketDeployment"
+
+# one connection per transfer thread, shared by every transfer in the invocation
+cloudfront = boto3.client('cloudfront')
+s3 = boto3.client('s3', config=Config(max_pool_connections=MAX_CONCURRENCY))
+s3_signed = None  # created on first use by a SignContent deployment
+
+# source archives and extracted contents are kept across warm invocations in
+# /tmp, or across containers when an efs volume is mounted (0 disables)
+SOURCE_CACHE_BUDGET = int(os.getenv(ENV_KEY_SOURCE_CACHE_MB, "256")) * MB
+
+# maps "SystemMetadata" keys (aws cli option names) to S3 upload arguments
+SYSTEM_METADATA_ARGS = {
+    "cache-control": "CacheControl",
+    "content-disposition": "ContentDisposition",
+    "content-encoding": "ContentEncoding",
+    "content-language": "ContentLanguage",
+    "content-type": "ContentType",
+    "expires": "Expires",
+    "sse": "ServerSideEncryption",
+    "sse-kms-key-id": "SSEKMSKeyId",
+    "storage-class": "StorageClass",
+    "website-redirect": "WebsiteRedirectLocation",
+    "acl": "ACL",
+}
 
 def handler(event, context):
 
+    metrics.reset()
+
+    # asynchronous completion check scheduled by cloudfront_invalidate
+    if 'InvalidationCheck' in event:
+        check = event['InvalidationCheck']
+        try:
+            wait_for_invalidations(check['DistributionId'], check['InvalidationIds'])
+        finally:
+            metrics.emit({'DistributionId': check['DistributionId']})
+        return
+
     def cfn_error(message=None):
         if message:
             logger.error("| cfn_error: %s" % message.encode())
@@ -66,6 +166,8 @@ def handler(event, context):
             include             = props.get('Include', [])
             sign_content        = props.get('SignContent', 'false').lower() == 'true'
             output_object_keys  = props.get('OutputObjectKeys', 'true') == 'true'
+            wait_for_invalidation = props.get('WaitForDistributionInvalidation', 'false').lower()
+            invalidation_threshold = int(props.get('InvalidationPathThreshold', '100'))
 
             # backwards compatibility - if "SourceMarkers" is not specified,
             # assume all sources have an empty market map
@@ -86,11 +188,15 @@ def handler(event, context):
             cfn_error("missing request resource property %s. props: %s" % (str(e), props))
             return
 
-        # configure aws cli options after resetting back to the defaults for each request
-        if os.path.exists(AWS_CLI_CONFIG_FILE):
-                os.remove(AWS_CLI_CONFIG_FILE)
+        # payload signing needs a differently configured client
+        s3_client = s3
         if sign_content:
-                aws_command("configure", "set", "default.s3.payload_signing_enabled", "true")
+            global s3_signed
+            if s3_signed is None:
+                s3_signed = boto3.client('s3', config=Config(
+                    max_pool_connections=MAX_CONCURRENCY,
+                    s3={'payload_signing_enabled': True}))
+            s3_client = s3_signed
 
         # treat "/" as if no prefix was specified
         if dest_bucket_prefix == "/":
@@ -120,7 +226,7 @@ def handler(event, context):
         # delete or create/update (only if "retain_on_delete" is false)
         if request_type == "Delete" and not retain_on_delete:
             if not bucket_owned(dest_bucket_name, dest_bucket_prefix):
-                aws_command("s3", "rm", s3_dest, "--recursive")
+                s3_remove_recursive(s3_client, s3_dest)
 
         # if we are updating without retention and the destination changed, delete first
         if request_type == "Update" and not retain_on_delete and old_s3_dest != s3_dest:
@@ -128,24 +234,103 @@ def handler(event, context):
                 logger.warn("cannot delete old resource without old resource properties")
                 return
 
-            aws_command("s3", "rm", old_s3_dest, "--recursive")
+            s3_remove_recursive(s3_client, old_s3_dest)
 
+        changed_paths = []
         if request_type == "Update" or request_type == "Create":
-            s3_deploy(s3_source_zips, s3_dest, user_metadata, system_metadata, prune, exclude, include, source_markers, extract, source_markers_config)
+            with metrics.phase('Deploy'):
+                changed_paths = s3_deploy(s3_client, s3_source_zips, s3_dest, user_metadata, system_metadata, prune, exclude, include, source_markers, extract, source_markers_config)
 
+        # unless paths were given explicitly, only invalidate what this deployment changed
+        invalidation_ids = []
         if distribution_id:
-            cloudfront_invalidate(distribution_id, distribution_paths)
+            if 'DistributionPaths' not in props and request_type != "Delete":
+                distribution_paths = minimal_invalidation_paths(changed_paths, invalidation_threshold)
+            if distribution_paths:
+                invalidation_ids = cloudfront_invalidate(distribution_id, distribution_paths, wait_for_invalidation, context)
+            else:
+                logger.info("| nothing changed, skipping invalidation")
 
         cfn_send(event, context, CFN_SUCCESS, physicalResourceId=physical_id, responseData={
             # Passing through the ARN sequences dependencees on the deployment
             'DestinationBucketArn': props.get('DestinationBucketArn'),
-            **({'SourceObjectKeys': props.get('SourceObjectKeys')} if output_object_keys else {'SourceObjectKeys': []})
+            **({'SourceObjectKeys': props.get('SourceObjectKeys')} if output_object_keys else {'SourceObjectKeys': []}),
+            'ChangedPathCount': len(changed_paths),
+            'ChangedPaths': truncate_paths(changed_paths, RESPONSE_PATHS_BUDGET),
+            'InvalidationIds': invalidation_ids,
+            'Metrics': metrics.summary()
         })
     except KeyError as e:
         cfn_error("invalid request. Missing key %s" % str(e))
     except Exception as e:
         logger.exception(e)
         cfn_error(str(e))
+    finally:
+        # stack ids look like arn:aws:cloudformation:<region>:<account>:stack/<name>/<id>
+        stack_name = event.get('StackId', '').split('/')[1:2]
+        metrics.emit({'StackName': stack_name[0] if stack_name else 'unknown'},
+                     LogicalResourceId=event.get('LogicalResourceId'), RequestType=event.get('RequestType'))
+
+#---------------------------------------------------------------------------------------------------
+# per-invocation phase timings and counters. Phases of concurrent sources are
+# summed, so a phase can report more time than the deployment took overall.
+class DeployMetrics:
+    """Collect per-phase durations, bytes and file counts for one invocation.
+
+    The totals are returned to CloudFormation by "summary" and logged as a
+    CloudWatch embedded metric format record by "emit", so deploy latency can
+    be graphed and alarmed on per stack without any extra tooling.
+    """
+
+    UNITS = {'Duration': 'Milliseconds', 'Bytes': 'Bytes', 'Files': 'Count', 'SubstitutedFiles': 'Count'}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.phases = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name, **counts):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, Duration=(time.monotonic() - start) * 1000, **counts)
+
+    def add(self, name, **counts):
+        with self._lock:
+            phase = self.phases.setdefault(name, collections.Counter())
+            phase.update(counts)
+
+    def summary(self):
+        with self._lock:
+            return {name: {key: int(round(value)) for key, value in phase.items()}
+                    for name, phase in self.phases.items()}
+
+    def emit(self, dimensions, **properties):
+        summary = self.summary()
+        if not summary:
+            return
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [sorted(dimensions)],
+                    'Metrics': [{'Name': name + key, 'Unit': self.UNITS[key]}
+                                for name, phase in summary.items() for key in phase]
+                }]
+            },
+            **{key: value for key, value in properties.items() if value is not None},
+            **dimensions,
+            **{name + key: value for name, phase in summary.items() for key, value in phase.items()}
+        }
+        # embedded metric records must be written to stdout without the log prefix
+        print(json.dumps(record), flush=True)
+
+metrics = DeployMetrics()
 
 #---------------------------------------------------------------------------------------------------
 # Sanitize the message to mitigate CWE-117 and CWE-93 vulnerabilities
@@ -163,11 +348,17 @@ def sanitize_message(message):
 
 #---------------------------------------------------------------------------------------------------
 # populate all files from s3_source_zips to a destination bucket
-def s3_deploy(s3_source_zips, s3_dest, user_metadata, system_metadata, prune, exclude, include, source_markers, extract, source_markers_config):
+def s3_deploy(s3_client, s3_source_zips, s3_dest, user_metadata, system_metadata, prune, exclude, include, source_markers, extract, source_markers_config):
     # list lengths are equal
     if len(s3_source_zips) != len(source_markers):
         raise Exception("'source_markers' and 's3_source_zips' must be the same length")
 
+    # archives can be streamed straight from the source to the destination
+    # without staging them on disk
+    if extract and os.getenv(ENV_KEY_STREAMING_DEPLOY, "true").lower() == "true":
+        return s3_stream_deploy(s3_client, s3_source_zips, s3_dest, prune, exclude, include, source_markers, source_markers_config,
+                                create_metadata_extra_args(user_metadata, system_metadata))
+
     # create a temporary working directory in /tmp or if enabled an attached efs volume
     if ENV_KEY_MOUNT_PATH in os.environ:
         workdir = os.getenv(ENV_KEY_MOUNT_PATH) + "/" + str(uuid4())
@@ -182,67 +373,522 @@ def s3_deploy(s3_source_zips, s3_dest, user_metadata, system_metadata, prune, ex
     os.mkdir(contents_dir)
 
     try:
-        # download the archive from the source and extract to "contents"
-        for i in range(len(s3_source_zips)):
+        # download the archive from the source and extract it. With several
+        # sources, each one is fetched and extracted into its own directory
+        # concurrently, and the directories are merged into "contents" in
+        # source order so later sources still overwrite earlier ones.
+        def fetch_source(i):
             s3_source_zip = s3_source_zips[i]
             markers       = source_markers[i]
             markers_config = source_markers_config[i]
 
+            source_dir = contents_dir
+            if len(s3_source_zips) > 1:
+                source_dir = os.path.join(workdir, 'sources', str(i))
+                os.makedirs(source_dir)
+
             if extract:
-                archive=os.path.join(workdir, str(uuid4()))
-                logger.info("archive: %s" % archive)
-                aws_command("s3", "cp", s3_source_zip, archive)
-                logger.info("| extracting archive to: %s\n" % contents_dir)
-                logger.info("| markers: %s" % markers)
-                extract_and_replace_markers(archive, contents_dir, markers, markers_config)
+                extract_source(s3_client, s3_source_zip, source_dir, workdir, markers, markers_config)
             else:
-                logger.info("| copying archive to: %s\n" % contents_dir)
-                aws_command("s3", "cp", s3_source_zip, contents_dir)
+                logger.info("| copying archive to: %s\n" % source_dir)
+                s3_download(s3_client, s3_source_zip, os.path.join(source_dir, os.path.basename(s3_source_zip)))
+            return source_dir
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(s3_source_zips), SOURCE_WORKERS))) as executor:
+            source_dirs = list(executor.map(fetch_source, range(len(s3_source_zips))))
+        # every source is linked into the workdir by now, so evicting is safe
+        source_cache.evict()
+
+        for source_dir in source_dirs:
+            if source_dir != contents_dir:
+                merge_tree(source_dir, contents_dir)
 
         # sync from "contents" to destination
+        return s3_sync(s3_client, contents_dir, s3_dest, prune, exclude, include,
+                       create_metadata_extra_args(user_metadata, system_metadata))
+    finally:
+        if not os.getenv(ENV_KEY_SKIP_CLEANUP):
+            shutil.rmtree(workdir)
+
+# download and extract a source archive into "source_dir". With the source
+# cache enabled, extracted contents are kept per source ETag and marker set and
+# hard-linked into place, so a repeated deployment skips both the download and
+# the extraction.
+def extract_source(s3_client, s3_source_zip, source_dir, workdir, markers, markers_config):
+    logger.info("| extracting archive to: %s\n" % source_dir)
+    logger.info("| markers: %s" % markers)
+
+    bucket, key = parse_s3_url(s3_source_zip)
+    head = None
+    if source_cache.enabled():
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+        entry = source_cache.entry_name("contents", bucket, key, head['ETag'], markers, markers_config)
+        cached = source_cache.lookup(entry)
+        if cached is not None:
+            logger.info("| source cache hit: %s" % s3_source_zip)
+            with metrics.phase('SourceCache', Files=1):
+                link_tree(cached, source_dir)
+            return
 
-        s3_command = ["s3", "sync"]
+    # the archive is linked or downloaded into the workdir, so evicting its
+    # cache entry while it is being extracted is harmless
+    archive = os.path.join(workdir, str(uuid4()))
+    cached = cached_archive(s3_client, bucket, key, head)
+    if cached is not None:
+        link_file(cached, archive)
+    else:
+        logger.info("archive: %s" % archive)
+        s3_download(s3_client, s3_source_zip, archive)
 
-        if prune:
-          s3_command.append("--delete")
+    try:
+        if head is not None:
+            with ZipFile(archive, "r") as zip:
+                size = sum(info.file_size for info in zip.infolist())
+            # the extracted tree is linked, not copied, into the workdir, so
+            # caching it needs no room beyond the tree itself
+            if source_cache.reserve(size):
+                try:
+                    staging = source_cache.staging_path()
+                    extract_and_replace_markers(archive, staging, markers, markers_config)
+                    link_tree(source_cache.commit(staging, entry, size), source_dir)
+                finally:
+                    source_cache.release(size)
+                return
 
-        if exclude:
-          for filter in exclude:
-            s3_command.extend(["--exclude", filter])
+        extract_and_replace_markers(archive, source_dir, markers, markers_config)
+    finally:
+        os.remove(archive)
+
+# local path of a source archive in the source cache, downloading it into the
+# cache if there is room for it and for its extracted contents. Returns None
+# when the archive is not cacheable.
+def cached_archive(s3_client, bucket, key, head):
+    if head is None or not source_cache.enabled():
+        return None
+    entry = source_cache.entry_name("archive", bucket, key, head['ETag'])
+    cached = source_cache.lookup(entry)
+    if cached is not None:
+        logger.info("| archive cache hit: s3://%s/%s" % (bucket, key))
+        return cached
+    # extracted contents are at least as large as the archive
+    size = head['ContentLength']
+    if not source_cache.reserve(size, scratch=size):
+        return None
+    try:
+        staging = source_cache.staging_path()
+        s3_download(s3_client, "s3://%s/%s" % (bucket, key), staging)
+        return source_cache.commit(staging, entry, size)
+    finally:
+        source_cache.release(size)
 
-        if include:
-          for filter in include:
-            s3_command.extend(["--include", filter])
+# hard-link a file, copying across file systems. The link gets a fresh mtime
+# like an extracted file, so an mtime based sync never takes a cached file
+# for one that is already uploaded.
+def link_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+    os.utime(dst)
+
+# hard-link every file under "src" into "dst"
+def link_tree(src, dst):
+    for root, _, files in os.walk(src):
+        target_dir = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_dir, exist_ok=True)
+        for name in files:
+            link_file(os.path.join(root, name), os.path.join(target_dir, name))
+
+class SourceCache:
+    """Size-bounded LRU cache of source archives and extracted contents.
+
+    Every entry is a directory holding its payload ("data", a file or a tree)
+    and its size. Entries are written under a staging name and renamed into
+    place, so containers sharing an efs volume never see a partial entry. The
+    mtime of the size file records the last use. Room for an entry is reserved
+    before it is written, evicting older entries as needed, so the cache never
+    grows past its budget or fills the file system.
+    """
+
+    def __init__(self, root, budget):
+        self.root = root
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._reserved = 0
+
+    def enabled(self):
+        return self.budget > 0
+
+    def entry_name(self, kind, bucket, key, etag, *params):
+        digest = hashlib.sha256(json.dumps([bucket, key, etag, params], sort_keys=True).encode('utf-8'))
+        return "%s-%s" % (kind, digest.hexdigest()[:40])
+
+    def lookup(self, name):
+        entry = os.path.join(self.root, name)
+        try:
+            os.utime(os.path.join(entry, "size"))
+        except OSError:
+            return None
+        return os.path.join(entry, "data")
+
+    # make room for a new entry of "size" bytes, evicting least recently used
+    # entries until it fits the budget and the file system still has "scratch"
+    # bytes free after writing it. Every successful reserve must be released.
+    def reserve(self, size, scratch=0):
+        if not self.enabled() or size > self.budget:
+            return False
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            entries = self._entries()
+            total = sum(entry_size for _, entry_size, _ in entries) + self._reserved
+
+            def fits(evictable=0):
+                free = shutil.disk_usage(self.root).free - self._reserved + evictable
+                return total - evictable + size <= self.budget and size + scratch <= free
+
+            # don't empty the cache for an entry that would not fit anyway
+            if not fits(sum(entry_size for _, entry_size, _ in entries)):
+                return False
+            for _, entry_size, path in entries:
+                if fits():
+                    break
+                logger.info("| evicting from source cache: %s" % os.path.basename(path))
+                shutil.rmtree(path, ignore_errors=True)
+                total -= entry_size
+            if not fits():
+                return False
+            self._reserved += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self._reserved -= size
+
+    # a fresh path to write an entry's payload to before committing it
+    def staging_path(self):
+        staging = os.path.join(self.root, ".staging-%s" % uuid4())
+        os.makedirs(staging)
+        return os.path.join(staging, "data")
+
+    def commit(self, data_path, name, size):
+        staging = os.path.dirname(data_path)
+        with open(os.path.join(staging, "size"), "w") as f:
+            f.write(str(size))
+        entry = os.path.join(self.root, name)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # another invocation committed the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+        return os.path.join(entry, "data")
+
+    # drop least recently used entries until the cache fits its budget, along
+    # with staging directories left behind by invocations that timed out
+    def evict(self):
+        if not self.enabled() or not os.path.isdir(self.root):
+            return
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.budget:
+                    break
+                logger.info("| evicting from source cache: %s" % os.path.basename(path))
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+    # committed entries as (last use, size, path), least recently used first
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith(".staging-"):
+                if time.time() - os.path.getmtime(path) > 3600:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                size_file = os.path.join(path, "size")
+                with open(size_file) as f:
+                    entries.append((os.path.getmtime(size_file), int(f.read()), path))
+            except (OSError, ValueError):
+                shutil.rmtree(path, ignore_errors=True)
+        return sorted(entries)
+
+source_cache = SourceCache(
+    os.path.join(os.getenv(ENV_KEY_MOUNT_PATH) or tempfile.gettempdir(), "source-cache"),
+    SOURCE_CACHE_BUDGET)
+
+# move every file under "src" to the same relative path under "dst",
+# replacing files that already exist there
+def merge_tree(src, dst):
+    for root, _, files in os.walk(src):
+        target_dir = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_dir, exist_ok=True)
+        for name in files:
+            os.replace(os.path.join(root, name), os.path.join(target_dir, name))
 
-        s3_command.extend([contents_dir, s3_dest])
-        s3_command.extend(create_metadata_args(user_metadata, system_metadata))
-        aws_command(*s3_command)
+#---------------------------------------------------------------------------------------------------
+# deploy extracted archives without touching disk: zip members are read from
+# the source objects with ranged GETs, markers are replaced while the data
+# streams through, and each member is uploaded as its own object. Later
+# sources overwrite earlier ones, like extracting them on top of each other.
+def s3_stream_deploy(s3_client, s3_source_zips, s3_dest, prune, exclude, include, source_markers, source_markers_config, extra_args):
+    bucket, prefix = s3_dir_prefix(s3_dest)
+    def open_archive(s3_source_zip):
+        source_bucket, source_key = parse_s3_url(s3_source_zip)
+        head = s3_client.head_object(Bucket=source_bucket, Key=source_key)
+        logger.info("| streaming archive: %s" % s3_source_zip)
+        with metrics.phase('Open', Files=1):
+            return ZipFile(S3ObjectReader(s3_client, s3_source_zip, head), "r")
+
+    # opening an archive reads its central directory, so open them all at once
+    with ThreadPoolExecutor(max_workers=max(1, min(len(s3_source_zips), SOURCE_WORKERS))) as executor:
+        futures = [executor.submit(open_archive, s3_source_zip) for s3_source_zip in s3_source_zips]
+    archives = [future.result() for future in futures if future.exception() is None]
+    try:
+        if len(archives) != len(futures):
+            raise next(future.exception() for future in futures if future.exception() is not None)
+
+        members = {}
+        for i, archive in enumerate(archives):
+            for info in archive.infolist():
+                if info.is_dir(): continue
+                members[zip_member_path(info.filename)] = (i, info)
+
+        replacers = [marker_replacer(source_markers[i], source_markers_config[i]) for i in range(len(s3_source_zips))]
+        entries = {path: member for path, member in members.items()
+                   if path != MANIFEST_KEY and is_included(path, exclude, include)}
+
+        def open_entry(relative_path):
+            i, info = entries[relative_path]
+            for chunk in read_zip_member(archives[i], info, replacers[i]):
+                metrics.add('Upload', Bytes=len(chunk))
+                yield chunk
+
+        def upload_entry(manager, relative_path, key, upload_args):
+            body = io.BufferedReader(ChunkStream(open_entry(relative_path)), STREAM_CHUNK_SIZE)
+            return manager.upload(body, bucket, key, extra_args=upload_args)
+
+        hashes = None
+        if content_hash_sync_enabled():
+            hashes = hash_zip_members(archives, entries, replacers)
+
+        # only a few blocks of each archive are cached, so read the members in
+        # archive order rather than path order, as hash_zip_members does
+        def archive_order(relative_path):
+            i, info = entries[relative_path]
+            return i, info.header_offset
+
+        changed = sync_entries(s3_client, bucket, prefix, entries, hashes, upload_entry, None, prune, exclude, include, extra_args,
+                               upload_order=archive_order)
+        # members are substituted on the fly, so count the distinct members that contained markers
+        metrics.add('ReplaceMarkers', SubstitutedFiles=len(set().union(*(replacer.substituted for replacer in replacers))))
+        return changed
     finally:
-        if not os.getenv(ENV_KEY_SKIP_CLEANUP):
-            shutil.rmtree(workdir)
+        for archive in archives:
+            archive.close()
+
+# the path ZipFile.extractall would write a member to, relative to the target directory
+def zip_member_path(filename):
+    parts = filename.split("/")
+    return "/".join(part for part in parts if part not in ("", ".", ".."))
+
+# yield the (marker-substituted) contents of a zip member in bounded chunks
+def read_zip_member(archive, info, replacer):
+    def chunks():
+        with archive.open(info) as member:
+            yield from read_chunks(member)
+    # a member that turns out not to be JSON has to be found out before any of
+    # it is uploaded, so the upload can fall back to replacing bytes
+    replacer.check_json(info.filename, chunks)
+    return replacer.replace_chunks(chunks(), info.filename)
+
+# yield a file object's contents in STREAM_CHUNK_SIZE chunks
+def read_chunks(fileobj):
+    while True:
+        chunk = fileobj.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+# read-only file object over an iterator of byte chunks
+class ChunkStream(io.RawIOBase):
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            self._pending = next(self._chunks, None)
+            if self._pending is None:
+                self._pending = b""
+                return 0
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+# seekable, read-only file object over an S3 object, backed by ranged GETs of
+# READ_AHEAD_BLOCK_SIZE bytes. The most recently used blocks are kept in memory
+# and every GET is pinned to the ETag seen when the object was opened.
+class S3ObjectReader(io.RawIOBase):
+    def __init__(self, s3_client, s3_url, head=None):
+        self._s3 = s3_client
+        self._bucket, self._key = parse_s3_url(s3_url)
+        if head is None:
+            head = s3_client.head_object(Bucket=self._bucket, Key=self._key)
+        self.size = head['ContentLength']
+        self.etag = head['ETag']
+        self._pos = 0
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self._pos = offset
+        return offset
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        n = 0
+        while n < len(view) and self._pos < self.size:
+            index = self._pos // READ_AHEAD_BLOCK_SIZE
+            offset = self._pos - index * READ_AHEAD_BLOCK_SIZE
+            chunk = self._block(index)[offset:offset + len(view) - n]
+            view[n:n + len(chunk)] = chunk
+            n += len(chunk)
+            self._pos += len(chunk)
+        return n
+
+    def _block(self, index):
+        with self._lock:
+            if index in self._blocks:
+                self._blocks.move_to_end(index)
+                return self._blocks[index]
+
+        start = index * READ_AHEAD_BLOCK_SIZE
+        end = min(start + READ_AHEAD_BLOCK_SIZE, self.size) - 1
+        data = self._s3.get_object(Bucket=self._bucket, Key=self._key,
+                                   Range="bytes=%d-%d" % (start, end), IfMatch=self.etag)['Body'].read()
+
+        with self._lock:
+            self._blocks[index] = data
+            while len(self._blocks) > READ_AHEAD_BLOCKS:
+                self._blocks.popitem(last=False)
+        return data
 
 #---------------------------------------------------------------------------------------------------
-# invalidate files in the CloudFront distribution edge caches
-def cloudfront_invalidate(distribution_id, distribution_paths):
-    invalidation_resp = cloudfront.create_invalidation(
-        DistributionId=distribution_id,
-        InvalidationBatch={
-            'Paths': {
-                'Quantity': len(distribution_paths),
-                'Items': distribution_paths
-            },
-            'CallerReference': str(uuid4()),
-        })
+# invalidate files in the CloudFront distribution edge caches. "wait" is
+# "false" to return as soon as the invalidations are created, "true" to block
+# until they complete, or "async" to have a separate invocation of this
+# function wait for them. Computed paths always fit one invalidation; explicit
+# DistributionPaths over INVALIDATION_BATCH_SIZE are sent in batches, each one
+# once the previous has completed, as CloudFront only allows that many paths
+# in progress per distribution.
+def cloudfront_invalidate(distribution_id, distribution_paths, wait, context):
+    invalidation_ids = []
+    for i in range(0, len(distribution_paths), INVALIDATION_BATCH_SIZE):
+        batch = distribution_paths[i:i + INVALIDATION_BATCH_SIZE]
+        if invalidation_ids:
+            wait_for_invalidations(distribution_id, invalidation_ids[-1:])
+        with metrics.phase('Invalidate', Files=len(batch)):
+            invalidation_resp = cloudfront.create_invalidation(
+                DistributionId=distribution_id,
+                InvalidationBatch={
+                    'Paths': {
+                        'Quantity': len(batch),
+                        'Items': batch
+                    },
+                    'CallerReference': str(uuid4()),
+                })
+        invalidation_ids.append(invalidation_resp['Invalidation']['Id'])
+    logger.info("| invalidating %d paths in %s: %s" % (len(distribution_paths), distribution_id, invalidation_ids))
+
+    if wait == "async":
+        try:
+            boto3.client('lambda').invoke(
+                FunctionName=context.invoked_function_arn,
+                InvocationType='Event',
+                Payload=json.dumps({'InvalidationCheck': {
+                    'DistributionId': distribution_id,
+                    'InvalidationIds': invalidation_ids
+                }}).encode('utf-8'))
+        except Exception as e:
+            logger.warning("| could not schedule invalidation check, waiting instead: %s" % e)
+            wait = "true"
+
+    if wait == "true":
+        wait_for_invalidations(distribution_id, invalidation_ids)
+
+    return invalidation_ids
+
+def wait_for_invalidations(distribution_id, invalidation_ids):
     # by default, will wait up to 10 minutes
-    cloudfront.get_waiter('invalidation_completed').wait(
-        DistributionId=distribution_id,
-        Id=invalidation_resp['Invalidation']['Id'])
+    waiter = cloudfront.get_waiter('invalidation_completed')
+    for invalidation_id in invalidation_ids:
+        with metrics.phase('InvalidationWait', Files=1):
+            waiter.wait(DistributionId=distribution_id, Id=invalidation_id)
+        logger.info("| invalidation %s of %s completed" % (invalidation_id, distribution_id))
+
+# the smallest set of invalidation paths covering the changed object keys.
+# While there are more than "threshold" paths (or too many wildcards), paths
+# are collapsed into wildcards one directory level at a time, down to "/*",
+# so the result always fits a single invalidation.
+def minimal_invalidation_paths(changed_keys, threshold):
+    threshold = min(threshold, INVALIDATION_BATCH_SIZE)
+    paths = set()
+    for key in changed_keys:
+        paths.add("/" + key)
+        # index documents are also served under their directory path
+        if key == "index.html" or key.endswith("/index.html"):
+            paths.add("/" + key[:-len("index.html")])
+    if not paths:
+        return []
+
+    # "/a/b/c.js" and "/a/b/*" are both two directories deep; at level 2 they
+    # collapse into "/a/b/*", at level 0 everything collapses into "/*"
+    level = max(len(path.split("/")) - 2 for path in paths)
+    while level >= 0 and (len(paths) > threshold or sum(path.endswith("*") for path in paths) > MAX_WILDCARD_PATHS):
+        collapsed = set()
+        for path in paths:
+            dirs = path.split("/")[1:-1]
+            if len(dirs) >= level:
+                path = "/" + "".join(d + "/" for d in dirs[:level]) + "*"
+            collapsed.add(path)
+        # drop paths a wildcard already covers
+        wildcards = [path[:-1] for path in collapsed if path.endswith("*")]
+        paths = set(path for path in collapsed
+                    if not any(path != w + "*" and path.startswith(w) for w in wildcards))
+        level -= 1
+
+    # only reached with a threshold below one path
+    if len(paths) > threshold or sum(path.endswith("*") for path in paths) > MAX_WILDCARD_PATHS:
+        paths = {"/*"}
+
+    return [urllib.parse.quote(path, safe="/*~") for path in sorted(paths)]
 
 #---------------------------------------------------------------------------------------------------
 # set metadata
-def create_metadata_args(raw_user_metadata, raw_system_metadata):
+def create_metadata_extra_args(raw_user_metadata, raw_system_metadata):
     if len(raw_user_metadata) == 0 and len(raw_system_metadata) == 0:
-        return []
+        return {}
 
     format_system_metadata_key = lambda k: k.lower()
     format_user_metadata_key = lambda k: k.lower()
@@ -250,18 +896,272 @@ def create_metadata_args(raw_user_metadata, raw_system_metadata):
     system_metadata = { format_system_metadata_key(k): v for k, v in raw_system_metadata.items() }
     user_metadata = { format_user_metadata_key(k): v for k, v in raw_user_metadata.items() }
 
-    flatten = lambda l: [item for sublist in l for item in sublist]
-    system_args = flatten([[f"--{k}", v] for k, v in system_metadata.items()])
-    user_args = ["--metadata", json.dumps(user_metadata, separators=(',', ':'))] if len(user_metadata) > 0 else []
+    extra_args = {}
+    for k, v in system_metadata.items():
+        if k not in SYSTEM_METADATA_ARGS:
+            raise Exception("unsupported system metadata key: %s" % k)
+        extra_args[SYSTEM_METADATA_ARGS[k]] = v
+    if len(user_metadata) > 0:
+        extra_args["Metadata"] = user_metadata
 
-    return system_args + user_args + ["--metadata-directive", "REPLACE"]
+    return extra_args
 
 #---------------------------------------------------------------------------------------------------
-# executes an "aws" cli command
-def aws_command(*args):
-    aws="/opt/awscli/aws" # from AwsCliLayer
-    logger.info("| aws %s" % ' '.join(args))
-    subprocess.check_call([aws] + list(args))
+# split an "s3://bucket/key" url into bucket and key
+def parse_s3_url(url):
+    bucket, _, key = url[len("s3://"):].partition("/")
+    return bucket, key
+
+# key prefix for a recursive operation on an s3 url; like the aws cli, a
+# non-empty prefix is treated as a directory
+def s3_dir_prefix(url):
+    bucket, prefix = parse_s3_url(url)
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    return bucket, prefix
+
+#---------------------------------------------------------------------------------------------------
+# evaluate --exclude/--include filters the way "aws s3 sync" does: every file
+# starts out included, all excludes are applied and then all includes, and the
+# last matching filter wins
+def is_included(relative_path, exclude, include):
+    included = True
+    for pattern in exclude:
+        if fnmatch.fnmatchcase(relative_path, pattern):
+            included = False
+    for pattern in include:
+        if fnmatch.fnmatchcase(relative_path, pattern):
+            included = True
+    return included
+
+#---------------------------------------------------------------------------------------------------
+# download a single object to a local file (ranged, parallel GETs for large objects)
+def s3_download(s3_client, s3_url, local_path):
+    bucket, key = parse_s3_url(s3_url)
+    logger.info("| download s3://%s/%s -> %s" % (bucket, key, local_path))
+    with metrics.phase('Download', Files=1):
+        s3_client.download_file(bucket, key, local_path, Config=TRANSFER_CONFIG)
+    metrics.add('Download', Bytes=os.path.getsize(local_path))
+
+# list every object under a prefix as {relative key: object summary}
+def s3_list_objects(s3_client, bucket, prefix):
+    objects = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key'][len(prefix):]] = obj
+    return objects
+
+# delete keys in batches of 1000 (the delete_objects limit)
+def s3_delete_keys(s3_client, bucket, keys):
+    keys = list(keys)
+    for i in range(0, len(keys), 1000):
+        batch = keys[i:i + 1000]
+        resp = s3_client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in batch],
+            'Quiet': True
+        })
+        if resp.get('Errors'):
+            raise Exception("failed to delete %d objects from %s, first error: %s" % (len(resp['Errors']), bucket, resp['Errors'][0]))
+
+# equivalent of "aws s3 rm --recursive"
+def s3_remove_recursive(s3_client, s3_url):
+    bucket, prefix = s3_dir_prefix(s3_url)
+    keys = [prefix + rel for rel in s3_list_objects(s3_client, bucket, prefix)]
+    logger.info("| rm --recursive s3://%s/%s (%d objects)" % (bucket, prefix, len(keys)))
+    s3_delete_keys(s3_client, bucket, keys)
+
+#---------------------------------------------------------------------------------------------------
+# equivalent of "aws s3 sync": upload local files that are missing at the
+# destination, differ in size or are newer than the object, and (if pruning)
+# delete objects that no longer exist locally. Excluded paths are neither
+# uploaded nor deleted. With content hash sync enabled, files are compared
+# by content hash against the manifest instead.
+def s3_sync(s3_client, contents_dir, s3_dest, prune, exclude, include, extra_args):
+    bucket, prefix = s3_dir_prefix(s3_dest)
+
+    local_files = {}
+    for root, _, files in os.walk(contents_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            relative_path = os.path.relpath(path, contents_dir).replace(os.sep, "/")
+            if relative_path != MANIFEST_KEY and is_included(relative_path, exclude, include):
+                local_files[relative_path] = path
+
+    def upload_entry(manager, relative_path, key, upload_args):
+        metrics.add('Upload', Bytes=os.path.getsize(local_files[relative_path]))
+        return manager.upload(local_files[relative_path], bucket, key, extra_args=upload_args)
+
+    def is_unchanged(relative_path, remote):
+        stat = os.stat(local_files[relative_path])
+        return stat.st_size == remote['Size'] and stat.st_mtime <= remote['LastModified'].timestamp()
+
+    hashes = None
+    if content_hash_sync_enabled():
+        hashes = hash_files(local_files)
+
+    logger.info("| sync %s -> s3://%s/%s" % (contents_dir, bucket, prefix))
+    return sync_entries(s3_client, bucket, prefix, local_files, hashes, upload_entry, is_unchanged, prune, exclude, include, extra_args)
+
+# upload the entries that changed, prune stale objects and record the new
+# manifest. Without hashes, entries are uploaded unless "is_unchanged" says the
+# existing object is up to date. Uploads start in "upload_order" (a sort key
+# over relative paths), by path otherwise. Returns the changed object keys.
+def sync_entries(s3_client, bucket, prefix, entries, hashes, upload_entry, is_unchanged, prune, exclude, include, extra_args, upload_order=None):
+    with metrics.phase('List'):
+        remote_objects = s3_list_objects(s3_client, bucket, prefix)
+    metrics.add('List', Files=len(remote_objects))
+
+    if hashes is not None:
+        with metrics.phase('Manifest'):
+            manifest = read_manifest(s3_client, bucket, prefix)
+        uploads = plan_manifest_sync(manifest, hashes, remote_objects, extra_args)
+    else:
+        uploads = []
+        for relative_path in sorted(entries):
+            remote = remote_objects.get(relative_path)
+            if remote is not None and is_unchanged is not None and is_unchanged(relative_path, remote):
+                continue
+            uploads.append(relative_path)
+    if upload_order is not None:
+        uploads.sort(key=upload_order)
+
+    logger.info("| sync: %d of %d files changed" % (len(uploads), len(entries)))
+    with metrics.phase('Upload', Files=len(uploads)), create_transfer_manager(s3_client, TRANSFER_CONFIG) as manager:
+        futures = [upload_entry(manager, relative_path, prefix + relative_path, upload_extra_args(relative_path, extra_args))
+                   for relative_path in uploads]
+        for future in futures:
+            future.result()
+
+    stale = []
+    if prune:
+        stale = [rel for rel in sorted(remote_objects)
+                 if rel not in entries and rel != MANIFEST_KEY and is_included(rel, exclude, include)]
+    # a manifest left behind by an earlier hash sync no longer describes the objects
+    if hashes is None and MANIFEST_KEY in remote_objects:
+        stale.append(MANIFEST_KEY)
+    logger.info("| sync prune: %d objects" % len(stale))
+    with metrics.phase('Prune', Files=len(stale)):
+        s3_delete_keys(s3_client, bucket, [prefix + rel for rel in stale])
+
+    # an unchanged deployment leaves the manifest as it is
+    if hashes is not None and (uploads or manifest is None or set(manifest.get('files', {})) != set(hashes)):
+        with metrics.phase('Manifest'):
+            write_manifest(s3_client, bucket, prefix, hashes, extra_args)
+
+    return sorted(prefix + rel for rel in uploads + stale if rel != MANIFEST_KEY)
+
+def content_hash_sync_enabled():
+    return os.getenv(ENV_KEY_CONTENT_HASH_SYNC, "true").lower() == "true"
+
+#---------------------------------------------------------------------------------------------------
+# content hash manifest: {"files": {relative path: {"sha256", "size", "etag"}}}
+# for everything the last successful deployment uploaded. An object is only
+# skipped if its hash is unchanged and its ETag is still the one recorded, so
+# objects modified by anything else (or by an interrupted deployment) are
+# uploaded again.
+def read_manifest(s3_client, bucket, prefix):
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=prefix + MANIFEST_KEY)['Body'].read()
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    try:
+        manifest = json.loads(body)
+    except ValueError:
+        logger.warning("| ignoring unreadable manifest s3://%s/%s%s" % (bucket, prefix, MANIFEST_KEY))
+        return None
+    return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+def write_manifest(s3_client, bucket, prefix, hashes, extra_args):
+    # record the ETags S3 assigned to the uploaded objects
+    remote_objects = s3_list_objects(s3_client, bucket, prefix)
+    files = {}
+    for relative_path, entry in hashes.items():
+        remote = remote_objects.get(relative_path)
+        if remote is not None:
+            files[relative_path] = dict(entry, etag=remote['ETag'])
+
+    manifest = {'version': MANIFEST_VERSION, 'metadata': metadata_digest(extra_args), 'files': files}
+    s3_client.put_object(Bucket=bucket, Key=prefix + MANIFEST_KEY,
+                         Body=json.dumps(manifest, separators=(',', ':'), sort_keys=True).encode('utf-8'),
+                         ContentType='application/json')
+
+# relative paths whose content, metadata or object differ from the manifest
+def plan_manifest_sync(manifest, hashes, remote_objects, extra_args):
+    previous = {}
+    if manifest and manifest.get('metadata') == metadata_digest(extra_args):
+        previous = manifest.get('files', {})
+
+    uploads = []
+    for relative_path, entry in sorted(hashes.items()):
+        recorded = previous.get(relative_path)
+        remote = remote_objects.get(relative_path)
+        if (recorded and remote and recorded.get('sha256') == entry['sha256']
+                and recorded.get('etag') == remote['ETag']):
+            continue
+        uploads.append(relative_path)
+    return uploads
+
+def metadata_digest(extra_args):
+    return hashlib.sha256(json.dumps(extra_args, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def hash_chunks(chunks):
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        size += len(chunk)
+    return {'sha256': digest.hexdigest(), 'size': size}
+
+# hash local files in parallel (hashlib releases the GIL while hashing)
+def hash_files(local_files):
+    def hash_file(path):
+        with open(path, 'rb') as f:
+            return hash_chunks(read_chunks(f))
+
+    paths = sorted(local_files)
+    with metrics.phase('Hash'), ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        hashes = dict(zip(paths, executor.map(hash_file, [local_files[p] for p in paths])))
+    metrics.add('Hash', Files=len(hashes), Bytes=sum(entry['size'] for entry in hashes.values()))
+    return hashes
+
+# hash the substituted contents of zip members. Each archive is read front to
+# back so every block is fetched once; archives are hashed in parallel.
+def hash_zip_members(archives, entries, replacers):
+    by_archive = collections.defaultdict(list)
+    for relative_path, (i, info) in entries.items():
+        by_archive[i].append((info.header_offset, relative_path, info))
+
+    def hash_archive(i):
+        return [(relative_path, hash_chunks(read_zip_member(archives[i], info, replacers[i])))
+                for _, relative_path, info in sorted(by_archive[i])]
+
+    hashes = {}
+    with metrics.phase('Hash'), ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        for archive_hashes in executor.map(hash_archive, sorted(by_archive)):
+            hashes.update(archive_hashes)
+    metrics.add('Hash', Files=len(hashes), Bytes=sum(entry['size'] for entry in hashes.values()))
+    return hashes
+
+# as many paths as fit in "budget" bytes of JSON
+def truncate_paths(paths, budget):
+    result = []
+    size = 2
+    for path in paths:
+        size += len(json.dumps(path)) + 1
+        if size > budget:
+            break
+        result.append(path)
+    return result
+
+# the aws cli guesses a content type from the file name unless one was given
+def upload_extra_args(relative_path, extra_args):
+    if "ContentType" in extra_args:
+        return extra_args
+    content_type, _ = mimetypes.guess_type(relative_path)
+    if content_type is None:
+        return extra_args
+    return dict(extra_args, ContentType=content_type)
 
 #---------------------------------------------------------------------------------------------------
 # sends a response to cloudformation
@@ -315,14 +1215,85 @@ def bucket_owned(bucketName, keyPrefix):
 
 # extract archive and replace markers in output files
 def extract_and_replace_markers(archive, contents_dir, markers, markers_config):
+    replacer = marker_replacer(markers, markers_config)
     with ZipFile(archive, "r") as zip:
-        zip.extractall(contents_dir)
-
-        # replace markers for this source
-        for file in zip.namelist():
-            file_path = os.path.join(contents_dir, file)
-            if os.path.isdir(file_path): continue
-            replace_markers(file_path, markers, markers_config)
+        infos = zip.infolist()
+        with metrics.phase('Extract', Files=len(infos), Bytes=sum(info.file_size for info in infos)):
+            zip.extractall(contents_dir)
+
+    # replace markers for this source, skipping files that are binary by
+    # extension without even opening them
+    if not replacer: return
+    files = [os.path.join(contents_dir, zip_member_path(info.filename)) for info in infos
+             if not info.is_dir() and not (replacer.skip_binary and file_kind(info.filename) == "binary")]
+    files = list(dict.fromkeys(files))
+    with metrics.phase('ReplaceMarkers', Files=len(files)):
+        substituted = replace_files(replacer, files)
+    metrics.add('ReplaceMarkers', SubstitutedFiles=substituted)
+
+# replace markers in files, across worker processes for large bundles (the
+# regex holds the GIL). Returns the number of files that were rewritten.
+def replace_files(replacer, files):
+    if len(files) < PARALLEL_REPLACE_THRESHOLD or REPLACE_WORKERS < 2:
+        return sum(replacer.replace_file(file) for file in files)
+
+    # lambda has no /dev/shm, so multiprocessing pools and queues cannot be
+    # created there; plain processes reporting back over pipes work anywhere
+    workers = []
+    for i in range(REPLACE_WORKERS):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=replace_files_worker,
+                                          args=(replacer, files[i::REPLACE_WORKERS], sender))
+        process.start()
+        sender.close()
+        workers.append((process, receiver))
+
+    substituted = 0
+    errors = []
+    for process, receiver in workers:
+        try:
+            ok, result = receiver.recv()
+        except EOFError:
+            ok, result = False, "worker exited without a result"
+        receiver.close()
+        process.join()
+        if ok:
+            substituted += result
+        else:
+            errors.append(result)
+    if errors:
+        raise Exception("Failed to replace markers: %s" % "; ".join(errors))
+    return substituted
+
+# body of a marker substitution worker process: replace markers in its share
+# of the files and send back the number rewritten, or the error
+def replace_files_worker(replacer, files, sender):
+    try:
+        sender.send((True, sum(replacer.replace_file(file) for file in files)))
+    except Exception as e:
+        sender.send((False, "%s: %s" % (type(e).__name__, e)))
+    finally:
+        sender.close()
+
+# "text" or "binary" by file extension, None if the contents have to be sniffed
+def file_kind(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in TEXT_EXTENSIONS:
+        return "text"
+    if extension in BINARY_EXTENSIONS:
+        return "binary"
+    return None
+
+# NUL bytes or invalid UTF-8 mean the data is not text markers could appear in
+def looks_binary(head):
+    if b"\0" in head:
+        return True
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # the sample may end in the middle of a multi-byte character
+        return e.start < len(head) - 3
+    return False
 
 def prepare_json_safe_markers(markers):
     """Pre-process markers to ensure JSON-safe values"""
@@ -337,52 +1308,301 @@ def prepare_json_safe_markers(markers):
         safe_markers[key.encode('utf-8')] = json_safe_value.encode('utf-8')
     return safe_markers
 
+def marker_replace_tokens(markers, markers_config):
+    """Encode markers as {token: replacement} bytes, JSON-escaping values if configured."""
+    if not markers:
+        return {}
+    json_escape = markers_config.get('jsonEscape', 'false').lower()
+    if json_escape == 'true':
+        return prepare_json_safe_markers(markers)
+    return dict([(k.encode('utf-8'), v.encode('utf-8')) for k, v in markers.items()])
+
+def marker_replacer(markers, markers_config):
+    """Build the replacer for a source from its markers and markers config."""
+    skip_binary = markers_config.get('binaryFiles', 'false').lower() != 'true'
+    json_values = None
+    if markers and markers_config.get('jsonEscape', 'false').lower() == 'true':
+        json_values = {key: value if isinstance(value, str) else json.dumps(value) for key, value in markers.items()}
+    return MarkerReplacer(marker_replace_tokens(markers, markers_config), skip_binary, json_values)
+
 def replace_markers(filename, markers, markers_config):
     """Replace markers in a file, with special handling for JSON files."""
     # if there are no markers, skip
     if not markers:
-        return
-    
-    outfile = filename + '.new'
-    json_escape = markers_config.get('jsonEscape', 'false').lower()
-    if json_escape == 'true':
-        replace_tokens = prepare_json_safe_markers(markers)
-    else:
-        replace_tokens = dict([(k.encode('utf-8'), v.encode('utf-8')) for k, v in markers.items()])
-
-    # Handle content with line-by-line binary replacement
-    with open(filename, 'rb') as fi, open(outfile, 'wb') as fo:
-        # Process line by line to handle large files
-        for line in fi:
-            for token, replacement in replace_tokens.items():
-                line = line.replace(token, replacement)
-            fo.write(line)
-
-    # Delete the original file and rename the new one to the original
-    os.remove(filename)
-    os.rename(outfile, filename)
-
-def replace_markers_in_json(json_object, replace_tokens):
-    """Replace markers in JSON content with proper escaping."""
-    try:
-        def replace_in_structure(obj):
-            if isinstance(obj, str):
-                # Convert string to bytes for consistent replacement
-                result = obj.encode('utf-8')
-                for token, replacement in replace_tokens.items():
-                    result = result.replace(token, replacement)
-                # Convert back to string
-                return result.decode('utf-8')
-            elif isinstance(obj, dict):
-                return {k: replace_in_structure(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [replace_in_structure(item) for item in obj]
-            return obj
-
-        # Process the whole structure
-        processed = replace_in_structure(json_object)
-        return json.dumps(processed)
-    except Exception as e:
-        logger.error(f'Error processing JSON: {e}')
-        logger.exception(e)
-        return json_object
+        return False
+    return marker_replacer(markers, markers_config).replace_file(filename)
+
+class MarkerReplacer:
+    """Replace any number of tokens in a single pass over fixed-size chunks.
+
+    All tokens are matched by one compiled alternation (longest token first),
+    so the cost no longer grows with the number of markers. The tail of each
+    chunk that could be the start of a token is held back and matched together
+    with the next chunk, so tokens split across chunk boundaries are replaced
+    and memory stays bounded even for minified single-line bundles.
+
+    With "skip_binary", files that are binary by extension or by their first
+    bytes pass through untouched. With "json_values" (unescaped replacements
+    for jsonEscape sources), JSON files are parsed incrementally and tokens
+    are only replaced inside string values, which are re-encoded so the
+    result is always valid JSON. Files that fail to parse fall back to
+    replacing bytes with the escaped values.
+    """
+
+    def __init__(self, replace_tokens, skip_binary=True, json_values=None):
+        self.replace_tokens = replace_tokens
+        self.skip_binary = skip_binary
+        self.json_values = json_values
+        self.json_pattern = None
+        if json_values:
+            self.json_pattern = re.compile("|".join(re.escape(token) for token in sorted(json_values, key=len, reverse=True)))
+        # names of files that parsed as JSON, turned out not to be JSON, or
+        # hold no token at all and pass through byte for byte
+        self.valid_json = set()
+        self.invalid_json = set()
+        self.unmarked_json = set()
+        # names passed to replace_chunks whose contents had a token replaced
+        self.substituted = set()
+        tokens = sorted(replace_tokens, key=len, reverse=True)
+        self.pattern = re.compile(b"|".join(re.escape(token) for token in tokens)) if tokens else None
+        self.holdback = len(tokens[0]) - 1 if tokens else 0
+        # markers generated by the CDK share a long prefix, which bytes.find
+        # can rule out much faster than the regex can
+        self.prefix = os.path.commonprefix(tokens) if tokens else b""
+
+    def __bool__(self):
+        return self.pattern is not None
+
+    def _contains(self, data):
+        if self.prefix and data.find(self.prefix) < 0:
+            return False
+        return self.pattern.search(data) is not None
+
+    def skips(self, name, head):
+        """Whether a file with this name and first chunk is left untouched."""
+        if not self.skip_binary:
+            return False
+        kind = file_kind(name or "")
+        if kind is not None:
+            return kind == "binary"
+        return looks_binary(head[:SNIFF_BYTES])
+
+    def parses_json(self, name):
+        """Whether a file is substituted as JSON rather than as bytes."""
+        return (self.json_pattern is not None and name is not None and name not in self.invalid_json
+                and name not in self.unmarked_json and os.path.splitext(name)[1].lower() in JSON_EXTENSIONS)
+
+    def check_json(self, name, open_chunks):
+        """Parse a JSON file once up front, so that a file that is not JSON is
+        replaced as bytes before any output has been produced for it.
+
+        A JSON file without any token is passed through unchanged instead, the
+        way replace_file leaves it, so streamed and extracted deployments
+        upload the same bytes."""
+        if not self.parses_json(name) or name in self.valid_json:
+            return
+        if not self.contains_markers(open_chunks()):
+            self.unmarked_json.add(name)
+            return
+        try:
+            for _ in transform_json_chunks(open_chunks(), self._replace_json_string):
+                pass
+            self.valid_json.add(name)
+        except ValueError as e:
+            logger.info("| not valid JSON, replacing markers as bytes: %s (%s)" % (name, e))
+            self.invalid_json.add(name)
+
+    def _replace_json_string(self, literal):
+        if self.prefix and literal.find(self.prefix) < 0:
+            return literal
+        value, count = self.json_pattern.subn(lambda match: self.json_values[match.group()], json.loads(literal))
+        if not count:
+            return literal
+        return json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+    def contains_markers(self, chunks):
+        """Pre-scan chunks for any token, including tokens that straddle two chunks."""
+        if not self:
+            return False
+        tail = b""
+        for chunk in chunks:
+            data = tail + chunk
+            if self._contains(data):
+                return True
+            tail = data[len(data) - self.holdback:] if self.holdback else b""
+        return False
+
+    def replace_chunks(self, chunks, name=None):
+        """Yield chunks with every token replaced, recording "name" if any was."""
+        chunks = iter(chunks)
+        first = next(chunks, b"")
+        chunks = itertools.chain([first], chunks)
+        if not self or self.skips(name, first):
+            yield from chunks
+            return
+
+        if self.parses_json(name):
+            replaced = []
+            def replace_string(literal):
+                result = self._replace_json_string(literal)
+                if result is not literal:
+                    replaced.append(literal)
+                return result
+            yield from transform_json_chunks(chunks, replace_string)
+            if replaced:
+                self.substituted.add(name)
+            return
+
+        replaced = 0
+        pending = b""
+        for chunk in chunks:
+            pending += chunk
+            # any match that starts before "safe" is complete within "pending"
+            safe = len(pending) - self.holdback
+            if safe <= 0:
+                continue
+            out = []
+            pos = 0
+            for match in self.pattern.finditer(pending):
+                if match.start() >= safe:
+                    break
+                out.append(pending[pos:match.start()])
+                out.append(self.replace_tokens[match.group()])
+                pos = match.end()
+                replaced += 1
+            end = max(pos, safe)
+            out.append(pending[pos:end])
+            pending = pending[end:]
+            yield b"".join(out)
+
+        if pending:
+            pending, count = self.pattern.subn(lambda match: self.replace_tokens[match.group()], pending)
+            replaced += count
+            yield pending
+        if replaced and name is not None:
+            self.substituted.add(name)
+
+    def replace_file(self, filename):
+        """Rewrite a file with its tokens replaced; files without tokens are left untouched.
+
+        Returns whether the file was rewritten.
+        """
+        if not self:
+            return False
+        with open(filename, 'rb') as fi:
+            chunks = read_chunks(fi)
+            first = next(chunks, b"")
+            if self.skips(filename, first) or not self.contains_markers(itertools.chain([first], chunks)):
+                return False
+
+        outfile = filename + '.new'
+        try:
+            self._rewrite(filename, outfile)
+        except ValueError as e:
+            if not self.parses_json(filename):
+                raise
+            logger.info("| not valid JSON, replacing markers as bytes: %s (%s)" % (filename, e))
+            self.invalid_json.add(filename)
+            self._rewrite(filename, outfile)
+
+        # swap the new contents in under the original name
+        os.replace(outfile, filename)
+        return True
+
+    def _rewrite(self, filename, outfile):
+        with open(filename, 'rb') as fi, open(outfile, 'wb') as fo:
+            for chunk in self.replace_chunks(read_chunks(fi), filename):
+                fo.write(chunk)
+
+# one JSON token, optionally preceded by whitespace: a string, a number, a
+# literal or a structural character
+JSON_TOKEN = re.compile(rb'[ \t\n\r]*(?:("[^"\\]*(?:\\.[^"\\]*)*")|(-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?)|(true|false|null)|([{}\[\]:,]))', re.S)
+# what a token cut off at the end of a chunk can start with, and the rest of
+# a number cut off after a valid prefix ("1.", "2e")
+JSON_TOKEN_START = re.compile(rb'[ \t\n\r]*(?:["\-0-9tfn]|$)')
+JSON_NUMBER_REST = re.compile(rb'[0-9.eE+\-]+$')
+
+# re-serialize a JSON document compactly from an iterator of byte chunks,
+# passing the literal of every string value (not object keys) through
+# "replace_string". Only one token (and the current chunk) is held in memory
+# at a time. Raises ValueError if the input is not a single JSON value.
+def transform_json_chunks(chunks, replace_string):
+    chunks = iter(chunks)
+    buffer = b""
+    pos = 0
+    eof = False
+    stack = []
+    state = "value"
+    out = []
+
+    def after_value():
+        return "comma_or_end" if stack else "done"
+
+    while True:
+        match = JSON_TOKEN.match(buffer, pos)
+        # a token touching the end of the buffer may continue in the next chunk
+        if match is None or not eof and (match.end() == len(buffer) or
+                                         match.group(2) and JSON_NUMBER_REST.match(buffer, match.end())):
+            if eof:
+                if buffer[pos:].strip(b" \t\n\r"):
+                    raise ValueError("unexpected data at offset %d" % pos)
+                break
+            if match is None and not JSON_TOKEN_START.match(buffer, pos):
+                raise ValueError("unexpected data at offset %d" % pos)
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+            else:
+                buffer = buffer[pos:] + chunk
+                pos = 0
+            if out:
+                yield b"".join(out)
+                out = []
+            continue
+
+        pos = match.end()
+        string, number, literal, char = match.groups()
+        if state in ("value", "value_or_end"):
+            if string is not None:
+                out.append(replace_string(string))
+                state = after_value()
+            elif number is not None or literal is not None:
+                out.append(number or literal)
+                state = after_value()
+            elif char in (b"{", b"["):
+                out.append(char)
+                stack.append(char)
+                state = "key_or_end" if char == b"{" else "value_or_end"
+            elif char == b"]" and state == "value_or_end":
+                out.append(char)
+                stack.pop()
+                state = after_value()
+            else:
+                raise ValueError("expected a value at offset %d" % match.start())
+        elif state in ("key", "key_or_end"):
+            if string is not None:
+                out.append(string)
+                state = "colon"
+            elif char == b"}" and state == "key_or_end":
+                out.append(char)
+                stack.pop()
+                state = after_value()
+            else:
+                raise ValueError("expected a key at offset %d" % match.start())
+        elif state == "colon" and char == b":":
+            out.append(char)
+            state = "value"
+        elif state == "comma_or_end" and char == b",":
+            out.append(char)
+            state = "key" if stack[-1] == b"{" else "value"
+        elif state == "comma_or_end" and char in (b"}", b"]") and stack[-1] == (b"{" if char == b"}" else b"["):
+            out.append(char)
+            stack.pop()
+            state = after_value()
+        else:
+            raise ValueError("unexpected token at offset %d" % match.start())
+
+    if state != "done":
+        raise ValueError("unexpected end of JSON")
+    if out:
+        yield b"".join(out)
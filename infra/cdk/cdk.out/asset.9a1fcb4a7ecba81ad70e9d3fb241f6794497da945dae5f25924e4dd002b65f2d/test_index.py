@@ -0,0 +1,52 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import index
+
+
+class MinimalInvalidationPathsTest(unittest.TestCase):
+    def test_under_threshold_keeps_every_path(self):
+        paths = index.minimal_invalidation_paths(["a.js", "css/site.css", "docs/index.html"], 100)
+        self.assertEqual(paths, ["/a.js", "/css/site.css", "/docs/", "/docs/index.html"])
+
+    def test_collapses_directories_over_threshold(self):
+        keys = ["assets/%d.js" % i for i in range(200)] + ["index.html"]
+        self.assertEqual(index.minimal_invalidation_paths(keys, 100), ["/", "/assets/*", "/index.html"])
+
+    def test_root_level_keys_over_threshold_collapse_to_root(self):
+        keys = ["file-%d.js" % i for i in range(200)]
+        self.assertEqual(index.minimal_invalidation_paths(keys, 100), ["/*"])
+
+    def test_never_exceeds_one_invalidation(self):
+        keys = ["file-%d.js" % i for i in range(index.INVALIDATION_BATCH_SIZE + 1)]
+        self.assertEqual(index.minimal_invalidation_paths(keys, 10000), ["/*"])
+
+    def test_too_many_wildcards_collapse_to_root(self):
+        keys = ["dir-%d/%s.js" % (i, name) for i in range(index.MAX_WILDCARD_PATHS + 1) for name in "ab"]
+        keys += ["root-%d.js" % i for i in range(10)]
+        self.assertEqual(index.minimal_invalidation_paths(keys, 20), ["/*"])
+
+
+class CloudfrontInvalidateTest(unittest.TestCase):
+    def test_explicit_paths_wait_between_batches(self):
+        paths = ["/%d" % i for i in range(index.INVALIDATION_BATCH_SIZE * 2 + 1)]
+        calls = []
+        cloudfront = mock.Mock()
+        cloudfront.create_invalidation.side_effect = lambda **kwargs: (
+            calls.append(("create", kwargs["InvalidationBatch"]["Paths"]["Quantity"])) or
+            {"Invalidation": {"Id": "I%d" % len(calls)}})
+
+        with mock.patch.object(index, "cloudfront", cloudfront), \
+                mock.patch.object(index, "wait_for_invalidations",
+                                  side_effect=lambda distribution_id, ids: calls.append(("wait", ids))):
+            ids = index.cloudfront_invalidate("D1", paths, "false", None)
+
+        self.assertEqual(ids, ["I1", "I3", "I5"])
+        self.assertEqual(calls, [("create", 3000), ("wait", ["I1"]), ("create", 3000), ("wait", ["I3"]), ("create", 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Record/replay of AWS API calls for the Medeez operations scripts
+Records every botocore call of a run to a compressed cassette and serves
+later runs from it, so report and rule changes can be iterated on offline
+"""
+
+import base64
+import contextlib
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_VERSION = 1
+
+class CassetteMiss(Exception):
+    """Raised on replay for a call the cassette has no recording of"""
+
+def _encode(value: Any) -> Any:
+    """Make a botocore request or response JSON serializable"""
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(bytes(value)).decode('ascii')}
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    # file objects and other streaming inputs are identified by type only
+    return {'__object__': type(value).__name__}
+
+def _decode(value: Dict[str, Any]) -> Any:
+    """json object_hook reversing _encode"""
+    if '__datetime__' in value:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+    if '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+def _timeless(value: Any) -> Any:
+    """Parameters with timestamps blanked, as they move with the clock between runs"""
+    if isinstance(value, dict):
+        return {k: _timeless(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_timeless(v) for v in value]
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return '__timestamp__'
+    return value
+
+def call_key(region: Optional[str], service: str, operation: str, params: Dict[str, Any]) -> str:
+    """Index key of a call: its region, service, operation and canonical parameters, timestamps aside"""
+    canonical = json.dumps([region, service, operation, _encode(_timeless(params))],
+                           sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class Cassette:
+    """Records botocore calls to, or replays them from, a gzipped JSON-lines file.
+
+    The first line is a header; every other line is one call with its
+    response (errors included, so replayed runs take the same error paths).
+    Calls are keyed by region, service, operation and parameters, with
+    timestamp values ignored. Identical calls are replayed in the order they
+    were recorded, the last response repeating, which keeps waiters and
+    polling loops deterministic. A call whose parameters still differ, such
+    as a date range computed from today, falls back to the calls of its
+    operation in recorded order.
+    """
+
+    def __init__(self, path: str, mode: str):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.calls = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._index: Dict[str, List[Dict[str, Any]]] = {}
+        self._cursors: Dict[str, int] = {}
+        self._by_operation: Dict[Tuple[Optional[str], str, str], List[Dict[str, Any]]] = {}
+        self._operation_cursors: Dict[Tuple[Optional[str], str, str], int] = {}
+
+        if mode == 'record':
+            self._file = gzip.open(path, 'wt', encoding='utf-8')
+            self._write({'version': CASSETTE_VERSION,
+                         'recorded_at': datetime.datetime.now().isoformat(),
+                         'region': boto3.Session().region_name})
+        else:
+            self._load()
+
+    def _load(self):
+        """Read a cassette into the call index"""
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != CASSETTE_VERSION:
+                raise ValueError(f"Unsupported cassette version in {self.path}: {header.get('version')}")
+            for line in f:
+                entry = json.loads(line, object_hook=_decode)
+                # re-key from the recorded parameters so older cassettes follow the current key
+                key = call_key(entry['region'], entry['service'], entry['operation'], entry['params'] or {})
+                self._index.setdefault(key, []).append(entry)
+                self._by_operation.setdefault(
+                    (entry['region'], entry['service'], entry['operation']), []).append(entry)
+
+        # replayed clients still need a region to be created
+        if header.get('region') and not os.environ.get('AWS_DEFAULT_REGION'):
+            os.environ['AWS_DEFAULT_REGION'] = header['region']
+        logger.info(f"Loaded {sum(len(v) for v in self._index.values())} recorded calls from {self.path}")
+
+    def _write(self, entry: Dict[str, Any]):
+        line = json.dumps(_encode(entry), separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def install(self, session: Optional[boto3.Session] = None):
+        """Hook into a session's events; clients must be created afterwards"""
+        if session is None:
+            if boto3.DEFAULT_SESSION is None:
+                boto3.setup_default_session()
+            session = boto3.DEFAULT_SESSION
+        events = session.events
+        events.register('provide-client-params', self._on_params)
+        if self.mode == 'record':
+            events.register('after-call', self._on_after_call)
+        else:
+            events.register('before-call', self._on_before_call)
+
+    def _on_params(self, params, model, context, **kwargs):
+        context['cassette_key'] = call_key(context.get('client_region'), model.service_model.service_name,
+                                           model.name, params)
+        context['cassette_params'] = params
+
+    def _on_after_call(self, http_response, parsed, model, context, **kwargs):
+        # read streaming bodies into the cassette and hand the caller a fresh stream
+        recorded = dict(parsed)
+        for name, value in parsed.items():
+            if isinstance(value, StreamingBody):
+                data = value.read()
+                parsed[name] = StreamingBody(io.BytesIO(data), len(data))
+                recorded[name] = data
+
+        self._write({
+            'key': context['cassette_key'],
+            'service': model.service_model.service_name,
+            'operation': model.name,
+            'region': context.get('client_region'),
+            'params': context.get('cassette_params'),
+            'status': http_response.status_code,
+            'headers': dict(http_response.headers),
+            'response': recorded
+        })
+        with self._lock:
+            self.calls += 1
+
+    def _on_before_call(self, model, context, **kwargs) -> Tuple[AWSResponse, Dict[str, Any]]:
+        key = context['cassette_key']
+        operation = (context.get('client_region'), model.service_model.service_name, model.name)
+        with self._lock:
+            self.calls += 1
+            entries, cursors = self._index.get(key), self._cursors
+            if not entries:
+                key, entries, cursors = operation, self._by_operation.get(operation), self._operation_cursors
+                if not entries:
+                    self.misses += 1
+                    raise CassetteMiss(f"No recorded {model.service_model.service_name}.{model.name} call "
+                                       f"with parameters {json.dumps(_encode(context.get('cassette_params')), sort_keys=True)}")
+                logger.debug(f"Replaying {model.service_model.service_name}.{model.name} by recorded order, "
+                             f"its parameters differ from the recording")
+            cursor = cursors.get(key, 0)
+            cursors[key] = cursor + 1
+            entry = entries[min(cursor, len(entries) - 1)]
+
+        # callers may mutate responses, so every replay gets its own copy
+        response = json.loads(json.dumps(_encode(entry['response'])), object_hook=_decode)
+        for name, member in model.output_shape.members.items() if model.output_shape else ():
+            if member.serialization.get('streaming') and isinstance(response.get(name), bytes):
+                response[name] = StreamingBody(io.BytesIO(response[name]), len(response[name]))
+        return AWSResponse('', entry['status'], entry.get('headers', {}), None), response
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.mode == 'record':
+            logger.info(f"Recorded {self.calls} calls to {self.path}")
+        else:
+            logger.info(f"Replayed {self.calls} calls from {self.path} ({self.misses} not recorded)")
+
+def add_arguments(parser):
+    """Add the --record/--replay options to a script's argument parser"""
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--record', metavar='CASSETTE',
+                       help='Record every AWS API call of this run to a cassette file')
+    group.add_argument('--replay', metavar='CASSETTE',
+                       help='Serve AWS API calls from a recorded cassette instead of AWS')
+
+@contextlib.contextmanager
+def from_args(args) -> Iterator[Optional[Cassette]]:
+    """Record or replay for the duration of a run, as requested on the command line"""
+    if not (args.record or args.replay):
+        yield None
+        return
+    cassette = Cassette(args.record or args.replay, 'record' if args.record else 'replay')
+    cassette.install()
+    try:
+        yield cassette
+    finally:
+        cassette.close()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Tag-based resource discovery for the Medeez operations scripts
+Finds an environment's resources through the Resource Groups Tagging API
+instead of listing every resource in the account and matching on names
+"""
+
+import re
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+import boto3
+
+# Tags the CDK app puts on every resource (see infra/cdk/bin)
+PROJECT_TAG = ('Project', 'Medeez')
+
+def default_tags(environment: str) -> Dict[str, str]:
+    return {'Environment': environment, PROJECT_TAG[0]: PROJECT_TAG[1]}
+
+def resource_name(arn: str) -> str:
+    """Name part of an ARN: the bucket of an S3 ARN, the table of a DynamoDB ARN"""
+    resource = arn.split(':', 5)[5]
+    return re.split('[:/]', resource, maxsplit=1)[-1]
+
+class Resource(NamedTuple):
+    arn: str
+    tags: Dict[str, str]
+
+    @property
+    def name(self) -> str:
+        return resource_name(self.arn)
+
+class ResourceDiscovery:
+    """Resources carrying every one of a set of tags, by resource type.
+
+    Each resource type ('s3', 'dynamodb:table', ...) is fetched with one
+    paginated get_resources sweep the first time it is asked for. The
+    Tagging API is regional, so this finds the resources in the session's
+    region, S3 buckets included.
+    """
+
+    def __init__(self, session: boto3.Session, tags: Dict[str, str]):
+        self.tags = tags
+        self._client = session.client('resourcegroupstaggingapi')
+        self._lock = threading.Lock()
+        self._resources: Dict[str, List[Resource]] = {}
+
+    def resources(self, resource_type: str) -> List[Resource]:
+        with self._lock:
+            if resource_type not in self._resources:
+                self._resources[resource_type] = self._fetch(resource_type)
+            return self._resources[resource_type]
+
+    def names(self, resource_type: str) -> List[str]:
+        return [resource.name for resource in self.resources(resource_type)]
+
+    def _fetch(self, resource_type: str) -> List[Resource]:
+        paginator = self._client.get_paginator('get_resources')
+        pages = paginator.paginate(
+            TagFilters=[{'Key': key, 'Values': [value]} for key, value in self.tags.items()],
+            ResourceTypeFilters=[resource_type],
+            ResourcesPerPage=100
+        )
+        return [
+            Resource(mapping['ResourceARN'], {tag['Key']: tag['Value'] for tag in mapping.get('Tags', [])})
+            for page in pages
+            for mapping in page['ResourceTagMappingList']
+        ]
+
+def parse_tags(values: Optional[List[str]]) -> Optional[Dict[str, str]]:
+    """Turn KEY=VALUE options into a tag filter"""
+    if not values:
+        return None
+    tags = {}
+    for value in values:
+        key, sep, tag_value = value.partition('=')
+        if not sep or not key:
+            raise ValueError(f"Expected KEY=VALUE, got {value!r}")
+        tags[key] = tag_value
+    return tags
+
+def add_arguments(parser):
+    """Add the --tag option to a script's argument parser"""
+    parser.add_argument('--tag', action='append', metavar='KEY=VALUE',
+                       help='Only scan resources with this tag; repeat for several '
+                            '(default: Environment=<environment> and Project=Medeez)')
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Multi-account, multi-region fan-out for the Medeez operations scripts
+Assumes a role per account, runs one scan per (account, region) in a
+process pool under a shared API rate limit and yields the results as the
+scans finish, so a full scan takes about as long as the slowest target
+"""
+
+import datetime
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import boto3
+import botocore.session
+from botocore.credentials import RefreshableCredentials
+
+logger = logging.getLogger(__name__)
+
+# Scans are I/O bound, so there can be more workers than CPUs
+MAX_WORKERS = 32
+
+def default_session() -> boto3.Session:
+    """The default boto3 session, so record/replay and profiling hooks apply"""
+    if boto3.DEFAULT_SESSION is None:
+        boto3.setup_default_session()
+    return boto3.DEFAULT_SESSION
+
+class Target(NamedTuple):
+    """One (account, region) to scan; role_arn None means the current credentials"""
+    role_arn: Optional[str]
+    region: str
+    # global services (IAM, CloudFront, budgets) are only scanned in the
+    # first region of each account
+    primary: bool
+
+    @property
+    def account(self) -> str:
+        return self.role_arn.split(':')[4] if self.role_arn else 'default'
+
+    @property
+    def label(self) -> str:
+        return f"{self.account}/{self.region}"
+
+def build_targets(role_arns: Optional[List[str]], regions: Optional[List[str]]) -> List[Target]:
+    """Every combination of account role and region"""
+    regions = regions or [default_session().region_name or 'us-east-1']
+    return [Target(role_arn, region, i == 0)
+            for role_arn in (role_arns or [None])
+            for i, region in enumerate(regions)]
+
+class CredentialCache:
+    """Assumed-role credentials by role ARN, reused until shortly before they expire"""
+
+    def __init__(self, session_name: str = 'medeez-scan', duration: int = 3600, refresh_margin: int = 300):
+        self.session_name = session_name
+        self.duration = duration
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._credentials: Dict[str, Dict[str, str]] = {}
+        self._sts = None
+
+    def seed(self, role_arn: str, credentials: Dict[str, str]):
+        """Reuse credentials assumed elsewhere (such as by the parent process)"""
+        with self._lock:
+            self._credentials.setdefault(role_arn, credentials)
+
+    def get(self, role_arn: str) -> Dict[str, str]:
+        """Credentials in botocore's refreshable-credentials metadata format"""
+        with self._lock:
+            credentials = self._credentials.get(role_arn)
+            if credentials is None or self._expiring(credentials):
+                if self._sts is None:
+                    self._sts = default_session().client('sts')
+                response = self._sts.assume_role(RoleArn=role_arn, RoleSessionName=self.session_name,
+                                                 DurationSeconds=self.duration)['Credentials']
+                credentials = {
+                    'access_key': response['AccessKeyId'],
+                    'secret_key': response['SecretAccessKey'],
+                    'token': response['SessionToken'],
+                    'expiry_time': response['Expiration'].isoformat()
+                }
+                self._credentials[role_arn] = credentials
+                logger.info(f"Assumed {role_arn} until {credentials['expiry_time']}")
+            return credentials
+
+    def _expiring(self, credentials: Dict[str, str]) -> bool:
+        expiry = datetime.datetime.fromisoformat(credentials['expiry_time'])
+        margin = datetime.timedelta(seconds=self.refresh_margin)
+        return expiry - margin <= datetime.datetime.now(datetime.timezone.utc)
+
+class RateLimiter:
+    """API call rate limit shared by every process of a fan-out.
+
+    The next free slot lives in shared memory, so the limit holds across
+    workers. Up to `burst` calls may go out back to back after an idle spell.
+    """
+
+    def __init__(self, rate: float, burst: int = 10):
+        self.interval = 1.0 / rate
+        self.burst = burst
+        self._next = multiprocessing.Value('d', 0.0)
+
+    def acquire(self, **kwargs):
+        with self._next.get_lock():
+            now = time.monotonic()
+            slot = max(self._next.value, now - self.burst * self.interval)
+            self._next.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def install(self, session: boto3.Session):
+        """Count every HTTP attempt of a session's clients, retries included"""
+        session.events.register('before-send', self.acquire)
+
+    def install_client(self, client):
+        """Count every HTTP attempt of one client, for services with their own quotas"""
+        client.meta.events.register('before-send', self.acquire)
+
+# Per worker process state, set up by _init_worker
+_limiter: Optional[RateLimiter] = None
+_credentials = CredentialCache()
+
+def _init_worker(limiter: Optional[RateLimiter]):
+    global _limiter
+    _limiter = limiter
+
+def _session(target: Target, credentials: Optional[Dict[str, str]]) -> boto3.Session:
+    """A session for the target, refreshing its assumed role when it nears expiry"""
+    botocore_session = botocore.session.Session()
+    if target.role_arn:
+        _credentials.seed(target.role_arn, credentials)
+        # boto3 has no public way to attach refreshable credentials to a session
+        botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+            credentials, refresh_using=lambda: _credentials.get(target.role_arn), method='assume-role')
+    session = boto3.Session(botocore_session=botocore_session, region_name=target.region)
+    if _limiter is not None:
+        _limiter.install(session)
+    return session
+
+def _run(scan: Callable[[boto3.Session, Target], Dict[str, Any]], target: Target,
+         credentials: Optional[Dict[str, str]]) -> Dict[str, Any]:
+    return scan(_session(target, credentials), target)
+
+def fan_out(scan: Callable[[boto3.Session, Target], Dict[str, Any]], targets: List[Target],
+            max_workers: Optional[int] = None, rate: Optional[float] = None) -> Iterator[Tuple[Target, Dict[str, Any]]]:
+    """Run scan(session, target) for every target in a process pool.
+
+    scan must be picklable (a module-level function or a partial of one).
+    Results are yielded in completion order; a target whose scan raised
+    yields {'error': message} instead.
+    """
+    cache = CredentialCache()
+    limiter = RateLimiter(rate) if rate else None
+    workers = max_workers or min(len(targets), MAX_WORKERS, (os.cpu_count() or 1) * 4)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(limiter,)) as executor:
+        futures = {}
+        for target in targets:
+            # roles are assumed once per account here and handed to the workers
+            credentials = cache.get(target.role_arn) if target.role_arn else None
+            futures[executor.submit(_run, scan, target, credentials)] = target
+
+        for future in as_completed(futures):
+            target = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Scan of {target.label} failed: {e}")
+                result = {'error': str(e)}
+            else:
+                logger.info(f"Scan of {target.label} complete")
+            yield target, result
+
+def add_arguments(parser):
+    """Add the fan-out options to a script's argument parser"""
+    parser.add_argument('--accounts', nargs='+', metavar='ROLE_ARN',
+                       help='Scan each account by assuming these roles (default: current credentials)')
+    parser.add_argument('--regions', nargs='+', metavar='REGION',
+                       help='Scan each of these regions (default: the configured region)')
+    parser.add_argument('--max-workers', type=int,
+                       help=f'Scans to run at once across accounts and regions (default: up to {MAX_WORKERS})')
+    parser.add_argument('--rate-limit', type=float, metavar='CALLS_PER_SECOND',
+                       help='Cap on AWS API calls per second shared by all scans')
+
+def enabled(args) -> bool:
+    return bool(args.accounts or args.regions)
+
+def check_arguments(parser, args):
+    """Reject options that only apply to a single in-process scan"""
+    if not enabled(args):
+        return
+    for option in ('record', 'replay', 'profile', 'profile_trace', 'stream', 'cognito_cache'):
+        if getattr(args, option, None):
+            parser.error(f"--{option.replace('_', '-')} cannot be combined with --accounts/--regions")
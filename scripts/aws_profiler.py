@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+AWS API call profiler for the Medeez operations scripts
+Times every botocore call and attributes it to the check or optimizer that
+issued it, so slow services and N+1 call patterns stand out
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterator, List, Optional
+
+import boto3
+import botocore
+
+THROTTLE_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+    'SlowDown', 'RequestThrottled', 'BandwidthLimitExceeded', 'PriorRequestNotComplete'
+}
+
+# Frames from these files are skipped when looking for the function that issued a call
+_LIBRARY_PATHS = tuple(
+    os.path.dirname(module.__file__) + os.sep
+    for module in (boto3, botocore, threading)
+) + (os.path.abspath(__file__),)
+
+_scope = contextvars.ContextVar('aws_profiler_scope', default='main')
+
+@contextlib.contextmanager
+def scope(name: str) -> Iterator[None]:
+    """Attribute the AWS calls made inside the block (and threads it submits
+    work to with a copied context) to a check or optimizer"""
+    token = _scope.set(name)
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+def _percentile(values: List[float], percentile: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))]
+
+def _caller() -> str:
+    """Name of the innermost function outside boto3/botocore on this thread's stack"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not filename.startswith(_LIBRARY_PATHS) and not filename.startswith('<'):
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return 'unknown'
+
+class ApiProfiler:
+    """Collects per-operation latency, retry, throttle and byte counts.
+
+    Calls are timed from before-call to after-call, so retries and backoff
+    are part of a call's latency. Throttles are counted on every attempt
+    through the needs-retry event. Each call is attributed to the current
+    scope and to the function that issued it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._latencies = defaultdict(list)
+        self._stats = defaultdict(Counter)
+        self._scopes = defaultdict(lambda: defaultdict(Counter))
+        self._trace = []
+
+    def install(self, session: Optional[boto3.Session] = None):
+        """Hook into a session's events; clients must be created afterwards"""
+        if session is None:
+            if boto3.DEFAULT_SESSION is None:
+                boto3.setup_default_session()
+            session = boto3.DEFAULT_SESSION
+        events = session.events
+        # registered first so the call is timed even when a later handler
+        # (such as a cassette replay) answers it
+        events.register_first('before-call', self._on_before_call)
+        events.register('needs-retry', self._on_needs_retry)
+        events.register('after-call', self._on_after_call)
+
+    def _on_before_call(self, params, context, **kwargs):
+        body = params.get('body') or b''
+        context['profile'] = {
+            'start': time.perf_counter(),
+            'scope': _scope.get(),
+            'function': _caller(),
+            'request_bytes': len(body) if isinstance(body, (bytes, str)) else 0,
+            'throttles': 0
+        }
+
+    def _on_needs_retry(self, response, request_dict, **kwargs):
+        profile = request_dict.get('context', {}).get('profile')
+        if profile is not None and response is not None:
+            code = response[1].get('Error', {}).get('Code')
+            if code in THROTTLE_ERROR_CODES:
+                profile['throttles'] += 1
+
+    def _on_after_call(self, http_response, parsed, model, context, **kwargs):
+        profile = context.get('profile')
+        if profile is None:
+            return
+        end = time.perf_counter()
+        latency_ms = (end - profile['start']) * 1000
+        operation = f"{model.service_model.service_name}.{model.name}"
+        metadata = parsed.get('ResponseMetadata', {})
+        error = http_response.status_code >= 300
+        headers = getattr(http_response, 'headers', None) or {}
+
+        with self._lock:
+            self._latencies[operation].append(latency_ms)
+            stats = self._stats[operation]
+            stats['calls'] += 1
+            stats['retries'] += metadata.get('RetryAttempts', 0)
+            stats['throttles'] += profile['throttles']
+            stats['errors'] += int(error)
+            stats['request_bytes'] += profile['request_bytes']
+            stats['response_bytes'] += int(headers.get('content-length') or 0)
+
+            functions = self._scopes[profile['scope']]
+            functions[profile['function']][operation] += 1
+            functions[profile['function']]['_time_ms'] += latency_ms
+
+            self._trace.append({
+                'name': operation,
+                'cat': profile['scope'],
+                'ph': 'X',
+                'ts': round((profile['start'] - self._start) * 1e6),
+                'dur': round(latency_ms * 1000),
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': {'function': profile['function'], 'status': http_response.status_code,
+                         'retries': metadata.get('RetryAttempts', 0)}
+            })
+
+    def report(self) -> Dict[str, Any]:
+        """Profile summary for the report"""
+        with self._lock:
+            by_operation = {}
+            for operation, latencies in sorted(self._latencies.items()):
+                stats = self._stats[operation]
+                by_operation[operation] = {
+                    'calls': stats['calls'],
+                    'p50_ms': round(_percentile(latencies, 50), 1),
+                    'p95_ms': round(_percentile(latencies, 95), 1),
+                    'max_ms': round(max(latencies), 1),
+                    'total_ms': round(sum(latencies), 1),
+                    'retries': stats['retries'],
+                    'throttles': stats['throttles'],
+                    'errors': stats['errors'],
+                    'request_bytes': stats['request_bytes'],
+                    'response_bytes': stats['response_bytes']
+                }
+
+            by_scope = {}
+            hotspots = []
+            for scope_name, functions in sorted(self._scopes.items()):
+                by_scope[scope_name] = {}
+                for function, counts in sorted(functions.items()):
+                    operations = {op: n for op, n in sorted(counts.items()) if op != '_time_ms'}
+                    by_scope[scope_name][function] = {
+                        'calls': sum(operations.values()),
+                        'time_ms': round(counts['_time_ms'], 1),
+                        'operations': operations
+                    }
+                    for operation, calls in operations.items():
+                        hotspots.append({'scope': scope_name, 'function': function,
+                                         'operation': operation, 'calls': calls})
+
+        # the same operation called over and over from one function is the
+        # usual sign of an N+1 pattern
+        hotspots.sort(key=lambda h: h['calls'], reverse=True)
+        return {
+            'wall_time_s': round(time.perf_counter() - self._start, 3),
+            'total_calls': sum(op['calls'] for op in by_operation.values()),
+            'by_operation': by_operation,
+            'by_scope': by_scope,
+            'top_call_sites': hotspots[:10]
+        }
+
+    def write_trace(self, path: str):
+        """Write the calls as a Chrome trace (chrome://tracing, Perfetto)"""
+        with self._lock:
+            events = list(self._trace)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+def add_arguments(parser):
+    """Add the --profile/--profile-trace options to a script's argument parser"""
+    parser.add_argument('--profile', action='store_true',
+                       help='Profile AWS API calls and add the profile to the output')
+    parser.add_argument('--profile-trace', metavar='FILE',
+                       help='Also write the profiled calls as a Chrome trace file')
+
+def from_args(args) -> Optional[ApiProfiler]:
+    """Install a profiler if one was requested on the command line"""
+    if not (args.profile or args.profile_trace):
+        return None
+    profiler = ApiProfiler()
+    profiler.install()
+    return profiler
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""
+Benchmark Harness for the Medeez AWS Operations Scripts
+Runs the compliance, cost optimization and cost analysis entry points against
+synthetic accounts and records wall time, API calls and memory to a baseline
+"""
+
+import argparse
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import boto3
+from botocore.awsrequest import AWSResponse
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# entry point -> (script, class, constructor keyword arguments)
+ENTRY_POINTS = {
+    'generate_compliance_report': ('security-compliance-check.py', 'SecurityComplianceChecker', {}),
+    'run_optimization': ('cost-optimization.py', 'CostOptimizer', {'dry_run': True, 'journal_path': None}),
+    'analyze_costs': ('cost-analysis.py', 'CostAnalyzer', {})
+}
+
+# Response members that continue a listing; generated responses never set them
+# unless the listing is actually paginated
+TOKEN_MEMBERS = {
+    'NextToken', 'NextMarker', 'Marker', 'ContinuationToken', 'NextContinuationToken',
+    'NextPageToken', 'NextKeyMarker', 'NextUploadIdMarker', 'LastEvaluatedTableName',
+    'LastEvaluatedKey', 'position', 'IsTruncated'
+}
+
+# String members holding JSON policy documents
+POLICY_MEMBERS = {'Policy', 'PolicyDocument', 'AssumeRolePolicyDocument'}
+
+POLICY_DOCUMENT = json.dumps({
+    'Version': '2012-10-17',
+    'Statement': [{'Effect': 'Allow', 'Principal': {'Service': 'lambda.amazonaws.com'}, 'Action': 'sts:AssumeRole'}]
+})
+
+# String members holding networks, which callers parse as such
+IPV4_CIDR_MEMBERS = {'CidrIp', 'CidrBlock', 'Cidr', 'DestinationCidrBlock'}
+IPV6_CIDR_MEMBERS = {'CidrIpv6', 'Ipv6CidrBlock', 'DestinationIpv6CidrBlock'}
+
+PAGE_TOKEN_PREFIX = 'benchmark-page-'
+DEFAULT_PAGE_SIZE = 100
+MAX_SHAPE_DEPTH = 6
+
+# Listings AWS returns in full unless a page size is requested
+UNPAGED_BY_DEFAULT = {'s3.ListBuckets'}
+
+class SyntheticAccount:
+    """Answers every botocore call of a session from a generated account.
+
+    Responses are built from each operation's output shape. Paginated result
+    lists hold `counts[result key]` items (default `scale`) served in pages,
+    other lists hold two items, and names carry the environment so the
+    scripts' resource filters match. Operations whose results the scripts
+    correlate with their requests have dedicated generators.
+
+    Every attempt waits `latency` seconds and is throttled with probability
+    `throttle_rate`. Throttled attempts are retried with exponential backoff
+    up to the client's configured attempt limit, as botocore's retry handler
+    would, and fail with a ThrottlingException once the limit is reached.
+    """
+
+    def __init__(self, environment: str, scale: int, counts: Dict[str, int], latency: float,
+                 throttle_rate: float, backoff: float, seed: int):
+        self.environment = environment
+        self.scale = scale
+        self.counts = counts
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.backoff = backoff
+        self.calls = Counter()
+        self.throttle_retries = 0
+        self.throttle_failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._session = None
+        self._paginators = {}
+        self._generators = {
+            'ce.GetCostAndUsage': self._cost_and_usage,
+            'monitoring.GetMetricData': self._metric_data,
+            'tagging.GetResources': self._tagged_resources
+        }
+
+    def install(self, session: boto3.Session):
+        """Answer the calls of every client created from the session from here on"""
+        self._session = session._session
+        session.events.register('provide-client-params', self._on_params)
+        session.events.register('before-call', self._on_before_call)
+
+    def _on_params(self, params, context, **kwargs):
+        context['benchmark_params'] = params
+
+    def _on_before_call(self, model, context, **kwargs):
+        service = model.service_model.endpoint_prefix
+        operation = f"{service}.{model.name}"
+        with self._lock:
+            self.calls[operation] += 1
+
+        attempts = self._max_attempts(context.get('client_config'))
+        for attempt in range(attempts):
+            time.sleep(self.latency)
+            with self._lock:
+                throttled = self._random.random() < self.throttle_rate
+                if throttled and attempt == attempts - 1:
+                    self.throttle_failures += 1
+                elif throttled:
+                    self.throttle_retries += 1
+                jitter = self._random.random()
+            if not throttled:
+                break
+            if attempt == attempts - 1:
+                return AWSResponse('', 400, {}, None), {
+                    'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'},
+                    'ResponseMetadata': {'HTTPStatusCode': 400, 'RetryAttempts': attempt}
+                }
+            time.sleep(min(self.backoff * 2 ** attempt, 20) * jitter)
+
+        params = context.get('benchmark_params', {})
+        generator = self._generators.get(operation)
+        response = generator(params) if generator else self._generate(model, params, context.get('client_region'))
+        response['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RetryAttempts': attempt}
+        return AWSResponse('', 200, {}, None), response
+
+    def _max_attempts(self, config) -> int:
+        """Total attempts botocore makes for a call with this client configuration"""
+        retries = getattr(config, 'retries', None) or {}
+        if 'total_max_attempts' in retries:
+            return retries['total_max_attempts']
+        if 'max_attempts' in retries:
+            return retries['max_attempts'] + 1
+        return 5 if retries.get('mode', 'legacy') == 'legacy' else 3
+
+    def _generate(self, model, params: Dict[str, Any], region: Optional[str]) -> Dict[str, Any]:
+        """Build a response from the output shape, paginating the result list"""
+        if model.output_shape is None:
+            return {}
+        service = model.service_model.endpoint_prefix
+        response = self._value(model.output_shape, '', 0, 0, service, region)
+
+        config = self._paginator_config(model)
+        if not config or not isinstance(config.get('input_token'), str) or not isinstance(config.get('output_token'), str):
+            return response
+        result_keys = config['result_key'] if isinstance(config['result_key'], list) else [config['result_key']]
+        for result_key in result_keys:
+            path = result_key.split('.')
+            list_shape = self._shape_at(model.output_shape, path)
+            if list_shape is None or list_shape.type_name != 'list':
+                continue
+
+            total = self.counts.get(path[-1], self.scale)
+            limit = params.get(config.get('limit_key'))
+            if limit is None and f"{service}.{model.name}" not in UNPAGED_BY_DEFAULT:
+                limit = DEFAULT_PAGE_SIZE
+            token = params.get(config['input_token'])
+            start = int(token[len(PAGE_TOKEN_PREFIX):]) if isinstance(token, str) and token.startswith(PAGE_TOKEN_PREFIX) else 0
+            end = min(total, start + limit) if limit else total
+
+            items = [self._value(list_shape.member, path[-1], i, len(path), service, region) for i in range(start, end)]
+            self._set_path(response, path, items)
+            if end < total:
+                self._set_path(response, config['output_token'].split('.'), f"{PAGE_TOKEN_PREFIX}{end}")
+                if config.get('more_results'):
+                    self._set_path(response, config['more_results'].split('.'), True)
+        return response
+
+    def _paginator_config(self, model) -> Optional[Dict[str, Any]]:
+        key = (model.service_model.service_name, model.name)
+        if key not in self._paginators:
+            try:
+                paginators = self._session.get_paginator_model(key[0])
+                self._paginators[key] = paginators.get_paginator(key[1])
+            except Exception:
+                self._paginators[key] = None
+        return self._paginators[key]
+
+    def _shape_at(self, shape, path: List[str]):
+        for name in path:
+            if shape is None or shape.type_name != 'structure':
+                return None
+            shape = shape.members.get(name)
+        return shape
+
+    def _set_path(self, response: Dict[str, Any], path: List[str], value: Any):
+        for name in path[:-1]:
+            response = response.setdefault(name, {})
+        response[path[-1]] = value
+
+    def _value(self, shape, name: str, index: int, depth: int, service: str, region: Optional[str]) -> Any:
+        """Deterministic value for a shape; `index` tells items of a list apart"""
+        type_name = shape.type_name
+        if type_name == 'structure':
+            if depth > MAX_SHAPE_DEPTH:
+                return {}
+            value = {}
+            for member_name, member in shape.members.items():
+                if member_name in TOKEN_MEMBERS or member.serialization.get('streaming'):
+                    continue
+                value[member_name] = self._value(member, member_name, index, depth + 1, service, region)
+            return value
+        if type_name == 'list':
+            if depth > MAX_SHAPE_DEPTH:
+                return []
+            return [self._value(shape.member, name, i, depth + 1, service, region) for i in range(2)]
+        if type_name == 'map':
+            return {}
+        if type_name == 'string':
+            if shape.enum:
+                return shape.enum[index % len(shape.enum)]
+            if name in POLICY_MEMBERS:
+                return POLICY_DOCUMENT
+            # every other network is open to the internet, so exposure checks have work to do
+            if name in IPV4_CIDR_MEMBERS:
+                return '0.0.0.0/0' if index % 2 else f"10.{index % 256}.0.0/16"
+            if name in IPV6_CIDR_MEMBERS:
+                return '::/0' if index % 2 else f"2600:1f18:{index % 65536:x}::/56"
+            if name.endswith('Arn') or name.endswith('ARN'):
+                return f"arn:aws:{service}:{region or 'us-east-1'}:123456789012:medeez-{self.environment}-{index}"
+            return f"medeez-{self.environment}-{name.lower()}-{index}"
+        if type_name in ('integer', 'long'):
+            return index + 1
+        if type_name in ('float', 'double'):
+            return float(index + 1)
+        if type_name == 'boolean':
+            return index % 2 == 0
+        if type_name == 'timestamp':
+            return datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(days=index)
+        if type_name == 'blob':
+            return b''
+        return None
+
+    def _cost_and_usage(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Cost Explorer results with one group per service for every period"""
+        start = datetime.date.fromisoformat(params['TimePeriod']['Start'])
+        end = datetime.date.fromisoformat(params['TimePeriod']['End'])
+        step = datetime.timedelta(days=30 if params.get('Granularity') == 'MONTHLY' else 1)
+        services = min(self.counts.get('Groups', self.scale), 50)
+
+        results = []
+        period_start = start
+        while period_start < end:
+            period_end = min(end, period_start + step)
+            results.append({
+                'TimePeriod': {'Start': period_start.isoformat(), 'End': period_end.isoformat()},
+                'Total': {},
+                'Groups': [{
+                    'Keys': [f"Service {i}"],
+                    'Metrics': {metric: {'Amount': f"{(i + 1) * 1.25:.2f}", 'Unit': 'USD'}
+                                for metric in params.get('Metrics', [])}
+                } for i in range(services)],
+                'Estimated': False
+            })
+            period_start = period_end
+        return {'ResultsByTime': results, 'GroupDefinitions': params.get('GroupBy', [])}
+
+    def _metric_data(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """One datapoint for every query of a get_metric_data call"""
+        timestamp = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        return {'MetricDataResults': [
+            {'Id': query['Id'], 'Label': query['Id'], 'Timestamps': [timestamp],
+             'Values': [float(i % 100)], 'StatusCode': 'Complete'}
+            for i, query in enumerate(params.get('MetricDataQueries', []))
+        ]}
+
+    def _tagged_resources(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Resources of the requested types carrying the requested tags, in pages"""
+        tags = [{'Key': f['Key'], 'Value': (f.get('Values') or [''])[0]} for f in params.get('TagFilters', [])]
+        total = self.counts.get('ResourceTagMappingList', self.scale)
+        arns = []
+        for resource_type in params.get('ResourceTypeFilters') or ['s3']:
+            service, _, kind = resource_type.partition(':')
+            for i in range(total):
+                if service == 's3':
+                    arns.append(f"arn:aws:s3:::medeez-{self.environment}-bucket-{i}")
+                else:
+                    arns.append(f"arn:aws:{service}:us-east-1:123456789012:{kind}/medeez-{self.environment}-{kind}-{i}")
+
+        token = params.get('PaginationToken')
+        start = int(token[len(PAGE_TOKEN_PREFIX):]) if token and token.startswith(PAGE_TOKEN_PREFIX) else 0
+        end = min(len(arns), start + params.get('ResourcesPerPage', 50))
+        return {
+            'ResourceTagMappingList': [{'ResourceARN': arn, 'Tags': tags} for arn in arns[start:end]],
+            'PaginationToken': f"{PAGE_TOKEN_PREFIX}{end}" if end < len(arns) else ''
+        }
+
+def load_script(filename: str):
+    """Import one of the hyphenated scripts as a module"""
+    if SCRIPTS_DIR not in sys.path:
+        sys.path.insert(0, SCRIPTS_DIR)
+    name = filename[:-3].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPTS_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run_entry(entry: str, environment: str, settings: Dict[str, Any]) -> Dict[str, Any]:
+    """Run one entry point against a synthetic account; called in a fresh process"""
+    # the scripts log every resource at INFO, which would dominate the timings
+    logging.disable(logging.INFO)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    boto3.setup_default_session()
+    account = SyntheticAccount(environment, **settings)
+    account.install(boto3.DEFAULT_SESSION)
+
+    script, class_name, kwargs = ENTRY_POINTS[entry]
+    module = load_script(script)
+
+    start = time.perf_counter()
+    instance = getattr(module, class_name)(environment, **kwargs)
+    getattr(instance, entry)()
+    wall_time = time.perf_counter() - start
+
+    return {
+        'wall_time_s': round(wall_time, 3),
+        'api_calls': sum(account.calls.values()),
+        'calls_by_operation': dict(sorted(account.calls.items())),
+        # ru_maxrss is reported in kilobytes on Linux
+        'peak_memory_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'throttle_retries': account.throttle_retries,
+        'throttle_failures': account.throttle_failures
+    }
+
+def compare_to_baseline(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Describe every entry point that got slower, hungrier or chattier than the baseline"""
+    if baseline.get('settings') != results['settings']:
+        print("Baseline was recorded with different settings; skipping comparison")
+        return []
+
+    regressions = []
+    for entry, result in results['entries'].items():
+        base = baseline.get('entries', {}).get(entry)
+        if not base or 'error' in base or 'error' in result:
+            continue
+        if result['wall_time_s'] > base['wall_time_s'] * (1 + tolerance):
+            regressions.append(f"{entry}: wall time {base['wall_time_s']}s -> {result['wall_time_s']}s")
+        if result['peak_memory_mb'] > base['peak_memory_mb'] * (1 + tolerance):
+            regressions.append(f"{entry}: peak memory {base['peak_memory_mb']}MB -> {result['peak_memory_mb']}MB")
+        # call counts are deterministic, so any increase is a regression
+        for operation, count in result['calls_by_operation'].items():
+            before = base['calls_by_operation'].get(operation, 0)
+            if count > before:
+                regressions.append(f"{entry}: {operation} calls {before} -> {count}")
+    return regressions
+
+def parse_counts(values: List[str]) -> Dict[str, int]:
+    counts = {}
+    for value in values:
+        key, _, count = value.partition('=')
+        if not count.isdigit():
+            raise ValueError(f"Expected RESULT_KEY=N, got {value}")
+        counts[key] = int(count)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Medeez AWS scripts against synthetic accounts')
+    parser.add_argument('--environment', default='dev', choices=['dev', 'staging', 'prod'],
+                       help='Environment the synthetic resources belong to')
+    parser.add_argument('--scale', type=int, default=100,
+                       help='Number of items in every paginated listing (roles, buckets, functions, ...)')
+    parser.add_argument('--count', action='append', default=[], metavar='RESULT_KEY=N',
+                       help='Override the number of items for one result key, e.g. Roles=5000')
+    parser.add_argument('--latency-ms', type=float, default=20,
+                       help='Simulated latency of every API attempt')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                       help='Probability that an API attempt is throttled')
+    parser.add_argument('--backoff-ms', type=float, default=50,
+                       help='Base delay of the exponential backoff after a throttled attempt')
+    parser.add_argument('--seed', type=int, default=0,
+                       help='Seed for throttling and backoff jitter')
+    parser.add_argument('--entry', action='append', choices=sorted(ENTRY_POINTS),
+                       help='Entry point to benchmark (default: all)')
+    parser.add_argument('--output', default='benchmark-baseline.json',
+                       help='Output file for results')
+    parser.add_argument('--baseline', help='Previous results to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                       help='Allowed relative increase in wall time and memory over the baseline')
+
+    args = parser.parse_args()
+    try:
+        counts = parse_counts(args.count)
+    except ValueError as e:
+        parser.error(str(e))
+
+    settings = {
+        'scale': args.scale,
+        'counts': counts,
+        'latency': args.latency_ms / 1000,
+        'throttle_rate': args.throttle_rate,
+        'backoff': args.backoff_ms / 1000,
+        'seed': args.seed
+    }
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'environment': args.environment,
+        'settings': settings,
+        'entries': {}
+    }
+
+    for entry in args.entry or list(ENTRY_POINTS):
+        print(f"Benchmarking {entry}...")
+        # a fresh process per entry point keeps peak memory and client caches separate
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                result = executor.submit(run_entry, entry, args.environment, settings).result()
+            except Exception as e:
+                result = {'error': f"{type(e).__name__}: {e}"}
+        results['entries'][entry] = result
+
+        if 'error' in result:
+            print(f"  failed: {result['error']}")
+        else:
+            print(f"  {result['wall_time_s']}s, {result['api_calls']} API calls, "
+                  f"{result['peak_memory_mb']}MB peak, {result['throttle_retries']} throttle retries")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
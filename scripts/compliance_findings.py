@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Structured findings for the Medeez security and compliance checks
+Every finding is a compact record of a rule id, the resource it applies to
+and the values for the rule's message template, so reports can be
+deduplicated, grouped and filtered without parsing messages
+"""
+
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set
+
+SEVERITIES = ('critical', 'high', 'medium', 'low', 'info')
+
+class Rule(NamedTuple):
+    severity: str
+    template: str
+
+# Message templates take the resource's display name as {name} and an
+# optional {detail}; recommendations are rules with severity 'info'
+RULES: Dict[str, Rule] = {
+    # Findings
+    'check.error': Rule('high', "Error checking {name}: {detail}"),
+    's3.encryption-disabled': Rule('high', "S3 bucket {name} does not have encryption enabled"),
+    's3.encryption-not-configured': Rule('high', "S3 bucket {name} does not have encryption configured"),
+    's3.weak-encryption': Rule('medium', "S3 bucket {name} uses weak encryption algorithm: {detail}"),
+    's3.ssl-not-enforced': Rule('high', "S3 bucket {name} does not enforce SSL/TLS"),
+    's3.public-access-not-blocked': Rule('high', "S3 bucket {name} does not block all public access"),
+    's3.versioning-disabled': Rule('medium', "S3 bucket {name} does not have versioning enabled"),
+    's3.access-logging-disabled': Rule('medium', "S3 bucket {name} does not have server access logging enabled"),
+    'dynamodb.encryption-disabled': Rule('high', "DynamoDB table {name} does not have encryption at rest enabled"),
+    'dynamodb.not-kms': Rule('medium', "DynamoDB table {name} is not using KMS encryption"),
+    'kms.rotation-disabled': Rule('medium', "KMS key {name} does not have automatic rotation enabled"),
+    'kms.permissive-policy': Rule('high', "KMS key {name} has overly permissive policy"),
+    'iam.admin-access': Rule('high', "IAM role {name} has administrative access"),
+    'iam.broad-permissions': Rule('high', "IAM role {name} has overly broad permissions"),
+    'cognito.weak-password-policy': Rule('medium', "Cognito user pool {name} has weak password policy"),
+    'cognito.mfa-disabled': Rule('high', "Cognito user pool {name} does not have MFA enabled"),
+    'cognito.password-auth-flow': Rule('medium', "Cognito app client {name} allows password authentication flows: {detail}"),
+    'cognito.long-token-validity': Rule('medium', "Cognito app client {name} issues long-lived tokens: {detail}"),
+    'apigateway.access-logging-disabled': Rule('medium', "API Gateway stage {name} does not have access logging enabled"),
+    'apigateway.data-trace-enabled': Rule('high', "API Gateway stage {name} logs full request and response data"),
+    'apigateway.throttle-too-tight': Rule('medium', "API Gateway stage {name} throttling is too tight for its traffic: {detail}"),
+    'cloudtrail.no-trails': Rule('critical', "No CloudTrail trails configured"),
+    'cloudtrail.not-logging': Rule('high', "CloudTrail {name} is not actively logging"),
+    'cloudtrail.validation-disabled': Rule('medium', "CloudTrail {name} does not have log file validation enabled"),
+    'cloudtrail.not-encrypted': Rule('medium', "CloudTrail {name} logs are not encrypted"),
+    'ec2.open-security-group': Rule('high', "Security group {name} allows access from anywhere"),
+    'ec2.exposed-sensitive-port': Rule('critical', "Security group {name} exposes {detail} to the internet on a public network interface"),
+    'ec2.cross-account-reference': Rule('medium', "Security group {name} allows traffic from a security group in another account: {detail}"),
+
+    # Recommendations
+    's3.enable-encryption': Rule('info', "Enable server-side encryption for {name}"),
+    's3.configure-encryption': Rule('info', "Configure server-side encryption for {name}"),
+    's3.enforce-ssl': Rule('info', "Add bucket policy to enforce SSL/TLS for {name}"),
+    's3.configure-ssl-policy': Rule('info', "Configure bucket policy to enforce SSL/TLS for {name}"),
+    's3.block-public-access': Rule('info', "Enable all four public access block settings for {name}"),
+    's3.enable-versioning': Rule('info', "Enable versioning for {name}"),
+    's3.enable-access-logging': Rule('info', "Enable server access logging for {name}"),
+    's3.consider-object-lock': Rule('info', "Consider Object Lock for {name} to protect records from deletion"),
+    'dynamodb.enable-encryption': Rule('info', "Enable encryption at rest for {name}"),
+    'dynamodb.use-kms': Rule('info', "Use KMS encryption for {name}"),
+    'dynamodb.enable-pitr': Rule('info', "Enable Point-in-Time Recovery for {name}"),
+    'kms.enable-rotation': Rule('info', "Enable automatic rotation for KMS key {name}"),
+    'kms.restrict-policy': Rule('info', "Review and restrict KMS key policy for {name}"),
+    'iam.restrict-permissions': Rule('info', "Review and restrict permissions for {name}"),
+    'iam.least-privilege': Rule('info', "Implement least privilege for {name}"),
+    'cognito.password-length': Rule('info', "Increase minimum password length for {name}"),
+    'cognito.enable-mfa': Rule('info', "Enable MFA for production user pool {name}"),
+    'cognito.account-recovery': Rule('info', "Configure account recovery mechanisms for {name}"),
+    'cognito.use-srp-auth': Rule('info', "Use SRP authentication instead of password flows for app client {name}"),
+    'cognito.shorten-token-validity': Rule('info', "Shorten token validity for app client {name}"),
+    'cognito.enable-token-revocation': Rule('info', "Enable token revocation for app client {name}"),
+    'cognito.prevent-user-existence-errors': Rule('info', "Prevent user existence errors for app client {name}"),
+    'apigateway.enable-access-logging': Rule('info', "Enable access logging for API stage {name}"),
+    'apigateway.enable-tracing': Rule('info', "Enable X-Ray tracing for API stage {name}"),
+    'apigateway.configure-throttling': Rule('info', "Configure throttling for API stage {name}"),
+    'apigateway.disable-data-trace': Rule('info', "Disable data trace logging for API stage {name}"),
+    'apigateway.raise-throttle': Rule('info', "Raise the throttling rate limit for API stage {name}"),
+    'apigateway.review-authorization': Rule('info', "Review authorization for API {name}, which has no authorizers"),
+    'cloudtrail.configure': Rule('info', "Configure CloudTrail for audit logging"),
+    'cloudtrail.enable-validation': Rule('info', "Enable log file validation for {name}"),
+    'cloudtrail.enable-encryption': Rule('info', "Enable encryption for CloudTrail {name}"),
+    'lambda.configure-logging': Rule('info', "Ensure logging is properly configured for {name}"),
+    'ec2.restrict-security-group': Rule('info', "Restrict access in security group {name}"),
+    'ec2.review-cross-account-reference': Rule('info', "Review cross-account security group references in {name}"),
+    'hipaa.rbac': Rule('info', "Implement role-based access control (RBAC)"),
+    'hipaa.access-reviews': Rule('info', "Regular access reviews and user access audits"),
+    'hipaa.training-records': Rule('info', "Maintain workforce training records"),
+    'hipaa.incident-response': Rule('info', "Establish incident response procedures"),
+    'hipaa.baa': Rule('info', "Ensure BAAs are in place with all third-party vendors"),
+    'hipaa.soc2': Rule('info', "Verify AWS SOC 2 Type II compliance documentation"),
+    'hipaa.physical-controls': Rule('info', "Document physical security controls provided by AWS"),
+    'hipaa.unique-user-id': Rule('info', "Implement unique user identification"),
+    'hipaa.emergency-access': Rule('info', "Establish emergency access procedures"),
+    'hipaa.automatic-logoff': Rule('info', "Enable automatic logoff for inactive sessions"),
+    'hipaa.audit-logging': Rule('info', "Enable comprehensive audit logging"),
+    'hipaa.log-monitoring': Rule('info', "Implement log monitoring and alerting"),
+    'hipaa.log-reviews': Rule('info', "Regular audit log reviews"),
+    'hipaa.electronic-signatures': Rule('info', "Implement electronic signature capabilities"),
+    'hipaa.integrity': Rule('info', "Ensure data integrity through checksums/hashing"),
+    'hipaa.tls': Rule('info', "Encrypt all data in transit using TLS 1.2 or higher"),
+    'hipaa.e2e-encryption': Rule('info', "Implement end-to-end encryption for sensitive communications"),
+}
+
+class Finding:
+    """One finding or recommendation.
+
+    Only the rule id, resource ARN, display name and detail are stored; the
+    severity and message come from the rule, so a finding costs a few
+    pointers however often its message text repeats.
+    """
+
+    __slots__ = ('rule', 'resource', 'name', 'detail')
+
+    def __init__(self, rule: str, resource: Optional[str] = None, name: Optional[str] = None,
+                 detail: Optional[str] = None):
+        if rule not in RULES:
+            raise ValueError(f"Unknown rule: {rule}")
+        self.rule = rule
+        self.resource = resource
+        self.name = name
+        self.detail = detail
+
+    @property
+    def severity(self) -> str:
+        return RULES[self.rule].severity
+
+    @property
+    def message(self) -> str:
+        return RULES[self.rule].template.format(name=self.name, detail=self.detail)
+
+    def key(self) -> tuple:
+        return (self.rule, self.resource, self.name, self.detail)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Finding) and self.key() == other.key()
+
+    def __hash__(self) -> int:
+        return hash(self.key())
+
+    def __repr__(self) -> str:
+        return f"Finding({self.rule!r}, {self.resource!r})"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'rule': self.rule, 'severity': self.severity, 'resource': self.resource, 'message': self.message}
+
+def to_json(value: Any) -> Any:
+    """json `default` hook serializing findings as they are written"""
+    if isinstance(value, Finding):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class FindingIndex:
+    """Deduplicating index of findings by rule and by resource"""
+
+    def __init__(self):
+        self._findings: Dict[tuple, Finding] = {}
+        self._by_rule: Dict[str, List[Finding]] = defaultdict(list)
+        self._by_resource: Dict[Optional[str], List[Finding]] = defaultdict(list)
+
+    def add(self, finding: Finding) -> bool:
+        """Index a finding; False if an identical one is already indexed"""
+        key = finding.key()
+        if key in self._findings:
+            return False
+        self._findings[key] = finding
+        self._by_rule[finding.rule].append(finding)
+        self._by_resource[finding.resource].append(finding)
+        return True
+
+    def unique(self, findings: List[Finding]) -> List[Finding]:
+        """Index a list of findings and return the ones not seen before"""
+        return [finding for finding in findings if self.add(finding)]
+
+    def by_rule(self, rule: str) -> List[Finding]:
+        return self._by_rule.get(rule, [])
+
+    def by_resource(self, resource: str) -> List[Finding]:
+        return self._by_resource.get(resource, [])
+
+    def counts_by_rule(self) -> Dict[str, int]:
+        return {rule: len(findings) for rule, findings in sorted(self._by_rule.items())}
+
+    def counts_by_severity(self) -> Dict[str, int]:
+        counts = Counter(finding.severity for finding in self._findings.values())
+        return {severity: counts[severity] for severity in SEVERITIES if counts[severity]}
+
+    def __contains__(self, finding: Finding) -> bool:
+        return finding.key() in self._findings
+
+    def __iter__(self) -> Iterator[Finding]:
+        return iter(self._findings.values())
+
+    def __len__(self) -> int:
+        return len(self._findings)
+
+class FindingCounts:
+    """Deduplicating counts of findings by rule and severity.
+
+    Stands in for FindingIndex when findings are streamed out as they are
+    found: only their keys are kept, so memory does not grow with the
+    findings themselves.
+    """
+
+    def __init__(self):
+        self._keys: Set[tuple] = set()
+        self._by_rule: Counter = Counter()
+        self._by_severity: Counter = Counter()
+
+    def add(self, finding: Finding) -> bool:
+        """Count a finding; False if an identical one was already counted"""
+        key = finding.key()
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        self._by_rule[finding.rule] += 1
+        self._by_severity[finding.severity] += 1
+        return True
+
+    def unique(self, findings: List[Finding]) -> List[Finding]:
+        """Count a list of findings and return the ones not seen before"""
+        return [finding for finding in findings if self.add(finding)]
+
+    def counts_by_rule(self) -> Dict[str, int]:
+        return dict(sorted(self._by_rule.items()))
+
+    def counts_by_severity(self) -> Dict[str, int]:
+        return {severity: self._by_severity[severity] for severity in SEVERITIES if self._by_severity[severity]}
+
+    def __contains__(self, finding: Finding) -> bool:
+        return finding.key() in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
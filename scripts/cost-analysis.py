@@ -8,10 +8,14 @@ import json
 import boto3
 import argparse
 import datetime
+import sys
 from decimal import Decimal
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 import pandas as pd
 
+import aws_cassette
+import aws_profiler
+
 class CostAnalyzer:
     def __init__(self, environment: str):
         self.environment = environment
@@ -287,8 +291,10 @@ class CostAnalyzer:
             'active_doctors': active_doctors
         }
     
-    def generate_report(self, output_file: str = None) -> str:
-        """Generate comprehensive cost analysis report"""
+    def generate_report(self, output_file: str = None,
+                        profiler: Optional[aws_profiler.ApiProfiler] = None) -> str:
+        """Generate comprehensive cost analysis report, with the API call
+        profile of the analysis if a profiler is given"""
         analysis = self.analyze_costs()
         
         # Calculate additional metrics
@@ -314,6 +320,9 @@ class CostAnalyzer:
             ]
         }
         
+        if profiler:
+            report['profile'] = profiler.report()
+        
         # Save to file if specified
         if output_file:
             with open(output_file, 'w') as f:
@@ -330,33 +339,44 @@ def main():
     parser.add_argument('--output', help='Output file for report')
     parser.add_argument('--format', choices=['json', 'csv'], default='json',
                        help='Output format')
+    aws_cassette.add_arguments(parser)
+    aws_profiler.add_arguments(parser)
     
     args = parser.parse_args()
     
-    analyzer = CostAnalyzer(args.environment)
-    
-    if args.format == 'json':
-        report = analyzer.generate_report(args.output)
-        print(report)
-    elif args.format == 'csv':
-        # Generate CSV report
-        analysis = analyzer.analyze_costs()
-        monthly_data = analysis['monthly_costs']
-        
-        # Create DataFrame for CSV export
-        services_data = []
-        for service, data in monthly_data.get('services', {}).items():
-            services_data.append({
-                'service': service,
-                'cost': data['cost'],
-                'usage': data['usage']
-            })
+    profiler = aws_profiler.from_args(args)
+    with aws_cassette.from_args(args):
+        analyzer = CostAnalyzer(args.environment)
         
-        df = pd.DataFrame(services_data)
-        if args.output:
-            df.to_csv(args.output, index=False)
-        else:
-            print(df.to_csv(index=False))
+        if args.format == 'json':
+            report = analyzer.generate_report(args.output, profiler if args.profile else None)
+            print(report)
+        elif args.format == 'csv':
+            # Generate CSV report
+            analysis = analyzer.analyze_costs()
+            monthly_data = analysis['monthly_costs']
+            
+            # Create DataFrame for CSV export
+            services_data = []
+            for service, data in monthly_data.get('services', {}).items():
+                services_data.append({
+                    'service': service,
+                    'cost': data['cost'],
+                    'usage': data['usage']
+                })
+            
+            df = pd.DataFrame(services_data)
+            if args.output:
+                df.to_csv(args.output, index=False)
+            else:
+                print(df.to_csv(index=False))
+            
+            # the CSV has no room for the profile, so it goes to stderr
+            if profiler and args.profile:
+                print(json.dumps(profiler.report(), indent=2), file=sys.stderr)
+    
+    if profiler and args.profile_trace:
+        profiler.write_trace(args.profile_trace)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
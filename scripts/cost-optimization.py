@@ -5,82 +5,269 @@ Automatically implements cost optimization recommendations
 """
 
 import json
+import os
 import boto3
+import hashlib
 import argparse
+import contextvars
+import functools
 import datetime
-from typing import Dict, List, Any
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Any, Callable, Optional, Tuple
 import logging
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import aws_cassette
+import aws_discovery
+import aws_fanout
+import aws_profiler
+import report_stream
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Concurrent calls allowed per service for resource-level work. Control-plane
+# APIs such as CloudFront and DynamoDB's describe calls throttle much earlier
+# than S3 bucket configuration calls do.
+SERVICE_CONCURRENCY = {
+    's3': 8,
+    'dynamodb': 4,
+    'lambda': 4,
+    'cloudfront': 2,
+    'cloudwatch': 2
+}
+
+# Optimizations of account-wide resources, run in the first region of each
+# account only when fanning out
+GLOBAL_OPTIMIZATIONS = {'CloudFront'}
+
+# Request headers whose values vary per viewer; keeping them in a cache key
+# leaves close to one cached object per viewer
+HIGH_CARDINALITY_HEADERS = {
+    'user-agent',
+    'referer',
+    'authorization',
+    'cookie',
+    'x-forwarded-for',
+    'cloudfront-viewer-address'
+}
+
+def structural_diff(current: Any, desired: Any, path: str = '') -> List[str]:
+    """Return the paths at which the current configuration differs from the desired one.
+    
+    Keys that only exist in the current configuration are ignored, since AWS
+    fills in defaults we never asked for. Lists match element-wise in any order.
+    """
+    if isinstance(desired, dict):
+        if not isinstance(current, dict):
+            return [path or '/']
+        drift = []
+        for key, value in desired.items():
+            drift.extend(structural_diff(current.get(key), value, f"{path}/{key}"))
+        return drift
+    
+    if isinstance(desired, list):
+        if not isinstance(current, list) or len(current) != len(desired):
+            return [path or '/']
+        unmatched = list(current)
+        for item in desired:
+            match = next((c for c in unmatched if not structural_diff(c, item)), None)
+            if match is None:
+                return [path or '/']
+            unmatched.remove(match)
+        return []
+    
+    return [] if current == desired else [path or '/']
+
+class ApplyJournal:
+    """Append-only record of the configuration changes applied in execute mode.
+    
+    Every entry stores the change key and a digest of the desired state, so a
+    run that was interrupted can tell which of its writes landed. The live
+    state always wins: a journaled change the plan finds drifted again is
+    forgotten and applied again. The journal is removed once a run finishes
+    without failures.
+    """
+    
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._lock = threading.Lock()
+        self._applied: Dict[str, str] = {}
+        
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn write from an interrupted run
+                    if entry['digest'] is None:
+                        self._applied.pop(entry['key'], None)
+                    else:
+                        self._applied[entry['key']] = entry['digest']
+            logger.info(f"Resuming from journal {path} with {len(self._applied)} applied changes")
+    
+    @staticmethod
+    def digest(desired: Any) -> str:
+        return hashlib.sha256(json.dumps(desired, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    def is_applied(self, key: str, digest: str) -> bool:
+        return self._applied.get(key) == digest
+    
+    def record(self, key: str, digest: Optional[str]):
+        with self._lock:
+            if digest is None:
+                self._applied.pop(key, None)
+            else:
+                self._applied[key] = digest
+            if not self.path:
+                return
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'key': key, 'digest': digest}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+    
+    def forget(self, key: str):
+        """Drop a change whose resource has drifted since it was applied"""
+        if key in self._applied:
+            self.record(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._applied = {}
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
 class CostOptimizer:
-    def __init__(self, environment: str, dry_run: bool = True):
+    def __init__(self, environment: str, dry_run: bool = True, journal_path: Optional[str] = None,
+                 service_concurrency: Optional[Dict[str, int]] = None, session: Optional[boto3.Session] = None,
+                 scan_global: bool = True, tags: Optional[Dict[str, str]] = None):
         self.environment = environment
         self.dry_run = dry_run
+        self.session = session or aws_fanout.default_session()
+        # Global services (CloudFront, budgets) are optimized once per
+        # account, not once per region
+        self.scan_global = scan_global
+        self.discovery = aws_discovery.ResourceDiscovery(self.session, tags or aws_discovery.default_tags(environment))
+        self.service_concurrency = {**SERVICE_CONCURRENCY, **(service_concurrency or {})}
+        self.journal = ApplyJournal(None if dry_run else journal_path)
+        self.apply_failures = 0
+        self._failures_lock = threading.Lock()
         
         # Initialize AWS clients
-        self.s3_client = boto3.client('s3')
-        self.dynamodb_client = boto3.client('dynamodb')
-        self.lambda_client = boto3.client('lambda')
-        self.cloudfront_client = boto3.client('cloudfront')
-        self.ce_client = boto3.client('ce')
+        self.s3_client = self._client('s3')
+        self.dynamodb_client = self._client('dynamodb')
+        self.lambda_client = self._client('lambda')
+        self.cloudfront_client = self._client('cloudfront')
+        # CloudFront publishes its metrics in us-east-1 only
+        self.cloudwatch_client = self._client('cloudwatch', region_name='us-east-1')
+        self.ce_client = self._client('ce')
+    
+    def _client(self, service: str, **kwargs):
+        """Create a client sized for the service's concurrency cap.
+        
+        Adaptive retry mode rate-limits the client on the caller side and backs
+        off exponentially once the service starts returning throttling errors.
+        """
+        return self.session.client(service, config=Config(
+            max_pool_connections=max(10, self.service_concurrency.get(service, 1)),
+            retries={'mode': 'adaptive', 'max_attempts': 10}
+        ), **kwargs)
+    
+    def _map(self, service: str, func: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+        """Run func over items concurrently within the service's cap, keeping input order"""
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=self.service_concurrency.get(service, 1)) as executor:
+            # each task runs in a copy of the caller's context so the caller's
+            # profiler scope carries over to the worker threads
+            futures = [executor.submit(contextvars.copy_context().run, func, item) for item in items]
+            return [future.result() for future in futures]
         
     def optimize_s3_storage(self) -> Dict[str, Any]:
         """Optimize S3 storage costs"""
         results = {'actions': [], 'savings': 0}
         
         try:
-            # List buckets for the environment
-            buckets = self.s3_client.list_buckets()['Buckets']
-            env_buckets = [b for b in buckets if self.environment in b['Name']]
+            # Buckets tagged for the environment in this region
+            env_buckets = self.discovery.names('s3')
             
-            for bucket in env_buckets:
-                bucket_name = bucket['Name']
+            def analyze_bucket(bucket_name):
                 logger.info(f"Analyzing bucket: {bucket_name}")
-                
-                # Enable Intelligent Tiering
-                if not self.dry_run:
-                    try:
-                        self.s3_client.put_bucket_intelligent_tiering_configuration(
-                            Bucket=bucket_name,
-                            Id='EntireBucket',
-                            IntelligentTieringConfiguration={
-                                'Id': 'EntireBucket',
-                                'Status': 'Enabled',
-                                'Filter': {'Prefix': ''},
-                                'Tierings': [
-                                    {
-                                        'Days': 1,
-                                        'AccessTier': 'ARCHIVE_ACCESS'
-                                    },
-                                    {
-                                        'Days': 90,
-                                        'AccessTier': 'DEEP_ARCHIVE_ACCESS'
-                                    }
-                                ]
-                            }
-                        )
-                        results['actions'].append(f"Enabled Intelligent Tiering for {bucket_name}")
-                    except Exception as e:
-                        logger.warning(f"Could not enable Intelligent Tiering for {bucket_name}: {e}")
-                else:
-                    results['actions'].append(f"[DRY RUN] Would enable Intelligent Tiering for {bucket_name}")
+                bucket_results = {'actions': []}
                 
                 # Clean up incomplete multipart uploads
-                self._cleanup_multipart_uploads(bucket_name, results)
-                
-                # Implement lifecycle policies
-                self._implement_lifecycle_policies(bucket_name, results)
+                self._cleanup_multipart_uploads(bucket_name, bucket_results)
                 
-                # Estimate savings (rough estimate)
-                results['savings'] += 50  # Estimated monthly savings per bucket
+                return bucket_results['actions']
+            
+            for actions in self._map('s3', analyze_bucket, env_buckets):
+                results['actions'].extend(actions)
+            
+            # Enable Intelligent Tiering and implement lifecycle policies
+            targets = []
+            for bucket_name in env_buckets:
+                targets.append(self._intelligent_tiering_target(bucket_name))
+                targets.append(self._lifecycle_policy_target(bucket_name))
+            
+            self._apply_changes('s3', self._plan_changes('s3', targets), results)
+            
+            # Estimate savings (rough estimate)
+            results['savings'] += 50 * len(env_buckets)  # Estimated monthly savings per bucket
                 
         except Exception as e:
             logger.error(f"Error optimizing S3 storage: {e}")
         
         return results
     
+    def _intelligent_tiering_target(self, bucket_name: str) -> Dict[str, Any]:
+        """Describe the desired Intelligent Tiering configuration for a bucket"""
+        tiering_config = {
+            'Id': 'EntireBucket',
+            'Status': 'Enabled',
+            'Filter': {'Prefix': ''},
+            'Tierings': [
+                {
+                    'Days': 1,
+                    'AccessTier': 'ARCHIVE_ACCESS'
+                },
+                {
+                    'Days': 90,
+                    'AccessTier': 'DEEP_ARCHIVE_ACCESS'
+                }
+            ]
+        }
+        
+        def read():
+            try:
+                return self.s3_client.get_bucket_intelligent_tiering_configuration(
+                    Bucket=bucket_name,
+                    Id='EntireBucket'
+                )['IntelligentTieringConfiguration']
+            except ClientError as e:
+                if e.response['Error']['Code'] in ('NoSuchConfiguration', 'NoSuchIntelligentTieringConfiguration'):
+                    return None
+                raise
+        
+        def apply(current):
+            self.s3_client.put_bucket_intelligent_tiering_configuration(
+                Bucket=bucket_name,
+                Id='EntireBucket',
+                IntelligentTieringConfiguration=tiering_config
+            )
+        
+        return {
+            'key': f"s3:{bucket_name}:intelligent-tiering",
+            'resource': bucket_name,
+            'change': 'enable Intelligent Tiering',
+            'done': 'Enabled Intelligent Tiering',
+            'desired': tiering_config,
+            'read': read,
+            'apply': apply
+        }
+    
     def _cleanup_multipart_uploads(self, bucket_name: str, results: Dict[str, Any]):
         """Clean up incomplete multipart uploads"""
         try:
@@ -104,110 +291,204 @@ class CostOptimizer:
         except Exception as e:
             logger.warning(f"Could not clean up multipart uploads for {bucket_name}: {e}")
     
-    def _implement_lifecycle_policies(self, bucket_name: str, results: Dict[str, Any]):
-        """Implement S3 lifecycle policies"""
-        lifecycle_config = {
-            'Rules': [
+    def _lifecycle_policy_target(self, bucket_name: str) -> Dict[str, Any]:
+        """Describe the desired S3 lifecycle rule for a bucket"""
+        lifecycle_rule = {
+            'ID': 'MedeezLifecycleRule',
+            'Status': 'Enabled',
+            'Filter': {'Prefix': ''},
+            'Transitions': [
                 {
-                    'ID': 'MedeezLifecycleRule',
-                    'Status': 'Enabled',
-                    'Filter': {'Prefix': ''},
-                    'Transitions': [
-                        {
-                            'Days': 30,
-                            'StorageClass': 'STANDARD_IA'
-                        },
-                        {
-                            'Days': 90,
-                            'StorageClass': 'GLACIER'
-                        },
-                        {
-                            'Days': 365,
-                            'StorageClass': 'DEEP_ARCHIVE'
-                        }
-                    ],
-                    'AbortIncompleteMultipartUpload': {
-                        'DaysAfterInitiation': 7
-                    }
+                    'Days': 30,
+                    'StorageClass': 'STANDARD_IA'
+                },
+                {
+                    'Days': 90,
+                    'StorageClass': 'GLACIER'
+                },
+                {
+                    'Days': 365,
+                    'StorageClass': 'DEEP_ARCHIVE'
                 }
-            ]
+            ],
+            'AbortIncompleteMultipartUpload': {
+                'DaysAfterInitiation': 7
+            }
         }
         
-        try:
-            if not self.dry_run:
-                self.s3_client.put_bucket_lifecycle_configuration(
-                    Bucket=bucket_name,
-                    LifecycleConfiguration=lifecycle_config
-                )
-                results['actions'].append(f"Implemented lifecycle policy for {bucket_name}")
-            else:
-                results['actions'].append(f"[DRY RUN] Would implement lifecycle policy for {bucket_name}")
-                
-        except Exception as e:
-            logger.warning(f"Could not implement lifecycle policy for {bucket_name}: {e}")
+        def read():
+            try:
+                return self.s3_client.get_bucket_lifecycle_configuration(Bucket=bucket_name)['Rules']
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'NoSuchLifecycleConfiguration':
+                    return []
+                raise
+        
+        def extract(rules):
+            return next((r for r in rules if r.get('ID') == lifecycle_rule['ID']), None)
+        
+        def apply(rules):
+            # Rules owned by other tooling are carried over untouched
+            other_rules = [r for r in rules if r.get('ID') != lifecycle_rule['ID']]
+            self.s3_client.put_bucket_lifecycle_configuration(
+                Bucket=bucket_name,
+                LifecycleConfiguration={'Rules': other_rules + [lifecycle_rule]}
+            )
+        
+        return {
+            'key': f"s3:{bucket_name}:lifecycle",
+            'resource': bucket_name,
+            'change': 'implement lifecycle policy',
+            'done': 'Implemented lifecycle policy',
+            'desired': lifecycle_rule,
+            'read': read,
+            'extract': extract,
+            'apply': apply
+        }
     
     def optimize_dynamodb(self) -> Dict[str, Any]:
         """Optimize DynamoDB costs"""
         results = {'actions': [], 'savings': 0}
         
         try:
-            # List tables for the environment
-            tables = self.dynamodb_client.list_tables()['TableNames']
-            env_tables = [t for t in tables if self.environment in t]
+            # Tables tagged for the environment
+            env_tables = self.discovery.names('dynamodb:table')
             
-            for table_name in env_tables:
+            def describe_table(table_name):
                 logger.info(f"Analyzing DynamoDB table: {table_name}")
-                
-                # Get table description
-                table_desc = self.dynamodb_client.describe_table(TableName=table_name)['Table']
-                
+                return self.dynamodb_client.describe_table(TableName=table_name)['Table']
+            
+            table_descs = self._map('dynamodb', describe_table, env_tables)
+            
+            targets = []
+            for table_name, table_desc in zip(env_tables, table_descs):
                 # Enable Point-in-Time Recovery if not enabled
-                if not table_desc.get('PointInTimeRecoveryDescription', {}).get('PointInTimeRecoveryStatus') == 'ENABLED':
-                    if not self.dry_run:
-                        self.dynamodb_client.update_continuous_backups(
-                            TableName=table_name,
-                            PointInTimeRecoverySpecification={'PointInTimeRecoveryEnabled': True}
-                        )
-                        results['actions'].append(f"Enabled PITR for {table_name}")
-                    else:
-                        results['actions'].append(f"[DRY RUN] Would enable PITR for {table_name}")
+                targets.append(self._dynamodb_pitr_target(table_name))
                 
                 # Implement TTL for expired records
-                self._implement_dynamodb_ttl(table_name, results)
+                targets.append(self._dynamodb_ttl_target(table_name))
                 
                 # Check for On-Demand billing mode
-                if table_desc['BillingModeSummary']['BillingMode'] == 'PROVISIONED':
+                if table_desc.get('BillingModeSummary', {}).get('BillingMode', 'PROVISIONED') == 'PROVISIONED':
                     results['actions'].append(f"Consider switching {table_name} to On-Demand billing for variable workloads")
                 
                 # Estimate savings
                 results['savings'] += 25  # Estimated monthly savings per table
+            
+            self._apply_changes('dynamodb', self._plan_changes('dynamodb', targets), results)
                 
         except Exception as e:
             logger.error(f"Error optimizing DynamoDB: {e}")
         
         return results
     
-    def _implement_dynamodb_ttl(self, table_name: str, results: Dict[str, Any]):
-        """Implement TTL for DynamoDB table"""
-        try:
-            # Check if TTL is already enabled
+    def _dynamodb_pitr_target(self, table_name: str) -> Dict[str, Any]:
+        """Describe the desired Point-in-Time Recovery state for a table"""
+        def read():
+            backups = self.dynamodb_client.describe_continuous_backups(TableName=table_name)
+            status = backups['ContinuousBackupsDescription'].get('PointInTimeRecoveryDescription', {}).get('PointInTimeRecoveryStatus')
+            return {'PointInTimeRecoveryEnabled': status == 'ENABLED'}
+        
+        def apply(current):
+            self.dynamodb_client.update_continuous_backups(
+                TableName=table_name,
+                PointInTimeRecoverySpecification={'PointInTimeRecoveryEnabled': True}
+            )
+        
+        return {
+            'key': f"dynamodb:{table_name}:pitr",
+            'resource': table_name,
+            'change': 'enable PITR',
+            'done': 'Enabled PITR',
+            'desired': {'PointInTimeRecoveryEnabled': True},
+            'read': read,
+            'apply': apply
+        }
+    
+    def _dynamodb_ttl_target(self, table_name: str) -> Dict[str, Any]:
+        """Describe the desired TTL state for a table"""
+        def read():
             ttl_desc = self.dynamodb_client.describe_time_to_live(TableName=table_name)
-            
-            if ttl_desc['TimeToLiveDescription']['TimeToLiveStatus'] != 'ENABLED':
-                if not self.dry_run:
-                    self.dynamodb_client.update_time_to_live(
-                        TableName=table_name,
-                        TimeToLiveSpecification={
-                            'AttributeName': 'ttl',
-                            'Enabled': True
-                        }
-                    )
-                    results['actions'].append(f"Enabled TTL for {table_name}")
-                else:
-                    results['actions'].append(f"[DRY RUN] Would enable TTL for {table_name}")
-                    
-        except Exception as e:
-            logger.warning(f"Could not implement TTL for {table_name}: {e}")
+            status = ttl_desc['TimeToLiveDescription']['TimeToLiveStatus']
+            # A TTL that is still being switched on counts as converged
+            return {'Enabled': status in ('ENABLED', 'ENABLING')}
+        
+        def apply(current):
+            self.dynamodb_client.update_time_to_live(
+                TableName=table_name,
+                TimeToLiveSpecification={
+                    'AttributeName': 'ttl',
+                    'Enabled': True
+                }
+            )
+        
+        return {
+            'key': f"dynamodb:{table_name}:ttl",
+            'resource': table_name,
+            'change': 'enable TTL',
+            'done': 'Enabled TTL',
+            'desired': {'Enabled': True},
+            'read': read,
+            'apply': apply
+        }
+    
+    def _plan_changes(self, service: str, targets: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Read the current state of every target concurrently and keep the ones that drift"""
+        def read_target(target):
+            try:
+                raw = target['read']()
+            except Exception as e:
+                logger.warning(f"Could not read current state for {target['key']}: {e}")
+                return None
+            current = target.get('extract', lambda state: state)(raw)
+            return raw, structural_diff(current, target['desired'])
+        
+        states = self._map(service, read_target, targets)
+        
+        changes = []
+        for target, state in zip(targets, states):
+            if state is None:
+                continue
+            raw, drift = state
+            if not drift:
+                logger.info(f"{target['key']} already matches the desired state")
+                continue
+            logger.info(f"{target['key']} differs at: {', '.join(drift)}")
+            changes.append({**target, 'current': raw, 'drift': drift})
+        
+        return changes
+    
+    def _apply_changes(self, service: str, changes: List[Dict[str, Any]], results: Dict[str, Any]):
+        """Apply planned changes in parallel, recording each one in the journal"""
+        if self.dry_run:
+            for change in changes:
+                results['actions'].append(f"[DRY RUN] Would {change['change']} for {change['resource']}")
+            return
+        
+        def apply_change(change):
+            # Everything planned differs from the desired state right now, so
+            # a journal entry means the change was applied and since reverted
+            digest = self.journal.digest(change['desired'])
+            if self.journal.is_applied(change['key'], digest):
+                logger.info(f"{change['key']} was applied by an earlier run but has drifted again")
+                self.journal.forget(change['key'])
+            try:
+                change['apply'](change['current'])
+            except Exception as e:
+                logger.warning(f"Could not {change['change']} for {change['resource']}: {e}")
+                return 'failed'
+            self.journal.record(change['key'], digest)
+            return 'applied'
+        
+        outcomes = self._map(service, apply_change, changes)
+        
+        # Report in plan order regardless of completion order
+        for change, outcome in zip(changes, outcomes):
+            if outcome == 'failed':
+                with self._failures_lock:
+                    self.apply_failures += 1
+            else:
+                results['actions'].append(f"{change['done']} for {change['resource']}")
     
     def optimize_lambda_functions(self) -> Dict[str, Any]:
         """Optimize Lambda function costs"""
@@ -245,42 +526,265 @@ class CostOptimizer:
         return results
     
     def optimize_cloudfront(self) -> Dict[str, Any]:
-        """Optimize CloudFront costs"""
-        results = {'actions': [], 'savings': 0}
+        """Optimize CloudFront costs and cache efficiency"""
+        results = {'actions': [], 'savings': 0, 'cache_findings': []}
         
         try:
             # List distributions
-            distributions = self.cloudfront_client.list_distributions()
+            distributions = []
+            paginator = self.cloudfront_client.get_paginator('list_distributions')
+            for page in paginator.paginate():
+                distributions.extend(page.get('DistributionList', {}).get('Items', []))
             
-            if 'DistributionList' in distributions and 'Items' in distributions['DistributionList']:
-                for dist in distributions['DistributionList']['Items']:
-                    dist_id = dist['Id']
-                    logger.info(f"Analyzing CloudFront distribution: {dist_id}")
-                    
-                    # Check price class
-                    price_class = dist['PriceClass']
-                    if price_class == 'PriceClass_All' and self.environment != 'prod':
-                        results['actions'].append(f"Consider using PriceClass_100 for {dist_id} in {self.environment} environment")
+            dist_ids = [dist['Id'] for dist in distributions]
+            configs = self._map('cloudfront', self._get_distribution_config, dist_ids)
+            policies = self._get_cloudfront_policies(configs)
+            metrics = self._get_cloudfront_metrics(dist_ids)
+            
+            for dist_id, config in zip(dist_ids, configs):
+                logger.info(f"Analyzing CloudFront distribution: {dist_id}")
+                
+                # Check price class
+                price_class = config['PriceClass']
+                if price_class == 'PriceClass_All' and self.environment != 'prod':
+                    results['actions'].append(f"Consider using PriceClass_100 for {dist_id} in {self.environment} environment")
+                
+                behaviors = [dict(config['DefaultCacheBehavior'], PathPattern='*')]
+                behaviors.extend(config.get('CacheBehaviors', {}).get('Items', []))
+                
+                for behavior in behaviors:
+                    path_pattern = behavior['PathPattern']
                     
                     # Check compression
-                    default_behavior = dist['DefaultCacheBehavior']
-                    if not default_behavior.get('Compress', False):
-                        results['actions'].append(f"Enable compression for distribution {dist_id}")
+                    if not behavior.get('Compress', False):
+                        results['actions'].append(f"Enable compression for distribution {dist_id} behavior {path_pattern}")
                     
-                    # Estimate savings
-                    results['savings'] += 15  # Estimated monthly savings per distribution
+                    # Check cache key fragmentation
+                    finding = self._analyze_cache_behavior(dist_id, behavior, len(behaviors), policies, metrics.get(dist_id, {}))
+                    if finding:
+                        results['cache_findings'].append(finding)
+                        results['actions'].append(
+                            f"Reduce cache key fragmentation for {dist_id} behavior {path_pattern}: {'; '.join(finding['issues'])}"
+                        )
+                
+                # Estimate savings
+                results['savings'] += 15  # Estimated monthly savings per distribution
                     
         except Exception as e:
             logger.error(f"Error optimizing CloudFront: {e}")
         
         return results
     
+    def _get_distribution_config(self, dist_id: str) -> Dict[str, Any]:
+        """Fetch the full configuration of a distribution, including every cache behavior"""
+        return self.cloudfront_client.get_distribution_config(Id=dist_id)['DistributionConfig']
+    
+    def _get_cloudfront_policies(self, configs: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Fetch each referenced cache policy once, concurrently
+        
+        Origin request policies only choose what is forwarded to the origin,
+        not what goes into the cache key, so they are not needed.
+        """
+        policy_ids = set()
+        for config in configs:
+            behaviors = [config['DefaultCacheBehavior']] + config.get('CacheBehaviors', {}).get('Items', [])
+            for behavior in behaviors:
+                if behavior.get('CachePolicyId'):
+                    policy_ids.add(behavior['CachePolicyId'])
+        
+        def fetch(policy_id):
+            try:
+                return self.cloudfront_client.get_cache_policy(Id=policy_id)['CachePolicy']['CachePolicyConfig']
+            except Exception as e:
+                logger.warning(f"Could not fetch CloudFront cache policy {policy_id}: {e}")
+                return None
+        
+        ids = sorted(policy_ids)
+        return {policy_id: policy for policy_id, policy in zip(ids, self._map('cloudfront', fetch, ids)) if policy}
+    
+    def _get_cloudfront_metrics(self, dist_ids: List[str], days: int = 7) -> Dict[str, Dict[str, float]]:
+        """Fetch traffic and cache metrics for all distributions in batched get_metric_data calls
+        
+        CacheHitRate is only published for distributions with additional
+        metrics enabled, so it may be missing from the result.
+        """
+        metric_stats = [
+            ('Requests', 'Sum'),
+            ('BytesDownloaded', 'Sum'),
+            ('CacheHitRate', 'Average'),
+            ('4xxErrorRate', 'Average'),
+            ('5xxErrorRate', 'Average')
+        ]
+        
+        queries = []
+        query_keys = {}
+        for i, dist_id in enumerate(dist_ids):
+            for j, (metric_name, stat) in enumerate(metric_stats):
+                query_id = f"d{i}m{j}"
+                query_keys[query_id] = (dist_id, metric_name)
+                queries.append({
+                    'Id': query_id,
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': 'AWS/CloudFront',
+                            'MetricName': metric_name,
+                            'Dimensions': [
+                                {'Name': 'DistributionId', 'Value': dist_id},
+                                {'Name': 'Region', 'Value': 'Global'}
+                            ]
+                        },
+                        'Period': days * 86400,
+                        'Stat': stat
+                    }
+                })
+        
+        end_time = datetime.datetime.utcnow()
+        start_time = end_time - datetime.timedelta(days=days)
+        metrics: Dict[str, Dict[str, float]] = {}
+        
+        # get_metric_data accepts at most 500 queries per call
+        for start in range(0, len(queries), 500):
+            request = {
+                'MetricDataQueries': queries[start:start + 500],
+                'StartTime': start_time,
+                'EndTime': end_time
+            }
+            try:
+                while True:
+                    response = self.cloudwatch_client.get_metric_data(**request)
+                    for result in response['MetricDataResults']:
+                        if result['Values']:
+                            dist_id, metric_name = query_keys[result['Id']]
+                            metrics.setdefault(dist_id, {})[metric_name] = result['Values'][0]
+                    if not response.get('NextToken'):
+                        break
+                    request['NextToken'] = response['NextToken']
+            except Exception as e:
+                logger.warning(f"Could not fetch CloudFront metrics: {e}")
+        
+        return metrics
+    
+    def _cache_key_profile(self, behavior: Dict[str, Any], policies: Dict[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Normalize a behavior's cache key and TTLs from its cache policy or legacy ForwardedValues"""
+        if behavior.get('CachePolicyId'):
+            policy = policies.get(behavior['CachePolicyId'])
+            if not policy:
+                return None
+            params = policy.get('ParametersInCacheKeyAndForwardedToOrigin', {})
+            headers = params.get('HeadersConfig', {})
+            cookies = params.get('CookiesConfig', {})
+            query_strings = params.get('QueryStringsConfig', {})
+            return {
+                'headers': headers.get('Headers', {}).get('Items', []) if headers.get('HeaderBehavior') == 'whitelist' else [],
+                'cookies': cookies.get('CookieBehavior', 'none'),
+                'cookie_names': cookies.get('Cookies', {}).get('Items', []),
+                'query_strings': query_strings.get('QueryStringBehavior', 'none'),
+                'query_string_names': query_strings.get('QueryStrings', {}).get('Items', []),
+                'default_ttl': policy.get('DefaultTTL', 0),
+                'max_ttl': policy.get('MaxTTL', 0)
+            }
+        
+        forwarded = behavior.get('ForwardedValues', {})
+        cookies = forwarded.get('Cookies', {})
+        query_string_keys = forwarded.get('QueryStringCacheKeys', {}).get('Items', [])
+        if not forwarded.get('QueryString'):
+            query_strings = 'none'
+        else:
+            query_strings = 'whitelist' if query_string_keys else 'all'
+        return {
+            'headers': forwarded.get('Headers', {}).get('Items', []),
+            'cookies': cookies.get('Forward', 'none'),
+            'cookie_names': cookies.get('WhitelistedNames', {}).get('Items', []),
+            'query_strings': query_strings,
+            'query_string_names': query_string_keys,
+            'default_ttl': behavior.get('DefaultTTL', 0),
+            'max_ttl': behavior.get('MaxTTL', 0)
+        }
+    
+    def _analyze_cache_behavior(self, dist_id: str, behavior: Dict[str, Any], behavior_count: int,
+                                policies: Dict[str, Dict[str, Any]], metrics: Dict[str, float]) -> Optional[Dict[str, Any]]:
+        """Flag cache key settings that fragment the cache and estimate the origin offload from fixing them
+        
+        Each issue carries the share of current cache misses it is assumed to
+        cause. The distribution's misses are split evenly across its
+        behaviors, because CloudFront only reports metrics per distribution.
+        """
+        profile = self._cache_key_profile(behavior, policies)
+        if not profile:
+            return None
+        
+        issues = []
+        miss_shares = []
+        
+        if profile['default_ttl'] == 0 and profile['max_ttl'] == 0:
+            issues.append("caching is disabled (TTL 0)")
+            miss_shares.append(1.0)
+        
+        headers = [h.lower() for h in profile['headers']]
+        if '*' in headers:
+            issues.append("all viewer headers are forwarded, which disables caching")
+            miss_shares.append(1.0)
+        else:
+            high_cardinality = [h for h in headers if h in HIGH_CARDINALITY_HEADERS]
+            if high_cardinality:
+                issues.append(f"high-cardinality headers in cache key: {', '.join(high_cardinality)}")
+                miss_shares.append(0.8)
+            other_headers = [h for h in headers if h not in HIGH_CARDINALITY_HEADERS]
+            if other_headers:
+                issues.append(f"headers in cache key: {', '.join(other_headers)}")
+                miss_shares.append(min(0.1 * len(other_headers), 0.5))
+        
+        if profile['cookies'] in ('all', 'allExcept'):
+            issues.append("all cookies are in the cache key")
+            miss_shares.append(0.9)
+        elif profile['cookies'] == 'whitelist' and profile['cookie_names']:
+            issues.append(f"cookies in cache key: {', '.join(profile['cookie_names'])}")
+            miss_shares.append(0.3)
+        
+        if profile['query_strings'] in ('all', 'allExcept'):
+            issues.append("all query strings are in the cache key")
+            miss_shares.append(0.5)
+        elif profile['query_strings'] == 'whitelist' and len(profile['query_string_names']) > 3:
+            issues.append(f"{len(profile['query_string_names'])} query strings in cache key")
+            miss_shares.append(0.15)
+        
+        if not issues:
+            return None
+        
+        # Issues overlap, so combine them as independent causes of a miss
+        remaining = 1.0
+        for share in miss_shares:
+            remaining *= 1 - share
+        recoverable_share = 1 - remaining
+        
+        finding = {
+            'distribution_id': dist_id,
+            'path_pattern': behavior['PathPattern'],
+            'cache_policy_id': behavior.get('CachePolicyId'),
+            'origin_request_policy_id': behavior.get('OriginRequestPolicyId'),
+            'issues': issues,
+            'metrics': metrics,
+            'expected_origin_offload': None
+        }
+        
+        hit_rate = metrics.get('CacheHitRate')
+        if hit_rate is not None:
+            miss_rate = (100 - hit_rate) / 100
+            gain = miss_rate * recoverable_share / behavior_count
+            finding['expected_origin_offload'] = {
+                'hit_rate_gain_pct': round(gain * 100, 2),
+                'origin_requests_saved': int(metrics.get('Requests', 0) * gain),
+                'origin_bytes_saved': int(metrics.get('BytesDownloaded', 0) * gain)
+            }
+        
+        return finding
+    
     def create_cost_budget(self, monthly_limit: float) -> Dict[str, Any]:
         """Create cost budget and alerts"""
         results = {'actions': [], 'savings': 0}
         
         try:
-            budgets_client = boto3.client('budgets')
+            budgets_client = self._client('budgets')
             
             budget_name = f"medeez-{self.environment}-monthly-budget"
             
@@ -332,7 +836,7 @@ class CostOptimizer:
             
             if not self.dry_run:
                 budgets_client.create_budget(
-                    AccountId=boto3.client('sts').get_caller_identity()['Account'],
+                    AccountId=self.session.client('sts').get_caller_identity()['Account'],
                     Budget=budget,
                     NotificationsWithSubscribers=notifications
                 )
@@ -345,8 +849,22 @@ class CostOptimizer:
         
         return results
     
-    def run_optimization(self) -> Dict[str, Any]:
-        """Run all cost optimization tasks"""
+    def _stream_result(self, stream: report_stream.NdjsonWriter, name: str,
+                       result: Dict[str, Any]) -> Dict[str, Any]:
+        """Write an optimizer's actions to the stream and return its result
+        with the action list replaced by a count"""
+        for action in result['actions']:
+            stream.write('action', optimization=name, message=action)
+        result = {**result, 'actions': len(result['actions'])}
+        stream.write('optimization', optimization=name, **result)
+        return result
+    
+    def run_optimization(self, stream: Optional[report_stream.NdjsonWriter] = None) -> Dict[str, Any]:
+        """Run all cost optimization tasks
+        
+        With a stream, each optimizer's actions are written out as soon as it
+        finishes and the results only keep per-optimizer counts and savings.
+        """
         logger.info(f"Starting cost optimization for environment: {self.environment}")
         logger.info(f"Dry run mode: {self.dry_run}")
         
@@ -366,25 +884,42 @@ class CostOptimizer:
             ('Lambda Functions', self.optimize_lambda_functions),
             ('CloudFront', self.optimize_cloudfront)
         ]
+        if not self.scan_global:
+            optimizations = [(name, func) for name, func in optimizations if name not in GLOBAL_OPTIMIZATIONS]
         
-        for name, optimization_func in optimizations:
-            logger.info(f"Running {name} optimization...")
-            try:
+        def run_scoped(name: str, optimization_func: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+            with aws_profiler.scope(name):
                 result = optimization_func()
+            return self._stream_result(stream, name, result) if stream else result
+        
+        # Services are independent, so run them side by side and collect the
+        # results in the order above once they have all finished
+        with ThreadPoolExecutor(max_workers=len(optimizations)) as executor:
+            futures = []
+            for name, optimization_func in optimizations:
+                logger.info(f"Running {name} optimization...")
+                futures.append((name, executor.submit(run_scoped, name, optimization_func)))
+        
+        for name, future in futures:
+            try:
+                result = future.result()
                 optimization_results['optimizations'][name] = result
                 optimization_results['total_estimated_savings'] += result['savings']
                 
-                if result['actions']:
+                action_count = result['actions'] if stream else len(result['actions'])
+                if action_count:
                     optimization_results['summary'].append(
-                        f"{name}: {len(result['actions'])} actions, ${result['savings']}/month estimated savings"
+                        f"{name}: {action_count} actions, ${result['savings']}/month estimated savings"
                     )
             except Exception as e:
                 logger.error(f"Error in {name} optimization: {e}")
                 optimization_results['optimizations'][name] = {
                     'error': str(e),
-                    'actions': [],
+                    'actions': 0 if stream else [],
                     'savings': 0
                 }
+                if stream:
+                    stream.write('optimization', optimization=name, **optimization_results['optimizations'][name])
         
         # Create cost budget
         if self.environment == 'prod':
@@ -394,13 +929,67 @@ class CostOptimizer:
         else:
             monthly_limit = 200
         
-        budget_result = self.create_cost_budget(monthly_limit)
-        optimization_results['optimizations']['Cost Budget'] = budget_result
+        if self.scan_global:
+            budget_result = self.create_cost_budget(monthly_limit)
+            if stream:
+                budget_result = self._stream_result(stream, 'Cost Budget', budget_result)
+            optimization_results['optimizations']['Cost Budget'] = budget_result
+        
+        # A clean run has converged; an interrupted or failed one keeps its journal for the next run
+        if not self.dry_run and self.apply_failures == 0:
+            self.journal.clear()
         
         logger.info(f"Optimization complete. Total estimated savings: ${optimization_results['total_estimated_savings']}/month")
         
         return optimization_results
 
+def optimize_target(environment: str, dry_run: bool, journal_path: Optional[str], tags: Optional[Dict[str, str]],
+                    session: boto3.Session, target: aws_fanout.Target) -> Dict[str, Any]:
+    """Optimization results for one account and region; runs in a fan-out worker"""
+    if journal_path:
+        journal_path = f"{journal_path}.{target.account}.{target.region}"
+    optimizer = CostOptimizer(environment, dry_run=dry_run, journal_path=journal_path,
+                              session=session, scan_global=target.primary, tags=tags)
+    return optimizer.run_optimization()
+
+def merge_results(environment: str, dry_run: bool,
+                  results: Iterable[Tuple[aws_fanout.Target, Dict[str, Any]]]) -> Dict[str, Any]:
+    """Combine per-account, per-region results into one result of the same shape.
+    
+    Actions are prefixed with the account and region they apply to and
+    savings are added up per optimization.
+    """
+    merged = {
+        'environment': environment,
+        'dry_run': dry_run,
+        'timestamp': datetime.datetime.now().isoformat(),
+        'optimizations': {},
+        'total_estimated_savings': 0,
+        'summary': [],
+        'targets': {}
+    }
+    
+    for target, result in sorted(results, key=lambda item: item[0].label):
+        if 'error' in result:
+            merged['targets'][target.label] = {'error': result['error']}
+            continue
+        merged['targets'][target.label] = {'total_estimated_savings': result['total_estimated_savings']}
+        merged['total_estimated_savings'] += result['total_estimated_savings']
+        
+        for name, optimization in result['optimizations'].items():
+            combined = merged['optimizations'].setdefault(name, {'actions': [], 'savings': 0})
+            combined['actions'].extend(f"[{target.label}] {action}" for action in optimization['actions'])
+            combined['savings'] += optimization['savings']
+            if 'error' in optimization:
+                combined.setdefault('errors', []).append(f"{target.label}: {optimization['error']}")
+    
+    for name, optimization in merged['optimizations'].items():
+        if optimization['actions'] and name != 'Cost Budget':
+            merged['summary'].append(
+                f"{name}: {len(optimization['actions'])} actions, ${optimization['savings']}/month estimated savings"
+            )
+    return merged
+
 def main():
     parser = argparse.ArgumentParser(description='AWS Cost Optimization for Medeez')
     parser.add_argument('--environment', required=True, choices=['dev', 'staging', 'prod'],
@@ -408,21 +997,56 @@ def main():
     parser.add_argument('--execute', action='store_true',
                        help='Execute optimizations (default is dry run)')
     parser.add_argument('--output', help='Output file for results')
+    parser.add_argument('--journal',
+                       help='Journal file used to resume an interrupted --execute run '
+                            '(default: cost-optimization-<environment>.journal)')
+    aws_cassette.add_arguments(parser)
+    aws_profiler.add_arguments(parser)
+    report_stream.add_arguments(parser)
+    aws_fanout.add_arguments(parser)
+    aws_discovery.add_arguments(parser)
     
     args = parser.parse_args()
+    if args.replay and args.execute:
+        parser.error('--replay cannot be combined with --execute')
+    aws_fanout.check_arguments(parser, args)
+    try:
+        tags = aws_discovery.parse_tags(args.tag)
+    except ValueError as e:
+        parser.error(f"--tag: {e}")
     
-    optimizer = CostOptimizer(args.environment, dry_run=not args.execute)
-    results = optimizer.run_optimization()
+    journal_path = args.journal or f"cost-optimization-{args.environment}.journal"
+    if aws_fanout.enabled(args):
+        targets = aws_fanout.build_targets(args.accounts, args.regions)
+        scan = functools.partial(optimize_target, args.environment, not args.execute, journal_path, tags)
+        results = merge_results(args.environment, not args.execute,
+                                aws_fanout.fan_out(scan, targets, max_workers=args.max_workers, rate=args.rate_limit))
+    else:
+        if args.rate_limit:
+            aws_fanout.RateLimiter(args.rate_limit).install(aws_fanout.default_session())
+        
+        profiler = aws_profiler.from_args(args)
+        with aws_cassette.from_args(args), report_stream.from_args(args) as stream:
+            optimizer = CostOptimizer(args.environment, dry_run=not args.execute, journal_path=journal_path, tags=tags)
+            results = optimizer.run_optimization(stream)
+            
+            if profiler:
+                if args.profile:
+                    results['profile'] = profiler.report()
+                if args.profile_trace:
+                    profiler.write_trace(args.profile_trace)
+            
+            if stream:
+                stream.write('summary', **results)
+                return
     
     # Output results
-    output = json.dumps(results, indent=2)
-    
     if args.output:
         with open(args.output, 'w') as f:
-            f.write(output)
+            json.dump(results, f, indent=2)
         print(f"Results saved to {args.output}")
     else:
-        print(output)
+        print(json.dumps(results, indent=2))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Security group exposure analysis for the Medeez compliance checks
+Loads every ingress permission of a set of security groups, with IPv6
+ranges and prefix lists expanded, keeping the rules open to all of IPv4
+or IPv6 apart so internet exposure is a lookup rather than a scan
+"""
+
+import ipaddress
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, NamedTuple, Set, Tuple, Union
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+# Filter values accepted per describe_network_interfaces filter
+MAX_FILTER_VALUES = 200
+
+# IpProtocol is a name for tcp, udp and icmp but may come back as its number
+PROTOCOL_NAMES = {'6': 'tcp', '17': 'udp', '1': 'icmp', '58': 'icmpv6'}
+
+class Permission(NamedTuple):
+    """One ingress rule of a group for one source"""
+    group_id: str
+    protocol: str  # 'tcp', 'udp', 'icmp', ... or '-1' for all traffic
+    from_port: int
+    to_port: int
+    source: str  # CIDR, prefix list id or security group id
+
+    @property
+    def ports(self) -> str:
+        if self.protocol == '-1':
+            return 'all'
+        if self.from_port == self.to_port:
+            return f"{self.protocol}/{self.from_port}"
+        return f"{self.protocol}/{self.from_port}-{self.to_port}"
+
+    def covers_port(self, port: int, protocol: str = 'tcp') -> bool:
+        if self.protocol == '-1':
+            return True
+        if PROTOCOL_NAMES.get(self.protocol, self.protocol) != protocol:
+            return False
+        return self.from_port <= port <= self.to_port
+
+class ExposureIndex:
+    """Ingress permissions of a set of groups, by group and by what they admit"""
+
+    def __init__(self):
+        self.internet: List[Permission] = []
+        self.group_references: Dict[str, List[Permission]] = defaultdict(list)
+        self.by_group: Dict[str, List[Permission]] = defaultdict(list)
+
+    def add(self, network: Network, permission: Permission):
+        if network.prefixlen == 0:
+            self.internet.append(permission)
+        self.by_group[permission.group_id].append(permission)
+
+    def add_reference(self, permission: Permission):
+        """An ingress rule whose source is another security group"""
+        self.group_references[permission.source].append(permission)
+        self.by_group[permission.group_id].append(permission)
+
+    def sources(self, group_id: str) -> Dict[str, List[str]]:
+        """Ports of a group reachable from each source"""
+        ports = defaultdict(list)
+        for permission in self.by_group.get(group_id, []):
+            if permission.ports not in ports[permission.source]:
+                ports[permission.source].append(permission.ports)
+        return dict(ports)
+
+    def internet_exposure(self) -> Dict[str, List[Permission]]:
+        """Permissions open to all of IPv4 or IPv6, by group"""
+        exposure = defaultdict(list)
+        for permission in self.internet:
+            exposure[permission.group_id].append(permission)
+        return exposure
+
+def _paginate(client, operation: str, **kwargs) -> Iterable[Dict[str, Any]]:
+    return client.get_paginator(operation).paginate(**kwargs)
+
+def load_security_groups(ec2_client, filters: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Security groups matching server-side filters, every page"""
+    return [group
+            for page in _paginate(ec2_client, 'describe_security_groups', Filters=filters)
+            for group in page['SecurityGroups']]
+
+def build_index(ec2_client, groups: List[Dict[str, Any]]) -> ExposureIndex:
+    """Index the ingress rules of groups, expanding each prefix list once"""
+    index = ExposureIndex()
+    prefix_lists: Dict[str, List[str]] = {}
+
+    for group in groups:
+        for rule in group.get('IpPermissions', []):
+            protocol = rule.get('IpProtocol', '-1')
+            from_port = rule.get('FromPort', 0) if protocol != '-1' else 0
+            to_port = rule.get('ToPort', 65535) if protocol != '-1' else 65535
+
+            def permission(source: str) -> Permission:
+                return Permission(group['GroupId'], protocol, from_port, to_port, source)
+
+            for ip_range in rule.get('IpRanges', []):
+                index.add(ipaddress.ip_network(ip_range['CidrIp'], strict=False), permission(ip_range['CidrIp']))
+            for ip_range in rule.get('Ipv6Ranges', []):
+                index.add(ipaddress.ip_network(ip_range['CidrIpv6'], strict=False), permission(ip_range['CidrIpv6']))
+            for prefix_list in rule.get('PrefixListIds', []):
+                list_id = prefix_list['PrefixListId']
+                if list_id not in prefix_lists:
+                    prefix_lists[list_id] = [entry['Cidr'] for page in _paginate(
+                        ec2_client, 'get_managed_prefix_list_entries', PrefixListId=list_id)
+                        for entry in page['Entries']]
+                for cidr in prefix_lists[list_id]:
+                    index.add(ipaddress.ip_network(cidr, strict=False), permission(list_id))
+            for pair in rule.get('UserIdGroupPairs', []):
+                index.add_reference(permission(pair.get('GroupId', '')))
+    return index
+
+def attached_groups(ec2_client, group_ids: List[str]) -> Tuple[Set[str], Set[str]]:
+    """Groups attached to a network interface, and those attached to one with a public address"""
+    attached, public = set(), set()
+    for start in range(0, len(group_ids), MAX_FILTER_VALUES):
+        chunk = group_ids[start:start + MAX_FILTER_VALUES]
+        for page in _paginate(ec2_client, 'describe_network_interfaces',
+                              Filters=[{'Name': 'group-id', 'Values': chunk}]):
+            for interface in page['NetworkInterfaces']:
+                ids = {group['GroupId'] for group in interface.get('Groups', [])}
+                attached |= ids
+                if interface.get('Association', {}).get('PublicIp') or interface.get('Ipv6Addresses'):
+                    public |= ids
+    return attached, public
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Streaming NDJSON output for the Medeez operations scripts
+Writes findings and actions as one JSON record per line while a run is in
+progress, so memory stays flat and consumers can start before it finishes
+"""
+
+import contextlib
+import json
+import sys
+import threading
+from collections import Counter
+from typing import Any, Iterator, Optional
+
+class NdjsonWriter:
+    """Thread-safe writer of one JSON record per line.
+
+    Every record has a `type` field. Lines are flushed as they are written
+    so a consumer tailing the output sees each record immediately.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._file = open(path, 'w', encoding='utf-8') if path else sys.stdout
+
+    def write(self, record_type: str, **fields: Any):
+        line = json.dumps({'type': record_type, **fields}, default=str, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            self.counts[record_type] += 1
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+def add_arguments(parser):
+    """Add the --stream option to a script's argument parser"""
+    parser.add_argument('--stream', action='store_true',
+                       help='Write results as NDJSON records while the run is in progress, '
+                            'ending with a summary record (to --output or stdout)')
+
+@contextlib.contextmanager
+def from_args(args) -> Iterator[Optional[NdjsonWriter]]:
+    """Stream to --output (or stdout) for the duration of a run, if requested"""
+    if not args.stream:
+        yield None
+        return
+    writer = NdjsonWriter(args.output)
+    try:
+        yield writer
+    finally:
+        writer.close()
@@ -7,28 +7,278 @@ Validates security configurations and HIPAA compliance requirements
 import json
 import boto3
 import argparse
+import contextvars
 import datetime
-from typing import Dict, List, Any, Optional
+import functools
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Any, NamedTuple, Optional, Tuple
 import logging
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import aws_cassette
+import aws_discovery
+import aws_fanout
+import aws_profiler
+import network_exposure
+import report_stream
+from compliance_findings import Finding, FindingCounts, FindingIndex, to_json
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Bucket posture settings: the S3 call fetching each one and the error code
+# it fails with when the setting was never configured
+S3_POSTURE_CALLS = {
+    'encryption': ('get_bucket_encryption', 'ServerSideEncryptionConfigurationNotFoundError'),
+    'policy': ('get_bucket_policy', 'NoSuchBucketPolicy'),
+    'public_access_block': ('get_public_access_block', 'NoSuchPublicAccessBlockConfiguration'),
+    'versioning': ('get_bucket_versioning', None),
+    'logging': ('get_bucket_logging', None),
+    'object_lock': ('get_object_lock_configuration', 'ObjectLockConfigurationNotFoundError')
+}
+
+# Posture calls in flight at once across all buckets
+S3_POSTURE_CONCURRENCY = 16
+
+PUBLIC_ACCESS_BLOCK_FLAGS = ('BlockPublicAcls', 'IgnorePublicAcls', 'BlockPublicPolicy', 'RestrictPublicBuckets')
+
+# API Gateway stage and authorizer calls in flight at once across all APIs
+API_GATEWAY_CONCURRENCY = 8
+
+# Window of API Gateway traffic and latency metrics, and the share of a
+# stage's throttling rate limit its peak traffic may reach before the limit
+# counts as too tight
+API_METRICS_HOURS = 24
+THROTTLE_HEADROOM = 0.8
+
+# Cognito describe calls in flight at once, and the rate they are held to;
+# Cognito's control-plane read quotas are low and shared by every caller in
+# the account, so large pool sets would otherwise hit TooManyRequests
+COGNITO_CONCURRENCY = 8
+COGNITO_RATE_LIMIT = 20
+
+# Connect and read timeouts of every AWS call. They bound how long a check
+# abandoned at its deadline can stay blocked in a call before it is cancelled
+CALL_TIMEOUTS = Config(connect_timeout=5, read_timeout=20)
+
+# Exit status of a run whose report is partial because checks timed out
+PARTIAL_REPORT_EXIT_CODE = 3
+
+# Longest acceptable app client token lifetimes, in seconds
+MAX_SESSION_TOKEN_VALIDITY = 3600
+MAX_REFRESH_TOKEN_VALIDITY = 30 * 86400
+
+TOKEN_VALIDITY_UNITS = {'seconds': 1, 'minutes': 60, 'hours': 3600, 'days': 86400}
+
+# Authentication flows that send the password itself rather than an SRP proof
+PASSWORD_AUTH_FLOWS = {'ALLOW_USER_PASSWORD_AUTH', 'USER_PASSWORD_AUTH', 'ADMIN_NO_SRP_AUTH'}
+
+# Administration and data store ports that must never face the internet
+SENSITIVE_PORTS = {
+    22: 'SSH',
+    3389: 'RDP',
+    3306: 'MySQL',
+    5432: 'PostgreSQL',
+    6379: 'Redis',
+    9200: 'OpenSearch',
+    11211: 'Memcached',
+    27017: 'MongoDB'
+}
+
+class BucketPosture(NamedTuple):
+    """Normalized security posture of one bucket; None means not configured"""
+    name: str
+    arn: str
+    encryption: Optional[List[str]]  # SSE algorithm of each default encryption rule
+    policy: Optional[Dict[str, Any]]
+    public_access_block: Optional[Dict[str, bool]]
+    versioning: Optional[str]  # 'Enabled' or 'Suspended'
+    logging_target: Optional[str]
+    object_lock: Optional[str]
+    errors: Dict[str, str]  # settings that could not be read, such as on AccessDenied
+
+def bucket_posture(bucket: aws_discovery.Resource,
+                   responses: Dict[str, Tuple[Optional[Dict[str, Any]], Optional[str]]]) -> BucketPosture:
+    """Normalize a bucket's posture call responses into one record"""
+    encryption, _ = responses['encryption']
+    policy, _ = responses['policy']
+    public_access_block, _ = responses['public_access_block']
+    versioning, _ = responses['versioning']
+    logging_config, _ = responses['logging']
+    object_lock, _ = responses['object_lock']
+    
+    return BucketPosture(
+        name=bucket.name,
+        arn=bucket.arn,
+        encryption=None if encryption is None else [
+            rule.get('ApplyServerSideEncryptionByDefault', {}).get('SSEAlgorithm')
+            for rule in encryption.get('ServerSideEncryptionConfiguration', {}).get('Rules', [])
+        ],
+        policy=json.loads(policy['Policy']) if policy else None,
+        public_access_block=public_access_block.get('PublicAccessBlockConfiguration') if public_access_block else None,
+        versioning=(versioning or {}).get('Status'),
+        logging_target=(logging_config or {}).get('LoggingEnabled', {}).get('TargetBucket'),
+        object_lock=(object_lock or {}).get('ObjectLockConfiguration', {}).get('ObjectLockEnabled'),
+        errors={setting: error for setting, (_, error) in responses.items() if error}
+    )
+
+class ApiStage(NamedTuple):
+    """Normalized settings of one REST or HTTP API stage"""
+    api_type: str  # 'rest' or 'http'
+    api_id: str
+    api_name: str
+    name: str
+    arn: str
+    access_logging: bool
+    tracing: Optional[bool]  # None for HTTP APIs, which have no X-Ray tracing
+    data_trace: bool
+    rate_limit: Optional[float]
+    burst_limit: Optional[int]
+
+def rest_api_stage(region: str, api: Dict[str, Any], stage: Dict[str, Any]) -> ApiStage:
+    # '*/*' holds the stage-wide defaults of the method settings
+    method_settings = stage.get('methodSettings', {})
+    defaults = method_settings.get('*/*', {})
+    return ApiStage(
+        api_type='rest',
+        api_id=api['id'],
+        api_name=api['name'],
+        name=stage['stageName'],
+        arn=f"arn:aws:apigateway:{region}::/restapis/{api['id']}/stages/{stage['stageName']}",
+        access_logging=bool(stage.get('accessLogSettings')),
+        tracing=bool(stage.get('tracingEnabled')),
+        data_trace=any(settings.get('dataTraceEnabled') for settings in method_settings.values()),
+        rate_limit=defaults.get('throttlingRateLimit'),
+        burst_limit=defaults.get('throttlingBurstLimit')
+    )
+
+def http_api_stage(region: str, api: Dict[str, Any], stage: Dict[str, Any]) -> ApiStage:
+    defaults = stage.get('DefaultRouteSettings', {})
+    return ApiStage(
+        api_type='http',
+        api_id=api['ApiId'],
+        api_name=api['Name'],
+        name=stage['StageName'],
+        arn=f"arn:aws:apigateway:{region}::/apis/{api['ApiId']}/stages/{stage['StageName']}",
+        access_logging=bool(stage.get('AccessLogSettings')),
+        tracing=None,
+        data_trace=any(settings.get('DataTraceEnabled')
+                       for settings in [defaults, *stage.get('RouteSettings', {}).values()]),
+        rate_limit=defaults.get('ThrottlingRateLimit'),
+        burst_limit=defaults.get('ThrottlingBurstLimit')
+    )
+
+def token_validity(client: Dict[str, Any], token: str, default_unit: str, default: int) -> int:
+    """Lifetime in seconds of an app client's AccessToken, IdToken or RefreshToken"""
+    unit = client.get('TokenValidityUnits', {}).get(token, default_unit)
+    return client.get(f"{token}Validity", default) * TOKEN_VALIDITY_UNITS[unit]
+
+class PoolDescriptionCache:
+    """describe_user_pool results kept between runs in a JSON file.
+    
+    An entry is reused while the pool's LastModifiedDate from
+    list_user_pools matches the one it was described at.
+    """
+    
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self.hits = 0
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+    
+    def get(self, pool: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(pool['Id'])
+        if entry and entry['last_modified'] == str(pool.get('LastModifiedDate')):
+            self.hits += 1
+            return entry['description']
+        return None
+    
+    def put(self, pool: Dict[str, Any], description: Dict[str, Any]):
+        with self._lock:
+            # round-tripped through JSON so cached and fresh entries look alike
+            self._entries[pool['Id']] = json.loads(json.dumps({
+                'last_modified': str(pool.get('LastModifiedDate')),
+                'description': description
+            }, default=str))
+    
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(temp_path, self.path)
+
+class CheckTimeout(BaseException):
+    """Raised from the AWS calls of a check that has run past its deadline.
+    
+    Like asyncio.CancelledError it is not an Exception, so the per-resource
+    `except Exception` handlers inside checks do not swallow it.
+    """
+
+# Deadline (time.monotonic()) of the check running in this context; copied
+# into the threads a check submits work to, like the profiler scope
+_check_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('check_deadline', default=None)
+
+def _enforce_deadline(**kwargs):
+    """before-call and before-send hook cancelling a timed-out check at its
+    next call or retry, including calls a cassette or benchmark answers"""
+    deadline = _check_deadline.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise CheckTimeout()
+
 class SecurityComplianceChecker:
-    def __init__(self, environment: str):
+    def __init__(self, environment: str, session: Optional[boto3.Session] = None, scan_global: bool = True,
+                 tags: Optional[Dict[str, str]] = None, cognito_cache: Optional[str] = None):
         self.environment = environment
-        self.region = boto3.Session().region_name or 'us-east-1'
+        self.session = session or aws_fanout.default_session()
+        self.region = self.session.region_name or 'us-east-1'
+        # Global services (IAM) are checked once per account, not per region
+        self.scan_global = scan_global
+        # Registered before the clients are created so they all inherit it, and
+        # ahead of any before-call hook that answers calls without sending them
+        self.session.events.register_first('before-call', _enforce_deadline, unique_id='compliance-check-deadline-call')
+        self.session.events.register('before-send', _enforce_deadline, unique_id='compliance-check-deadline-send')
+        self.discovery = aws_discovery.ResourceDiscovery(self.session, tags or aws_discovery.default_tags(environment))
         
         # Initialize AWS clients
-        self.iam_client = boto3.client('iam')
-        self.s3_client = boto3.client('s3')
-        self.dynamodb_client = boto3.client('dynamodb')
-        self.kms_client = boto3.client('kms')
-        self.cloudtrail_client = boto3.client('cloudtrail')
-        self.config_client = boto3.client('config')
-        self.lambda_client = boto3.client('lambda')
-        self.apigateway_client = boto3.client('apigateway')
-        self.cognito_client = boto3.client('cognito-idp')
+        self.iam_client = self.session.client('iam', config=CALL_TIMEOUTS)
+        self.s3_client = self.session.client('s3', config=CALL_TIMEOUTS.merge(Config(
+            max_pool_connections=S3_POSTURE_CONCURRENCY,
+            retries={'mode': 'adaptive', 'max_attempts': 10}
+        )))
+        self.dynamodb_client = self.session.client('dynamodb', config=CALL_TIMEOUTS)
+        self.kms_client = self.session.client('kms', config=CALL_TIMEOUTS)
+        self.cloudtrail_client = self.session.client('cloudtrail', config=CALL_TIMEOUTS)
+        self.config_client = self.session.client('config', config=CALL_TIMEOUTS)
+        self.lambda_client = self.session.client('lambda', config=CALL_TIMEOUTS)
+        self.apigateway_client = self.session.client('apigateway', config=CALL_TIMEOUTS.merge(Config(
+            max_pool_connections=API_GATEWAY_CONCURRENCY
+        )))
+        self.apigatewayv2_client = self.session.client('apigatewayv2', config=CALL_TIMEOUTS.merge(Config(
+            max_pool_connections=API_GATEWAY_CONCURRENCY
+        )))
+        self.cloudwatch_client = self.session.client('cloudwatch', config=CALL_TIMEOUTS)
+        self.cognito_client = self.session.client('cognito-idp', config=CALL_TIMEOUTS.merge(Config(
+            max_pool_connections=COGNITO_CONCURRENCY,
+            retries={'mode': 'adaptive', 'max_attempts': 10}
+        )))
+        aws_fanout.RateLimiter(COGNITO_RATE_LIMIT).install_client(self.cognito_client)
+        self.pool_cache = PoolDescriptionCache(cognito_cache)
+        
+        # Findings and recommendations of the last report, deduplicated and
+        # indexed by rule and by resource
+        self.findings = FindingIndex()
+        self.recommendations = FindingIndex()
         
     def check_encryption_at_rest(self) -> Dict[str, Any]:
         """Check encryption at rest for all resources"""
@@ -50,88 +300,117 @@ class SecurityComplianceChecker:
         return results
     
     def _check_s3_encryption(self) -> Dict[str, Any]:
-        """Check S3 bucket encryption settings"""
+        """Check S3 bucket encryption, SSL enforcement and data protection settings"""
         findings = []
         recommendations = []
         
         try:
-            buckets = self.s3_client.list_buckets()['Buckets']
-            env_buckets = [b for b in buckets if self.environment in b['Name']]
-            
-            for bucket in env_buckets:
-                bucket_name = bucket['Name']
-                
-                try:
-                    # Check server-side encryption
-                    encryption = self.s3_client.get_bucket_encryption(Bucket=bucket_name)
-                    
-                    rules = encryption.get('ServerSideEncryptionConfiguration', {}).get('Rules', [])
-                    if not rules:
-                        findings.append(f"S3 bucket {bucket_name} does not have encryption enabled")
-                        recommendations.append(f"Enable server-side encryption for {bucket_name}")
-                    else:
-                        for rule in rules:
-                            sse_algorithm = rule.get('ApplyServerSideEncryptionByDefault', {}).get('SSEAlgorithm')
-                            if sse_algorithm not in ['AES256', 'aws:kms']:
-                                findings.append(f"S3 bucket {bucket_name} uses weak encryption algorithm: {sse_algorithm}")
-                    
-                except self.s3_client.exceptions.ClientError as e:
-                    if e.response['Error']['Code'] == 'ServerSideEncryptionConfigurationNotFoundError':
-                        findings.append(f"S3 bucket {bucket_name} does not have encryption configured")
-                        recommendations.append(f"Configure server-side encryption for {bucket_name}")
-                
-                # Check bucket policy for SSL enforcement
-                try:
-                    policy = self.s3_client.get_bucket_policy(Bucket=bucket_name)
-                    policy_doc = json.loads(policy['Policy'])
-                    
-                    ssl_enforced = False
-                    for statement in policy_doc.get('Statement', []):
-                        if (statement.get('Effect') == 'Deny' and 
-                            'aws:SecureTransport' in statement.get('Condition', {}).get('Bool', {})):
-                            ssl_enforced = True
-                            break
-                    
-                    if not ssl_enforced:
-                        findings.append(f"S3 bucket {bucket_name} does not enforce SSL/TLS")
-                        recommendations.append(f"Add bucket policy to enforce SSL/TLS for {bucket_name}")
-                        
-                except self.s3_client.exceptions.ClientError:
-                    recommendations.append(f"Configure bucket policy to enforce SSL/TLS for {bucket_name}")
+            for posture in self._collect_bucket_posture(self.discovery.resources('s3')):
+                self._evaluate_bucket_posture(posture, findings, recommendations)
                 
         except Exception as e:
-            findings.append(f"Error checking S3 encryption: {str(e)}")
+            findings.append(Finding('check.error', name='S3 encryption', detail=str(e)))
         
         return {'s3_findings': findings, 's3_recommendations': recommendations}
     
+    def _fetch_bucket_setting(self, bucket_name: str, setting: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """Fetch one posture setting of a bucket as (response, error); both are
+        None when the setting was never configured"""
+        method, not_configured = S3_POSTURE_CALLS[setting]
+        try:
+            return getattr(self.s3_client, method)(Bucket=bucket_name), None
+        except ClientError as e:
+            if e.response['Error']['Code'] == not_configured:
+                return None, None
+            return None, str(e)
+    
+    def _collect_bucket_posture(self, buckets: List[aws_discovery.Resource]) -> List[BucketPosture]:
+        """Fetch every posture setting of every bucket concurrently.
+        
+        Discovery only returns buckets in the session's region, so the
+        regional S3 client reaches each bucket without a redirect.
+        """
+        calls = [(bucket.name, setting) for bucket in buckets for setting in S3_POSTURE_CALLS]
+        with ThreadPoolExecutor(max_workers=S3_POSTURE_CONCURRENCY) as executor:
+            # copied contexts keep the profiler scope of the check
+            futures = [executor.submit(contextvars.copy_context().run, self._fetch_bucket_setting, *call) for call in calls]
+            responses = iter([future.result() for future in futures])
+        
+        return [bucket_posture(bucket, {setting: next(responses) for setting in S3_POSTURE_CALLS})
+                for bucket in buckets]
+    
+    def _evaluate_bucket_posture(self, posture: BucketPosture, findings: List[Finding],
+                                 recommendations: List[Finding]):
+        """Apply the S3 rules to a bucket's posture record"""
+        arn, name = posture.arn, posture.name
+        
+        for setting, error in posture.errors.items():
+            findings.append(Finding('check.error', arn, f"{setting} of S3 bucket {name}", error))
+        
+        # Server-side encryption
+        if posture.encryption is None and 'encryption' not in posture.errors:
+            findings.append(Finding('s3.encryption-not-configured', arn, name))
+            recommendations.append(Finding('s3.configure-encryption', arn, name))
+        elif posture.encryption == []:
+            findings.append(Finding('s3.encryption-disabled', arn, name))
+            recommendations.append(Finding('s3.enable-encryption', arn, name))
+        else:
+            for sse_algorithm in posture.encryption or []:
+                if sse_algorithm not in ['AES256', 'aws:kms']:
+                    findings.append(Finding('s3.weak-encryption', arn, name, sse_algorithm))
+        
+        # Bucket policy for SSL enforcement
+        if posture.policy is None:
+            recommendations.append(Finding('s3.configure-ssl-policy', arn, name))
+        elif not any(statement.get('Effect') == 'Deny' and
+                     'aws:SecureTransport' in statement.get('Condition', {}).get('Bool', {})
+                     for statement in posture.policy.get('Statement', [])):
+            findings.append(Finding('s3.ssl-not-enforced', arn, name))
+            recommendations.append(Finding('s3.enforce-ssl', arn, name))
+        
+        # Public access block
+        if 'public_access_block' not in posture.errors and not all((posture.public_access_block or {}).get(flag)
+                                                                   for flag in PUBLIC_ACCESS_BLOCK_FLAGS):
+            findings.append(Finding('s3.public-access-not-blocked', arn, name))
+            recommendations.append(Finding('s3.block-public-access', arn, name))
+        
+        # Versioning, server access logging and object lock
+        if posture.versioning != 'Enabled' and 'versioning' not in posture.errors:
+            findings.append(Finding('s3.versioning-disabled', arn, name))
+            recommendations.append(Finding('s3.enable-versioning', arn, name))
+        if posture.logging_target is None and 'logging' not in posture.errors:
+            findings.append(Finding('s3.access-logging-disabled', arn, name))
+            recommendations.append(Finding('s3.enable-access-logging', arn, name))
+        if posture.object_lock != 'Enabled' and 'object_lock' not in posture.errors:
+            recommendations.append(Finding('s3.consider-object-lock', arn, name))
+    
     def _check_dynamodb_encryption(self) -> Dict[str, Any]:
         """Check DynamoDB encryption settings"""
         findings = []
         recommendations = []
         
         try:
-            tables = self.dynamodb_client.list_tables()['TableNames']
-            env_tables = [t for t in tables if self.environment in t]
-            
-            for table_name in env_tables:
+            for table in self.discovery.resources('dynamodb:table'):
+                table_name = table.name
+                table_arn = table.arn
                 table_desc = self.dynamodb_client.describe_table(TableName=table_name)['Table']
                 
                 # Check encryption at rest
                 sse_desc = table_desc.get('SSEDescription', {})
                 if sse_desc.get('Status') != 'ENABLED':
-                    findings.append(f"DynamoDB table {table_name} does not have encryption at rest enabled")
-                    recommendations.append(f"Enable encryption at rest for {table_name}")
+                    findings.append(Finding('dynamodb.encryption-disabled', table_arn, table_name))
+                    recommendations.append(Finding('dynamodb.enable-encryption', table_arn, table_name))
                 elif sse_desc.get('SSEType') != 'KMS':
-                    findings.append(f"DynamoDB table {table_name} is not using KMS encryption")
-                    recommendations.append(f"Use KMS encryption for {table_name}")
+                    findings.append(Finding('dynamodb.not-kms', table_arn, table_name))
+                    recommendations.append(Finding('dynamodb.use-kms', table_arn, table_name))
                 
                 # Check Point-in-Time Recovery
                 pitr = self.dynamodb_client.describe_continuous_backups(TableName=table_name)
                 if not pitr['ContinuousBackupsDescription']['PointInTimeRecoveryDescription'].get('PointInTimeRecoveryStatus') == 'ENABLED':
-                    recommendations.append(f"Enable Point-in-Time Recovery for {table_name}")
+                    recommendations.append(Finding('dynamodb.enable-pitr', table_arn, table_name))
                 
         except Exception as e:
-            findings.append(f"Error checking DynamoDB encryption: {str(e)}")
+            findings.append(Finding('check.error', name='DynamoDB encryption', detail=str(e)))
         
         return {'dynamodb_findings': findings, 'dynamodb_recommendations': recommendations}
     
@@ -145,14 +424,15 @@ class SecurityComplianceChecker:
             
             for key in keys:
                 key_id = key['KeyId']
+                key_arn = key.get('KeyArn')
                 key_desc = self.kms_client.describe_key(KeyId=key_id)['KeyMetadata']
                 
                 if key_desc.get('Origin') == 'AWS_KMS' and f"medeez-{self.environment}" in key_desc.get('Description', ''):
                     # Check key rotation
                     rotation_status = self.kms_client.get_key_rotation_status(KeyId=key_id)
                     if not rotation_status.get('KeyRotationEnabled'):
-                        findings.append(f"KMS key {key_id} does not have automatic rotation enabled")
-                        recommendations.append(f"Enable automatic rotation for KMS key {key_id}")
+                        findings.append(Finding('kms.rotation-disabled', key_arn, key_id))
+                        recommendations.append(Finding('kms.enable-rotation', key_arn, key_id))
                     
                     # Check key policy
                     key_policy = self.kms_client.get_key_policy(KeyId=key_id, PolicyName='default')
@@ -161,11 +441,11 @@ class SecurityComplianceChecker:
                     # Verify least privilege access
                     for statement in policy_doc.get('Statement', []):
                         if statement.get('Effect') == 'Allow' and statement.get('Principal') == '*':
-                            findings.append(f"KMS key {key_id} has overly permissive policy")
-                            recommendations.append(f"Review and restrict KMS key policy for {key_id}")
+                            findings.append(Finding('kms.permissive-policy', key_arn, key_id))
+                            recommendations.append(Finding('kms.restrict-policy', key_arn, key_id))
                 
         except Exception as e:
-            findings.append(f"Error checking KMS configuration: {str(e)}")
+            findings.append(Finding('check.error', name='KMS configuration', detail=str(e)))
         
         return {'kms_findings': findings, 'kms_recommendations': recommendations}
     
@@ -192,6 +472,8 @@ class SecurityComplianceChecker:
         """Check IAM roles for least privilege"""
         findings = []
         recommendations = []
+        if not self.scan_global:
+            return {'iam_findings': findings, 'iam_recommendations': recommendations}
         
         try:
             roles = self.iam_client.list_roles()['Roles']
@@ -199,13 +481,14 @@ class SecurityComplianceChecker:
             
             for role in env_roles:
                 role_name = role['RoleName']
+                role_arn = role['Arn']
                 
                 # Check for admin access
                 attached_policies = self.iam_client.list_attached_role_policies(RoleName=role_name)
                 for policy in attached_policies['AttachedPolicies']:
                     if 'Admin' in policy['PolicyName'] or policy['PolicyArn'].endswith('AdministratorAccess'):
-                        findings.append(f"IAM role {role_name} has administrative access")
-                        recommendations.append(f"Review and restrict permissions for {role_name}")
+                        findings.append(Finding('iam.admin-access', role_arn, role_name))
+                        recommendations.append(Finding('iam.restrict-permissions', role_arn, role_name))
                 
                 # Check inline policies
                 inline_policies = self.iam_client.list_role_policies(RoleName=role_name)
@@ -216,84 +499,289 @@ class SecurityComplianceChecker:
                     for statement in policy.get('Statement', []):
                         if statement.get('Effect') == 'Allow' and statement.get('Resource') == '*':
                             if any(action == '*' or ':*' in action for action in statement.get('Action', [])):
-                                findings.append(f"IAM role {role_name} has overly broad permissions")
-                                recommendations.append(f"Implement least privilege for {role_name}")
+                                findings.append(Finding('iam.broad-permissions', role_arn, role_name))
+                                recommendations.append(Finding('iam.least-privilege', role_arn, role_name))
                 
         except Exception as e:
-            findings.append(f"Error checking IAM roles: {str(e)}")
+            findings.append(Finding('check.error', name='IAM roles', detail=str(e)))
         
         return {'iam_findings': findings, 'iam_recommendations': recommendations}
     
+    def _describe_user_pool(self, pool: Dict[str, Any]) -> Dict[str, Any]:
+        """Describe a pool unless it is unchanged since it was last cached"""
+        description = self.pool_cache.get(pool)
+        if description is None:
+            description = self.cognito_client.describe_user_pool(UserPoolId=pool['Id'])['UserPool']
+            self.pool_cache.put(pool, description)
+        return description
+    
+    def _list_user_pool_clients(self, pool_id: str) -> List[str]:
+        paginator = self.cognito_client.get_paginator('list_user_pool_clients')
+        return [client['ClientId']
+                for page in paginator.paginate(UserPoolId=pool_id, MaxResults=60)
+                for client in page['UserPoolClients']]
+    
+    def _describe_user_pool_client(self, pool_id: str, client_id: str) -> Dict[str, Any]:
+        return self.cognito_client.describe_user_pool_client(UserPoolId=pool_id, ClientId=client_id)['UserPoolClient']
+    
+    def _evaluate_app_client(self, client: Dict[str, Any], pool_arn: str, findings: List[Finding],
+                             recommendations: List[Finding]):
+        """Check an app client's authentication flows and token lifetimes"""
+        client_arn = f"{pool_arn}/client/{client['ClientId']}"
+        client_name = client.get('ClientName', client['ClientId'])
+        
+        # Check authentication flows
+        password_flows = sorted(PASSWORD_AUTH_FLOWS.intersection(client.get('ExplicitAuthFlows', [])))
+        if password_flows:
+            findings.append(Finding('cognito.password-auth-flow', client_arn, client_name, ', '.join(password_flows)))
+            recommendations.append(Finding('cognito.use-srp-auth', client_arn, client_name))
+        
+        # Check token validity
+        long_lived = [
+            f"{token} {seconds // 60} minutes" for token, seconds in (
+                ('access token', token_validity(client, 'AccessToken', 'hours', 1)),
+                ('ID token', token_validity(client, 'IdToken', 'hours', 1))
+            ) if seconds > MAX_SESSION_TOKEN_VALIDITY
+        ]
+        refresh_seconds = token_validity(client, 'RefreshToken', 'days', 30)
+        if refresh_seconds > MAX_REFRESH_TOKEN_VALIDITY:
+            long_lived.append(f"refresh token {refresh_seconds // 86400} days")
+        if long_lived:
+            findings.append(Finding('cognito.long-token-validity', client_arn, client_name, ', '.join(long_lived)))
+            recommendations.append(Finding('cognito.shorten-token-validity', client_arn, client_name))
+        
+        if not client.get('EnableTokenRevocation', True):
+            recommendations.append(Finding('cognito.enable-token-revocation', client_arn, client_name))
+        if client.get('PreventUserExistenceErrors') != 'ENABLED':
+            recommendations.append(Finding('cognito.prevent-user-existence-errors', client_arn, client_name))
+    
     def _check_cognito_security(self) -> Dict[str, Any]:
-        """Check Cognito security configuration"""
+        """Check Cognito security configuration of user pools and their app clients"""
         findings = []
         recommendations = []
         
         try:
-            user_pools = self.cognito_client.list_user_pools(MaxResults=60)
-            env_pools = [p for p in user_pools['UserPools'] if self.environment in p['Name']]
+            paginator = self.cognito_client.get_paginator('list_user_pools')
+            env_pools = [pool for page in paginator.paginate(MaxResults=60)
+                         for pool in page['UserPools'] if self.environment in pool['Name']]
             
-            for pool in env_pools:
+            with ThreadPoolExecutor(max_workers=COGNITO_CONCURRENCY) as executor:
+                def submit(func, *args):
+                    # copied contexts keep the profiler scope of the check
+                    return executor.submit(contextvars.copy_context().run, func, *args)
+                
+                descriptions = [submit(self._describe_user_pool, pool) for pool in env_pools]
+                client_lists = [submit(self._list_user_pool_clients, pool['Id']) for pool in env_pools]
+                
+                # every app client of every pool is described at once, as
+                # soon as its pool's client list is in
+                clients = []
+                for pool, client_list in zip(env_pools, client_lists):
+                    try:
+                        clients.append([submit(self._describe_user_pool_client, pool['Id'], client_id)
+                                        for client_id in client_list.result()])
+                    except Exception as e:
+                        clients.append(e)
+            
+            for pool, description, pool_clients in zip(env_pools, descriptions, clients):
                 pool_id = pool['Id']
-                pool_desc = self.cognito_client.describe_user_pool(UserPoolId=pool_id)['UserPool']
+                try:
+                    pool_desc = description.result()
+                except Exception as e:
+                    findings.append(Finding('check.error', name=f"user pool {pool_id}", detail=str(e)))
+                    continue
+                pool_arn = pool_desc.get('Arn')
                 
                 # Check password policy
                 password_policy = pool_desc.get('Policies', {}).get('PasswordPolicy', {})
                 if password_policy.get('MinimumLength', 0) < 12:
-                    findings.append(f"Cognito user pool {pool_id} has weak password policy")
-                    recommendations.append(f"Increase minimum password length for {pool_id}")
+                    findings.append(Finding('cognito.weak-password-policy', pool_arn, pool_id))
+                    recommendations.append(Finding('cognito.password-length', pool_arn, pool_id))
                 
                 # Check MFA configuration
                 mfa_config = pool_desc.get('MfaConfiguration', 'OFF')
                 if mfa_config == 'OFF' and self.environment == 'prod':
-                    findings.append(f"Cognito user pool {pool_id} does not have MFA enabled")
-                    recommendations.append(f"Enable MFA for production user pool {pool_id}")
+                    findings.append(Finding('cognito.mfa-disabled', pool_arn, pool_id))
+                    recommendations.append(Finding('cognito.enable-mfa', pool_arn, pool_id))
                 
                 # Check account recovery
                 account_recovery = pool_desc.get('AccountRecoverySetting', {})
                 recovery_mechanisms = account_recovery.get('RecoveryMechanisms', [])
                 if not recovery_mechanisms:
-                    recommendations.append(f"Configure account recovery mechanisms for {pool_id}")
+                    recommendations.append(Finding('cognito.account-recovery', pool_arn, pool_id))
+                
+                # Check app clients
+                if isinstance(pool_clients, Exception):
+                    findings.append(Finding('check.error', name=f"app clients of {pool_id}", detail=str(pool_clients)))
+                    continue
+                for client in pool_clients:
+                    try:
+                        self._evaluate_app_client(client.result(), pool_arn, findings, recommendations)
+                    except Exception as e:
+                        findings.append(Finding('check.error', name=f"app client of {pool_id}", detail=str(e)))
+            
+            self.pool_cache.save()
                 
         except Exception as e:
-            findings.append(f"Error checking Cognito security: {str(e)}")
+            findings.append(Finding('check.error', name='Cognito security', detail=str(e)))
         
         return {'cognito_findings': findings, 'cognito_recommendations': recommendations}
     
+    def _fetch_api(self, api_type: str, api: Dict[str, Any]) -> Tuple[List[ApiStage], int]:
+        """Fetch the stages and the number of authorizers of one REST or HTTP API"""
+        if api_type == 'rest':
+            stages = [rest_api_stage(self.region, api, stage)
+                      for stage in self.apigateway_client.get_stages(restApiId=api['id'])['item']]
+            pages = self.apigateway_client.get_paginator('get_authorizers').paginate(restApiId=api['id'])
+            return stages, sum(len(page['items']) for page in pages)
+        
+        stages = [http_api_stage(self.region, api, stage)
+                  for page in self.apigatewayv2_client.get_paginator('get_stages').paginate(ApiId=api['ApiId'])
+                  for stage in page['Items']]
+        pages = self.apigatewayv2_client.get_paginator('get_authorizers').paginate(ApiId=api['ApiId'])
+        return stages, sum(len(page['Items']) for page in pages)
+    
+    def _get_api_stage_metrics(self, stages: List[ApiStage]) -> Dict[str, Dict[str, float]]:
+        """Fetch latency, peak traffic and client error metrics of all stages in
+        batched get_metric_data calls
+        
+        Peak traffic is the busiest minute's request count per second.
+        """
+        window = API_METRICS_HOURS * 3600
+        metric_stats = {
+            'rest': [('latency_p99_ms', 'Latency', 'p99', window),
+                     ('integration_latency_p99_ms', 'IntegrationLatency', 'p99', window),
+                     ('peak_rps', 'Count', 'Sum', 60),
+                     ('client_errors', '4XXError', 'Sum', window)],
+            'http': [('latency_p99_ms', 'Latency', 'p99', window),
+                     ('integration_latency_p99_ms', 'IntegrationLatency', 'p99', window),
+                     ('peak_rps', 'Count', 'Sum', 60),
+                     ('client_errors', '4xx', 'Sum', window)]
+        }
+        
+        queries = []
+        query_keys = {}
+        for i, stage in enumerate(stages):
+            api_dimension = {'Name': 'ApiName', 'Value': stage.api_name} if stage.api_type == 'rest' \
+                else {'Name': 'ApiId', 'Value': stage.api_id}
+            for j, (key, metric_name, stat, period) in enumerate(metric_stats[stage.api_type]):
+                query_id = f"s{i}m{j}"
+                query_keys[query_id] = (stage.arn, key)
+                queries.append({
+                    'Id': query_id,
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': 'AWS/ApiGateway',
+                            'MetricName': metric_name,
+                            'Dimensions': [api_dimension, {'Name': 'Stage', 'Value': stage.name}]
+                        },
+                        'Period': period,
+                        'Stat': stat
+                    }
+                })
+        
+        end_time = datetime.datetime.utcnow()
+        start_time = end_time - datetime.timedelta(seconds=window)
+        metrics: Dict[str, Dict[str, float]] = {}
+        
+        # get_metric_data accepts at most 500 queries per call; the values of
+        # one query may be split across pages, so the largest one is kept
+        for start in range(0, len(queries), 500):
+            request = {
+                'MetricDataQueries': queries[start:start + 500],
+                'StartTime': start_time,
+                'EndTime': end_time
+            }
+            try:
+                while True:
+                    response = self.cloudwatch_client.get_metric_data(**request)
+                    for result in response['MetricDataResults']:
+                        if result['Values']:
+                            stage_arn, key = query_keys[result['Id']]
+                            stage_metrics = metrics.setdefault(stage_arn, {})
+                            stage_metrics[key] = max(stage_metrics.get(key, 0), max(result['Values']))
+                    if not response.get('NextToken'):
+                        break
+                    request['NextToken'] = response['NextToken']
+            except Exception as e:
+                logger.warning(f"Could not fetch API Gateway metrics: {e}")
+        
+        for stage_metrics in metrics.values():
+            if 'peak_rps' in stage_metrics:
+                stage_metrics['peak_rps'] = round(stage_metrics['peak_rps'] / 60, 2)
+        return metrics
+    
     def _check_api_gateway_security(self) -> Dict[str, Any]:
-        """Check API Gateway security configuration"""
+        """Check API Gateway security configuration of REST and HTTP APIs"""
         findings = []
         recommendations = []
+        stage_metrics = {}
         
         try:
-            apis = self.apigateway_client.get_rest_apis()
-            env_apis = [api for api in apis['items'] if self.environment in api['name']]
+            rest_apis = [api for page in self.apigateway_client.get_paginator('get_rest_apis').paginate()
+                         for api in page['items'] if self.environment in api['name']]
+            http_apis = [api for page in self.apigatewayv2_client.get_paginator('get_apis').paginate()
+                         for api in page['Items']
+                         if api.get('ProtocolType') == 'HTTP' and self.environment in api['Name']]
+            apis = [('rest', api) for api in rest_apis] + [('http', api) for api in http_apis]
             
-            for api in env_apis:
-                api_id = api['id']
+            with ThreadPoolExecutor(max_workers=API_GATEWAY_CONCURRENCY) as executor:
+                # copied contexts keep the profiler scope of the check
+                futures = [executor.submit(contextvars.copy_context().run, self._fetch_api, *api) for api in apis]
+            
+            stages = []
+            for (api_type, api), future in zip(apis, futures):
+                api_name = api['name'] if api_type == 'rest' else api['Name']
+                try:
+                    api_stages, authorizers = future.result()
+                except Exception as e:
+                    findings.append(Finding('check.error', name=f"API {api_name}", detail=str(e)))
+                    continue
+                stages.extend(api_stages)
                 
-                # Check stages
-                stages = self.apigateway_client.get_stages(restApiId=api_id)
-                for stage in stages['item']:
-                    stage_name = stage['stageName']
-                    
-                    # Check logging
-                    if not stage.get('accessLogSettings'):
-                        findings.append(f"API Gateway stage {stage_name} does not have access logging enabled")
-                        recommendations.append(f"Enable access logging for API stage {stage_name}")
-                    
-                    # Check tracing
-                    if not stage.get('tracingEnabled'):
-                        recommendations.append(f"Enable X-Ray tracing for API stage {stage_name}")
-                    
-                    # Check throttling
-                    if not stage.get('throttleSettings'):
-                        recommendations.append(f"Configure throttling for API stage {stage_name}")
+                # Without authorizers every route relies on IAM or is open
+                if not authorizers:
+                    api_id = api['id'] if api_type == 'rest' else api['ApiId']
+                    api_arn = f"arn:aws:apigateway:{self.region}::/{'restapis' if api_type == 'rest' else 'apis'}/{api_id}"
+                    recommendations.append(Finding('apigateway.review-authorization', api_arn, api_name))
+            
+            metrics = self._get_api_stage_metrics(stages)
+            
+            for stage in stages:
+                # Check logging
+                if not stage.access_logging:
+                    findings.append(Finding('apigateway.access-logging-disabled', stage.arn, stage.name))
+                    recommendations.append(Finding('apigateway.enable-access-logging', stage.arn, stage.name))
+                
+                # Full request and response logging would write PHI to CloudWatch
+                if stage.data_trace:
+                    findings.append(Finding('apigateway.data-trace-enabled', stage.arn, stage.name))
+                    recommendations.append(Finding('apigateway.disable-data-trace', stage.arn, stage.name))
+                
+                # Check tracing
+                if stage.tracing is False:
+                    recommendations.append(Finding('apigateway.enable-tracing', stage.arn, stage.name))
+                
+                # Check throttling against observed traffic
+                observed = metrics.get(stage.arn, {})
+                if stage.rate_limit is None:
+                    recommendations.append(Finding('apigateway.configure-throttling', stage.arn, stage.name))
+                elif observed.get('peak_rps', 0) >= THROTTLE_HEADROOM * stage.rate_limit:
+                    detail = f"peak {observed['peak_rps']:g} requests/s against a limit of {stage.rate_limit:g}"
+                    findings.append(Finding('apigateway.throttle-too-tight', stage.arn, stage.name, detail))
+                    recommendations.append(Finding('apigateway.raise-throttle', stage.arn, stage.name))
+                
+                stage_metrics[stage.arn] = {
+                    **observed,
+                    'rate_limit': stage.rate_limit,
+                    'burst_limit': stage.burst_limit
+                }
                 
         except Exception as e:
-            findings.append(f"Error checking API Gateway security: {str(e)}")
+            findings.append(Finding('check.error', name='API Gateway security', detail=str(e)))
         
-        return {'api_gateway_findings': findings, 'api_gateway_recommendations': recommendations}
+        return {'api_gateway_findings': findings, 'api_gateway_recommendations': recommendations,
+                'api_gateway_stages': stage_metrics}
     
     def check_audit_logging(self) -> Dict[str, Any]:
         """Check audit logging and CloudTrail configuration"""
@@ -308,27 +796,28 @@ class SecurityComplianceChecker:
             trails = self.cloudtrail_client.describe_trails()['trailList']
             
             if not trails:
-                results['findings'].append("No CloudTrail trails configured")
-                results['recommendations'].append("Configure CloudTrail for audit logging")
+                results['findings'].append(Finding('cloudtrail.no-trails'))
+                results['recommendations'].append(Finding('cloudtrail.configure'))
                 results['status'] = 'fail'
             else:
                 for trail in trails:
                     trail_name = trail['Name']
+                    trail_arn = trail.get('TrailARN')
                     
                     # Check if trail is logging
                     trail_status = self.cloudtrail_client.get_trail_status(Name=trail_name)
                     if not trail_status.get('IsLogging'):
-                        results['findings'].append(f"CloudTrail {trail_name} is not actively logging")
+                        results['findings'].append(Finding('cloudtrail.not-logging', trail_arn, trail_name))
                     
                     # Check log file validation
                     if not trail.get('LogFileValidationEnabled'):
-                        results['findings'].append(f"CloudTrail {trail_name} does not have log file validation enabled")
-                        results['recommendations'].append(f"Enable log file validation for {trail_name}")
+                        results['findings'].append(Finding('cloudtrail.validation-disabled', trail_arn, trail_name))
+                        results['recommendations'].append(Finding('cloudtrail.enable-validation', trail_arn, trail_name))
                     
                     # Check encryption
                     if not trail.get('KMSKeyId'):
-                        results['findings'].append(f"CloudTrail {trail_name} logs are not encrypted")
-                        results['recommendations'].append(f"Enable encryption for CloudTrail {trail_name}")
+                        results['findings'].append(Finding('cloudtrail.not-encrypted', trail_arn, trail_name))
+                        results['recommendations'].append(Finding('cloudtrail.enable-encryption', trail_arn, trail_name))
             
             # Check Lambda function logging
             functions = self.lambda_client.list_functions()['Functions']
@@ -340,17 +829,17 @@ class SecurityComplianceChecker:
                 # Check if function has proper logging configuration
                 log_group_name = f"/aws/lambda/{function_name}"
                 try:
-                    logs_client = boto3.client('logs')
+                    logs_client = self.session.client('logs', config=CALL_TIMEOUTS)
                     log_group = logs_client.describe_log_groups(logGroupNamePrefix=log_group_name)
                     
                     if not log_group['logGroups']:
-                        results['recommendations'].append(f"Ensure logging is properly configured for {function_name}")
+                        results['recommendations'].append(Finding('lambda.configure-logging', function['FunctionArn'], function_name))
                     
                 except Exception:
                     pass
             
         except Exception as e:
-            results['findings'].append(f"Error checking audit logging: {str(e)}")
+            results['findings'].append(Finding('check.error', name='audit logging', detail=str(e)))
         
         return results
     
@@ -363,26 +852,55 @@ class SecurityComplianceChecker:
         }
         
         try:
-            # Check VPC configuration (if applicable)
-            ec2_client = boto3.client('ec2')
+            ec2_client = self.session.client('ec2', config=CALL_TIMEOUTS)
             
-            # Check security groups
-            security_groups = ec2_client.describe_security_groups()['SecurityGroups']
+            # Only the environment's groups, selected by tag on the server side
+            groups = network_exposure.load_security_groups(ec2_client, [
+                {'Name': f"tag:{key}", 'Values': [value]} for key, value in self.discovery.tags.items()
+            ])
+            index = network_exposure.build_index(ec2_client, groups)
+            attached, public = network_exposure.attached_groups(ec2_client, [sg['GroupId'] for sg in groups])
+            internet = index.internet_exposure()
             
-            for sg in security_groups:
-                if f"medeez-{self.environment}" in sg.get('GroupName', ''):
-                    # Check for overly permissive rules
-                    for rule in sg.get('IpPermissions', []):
-                        for ip_range in rule.get('IpRanges', []):
-                            if ip_range.get('CidrIp') == '0.0.0.0/0':
-                                results['findings'].append(f"Security group {sg['GroupName']} allows access from anywhere")
-                                results['recommendations'].append(f"Restrict access in security group {sg['GroupName']}")
+            results['exposure'] = {}
+            for sg in groups:
+                group_id = sg['GroupId']
+                sg_arn = f"arn:aws:ec2:{self.region}:{sg.get('OwnerId', '')}:security-group/{group_id}"
+                
+                if group_id in internet:
+                    results['findings'].append(Finding('ec2.open-security-group', sg_arn, sg['GroupName']))
+                    results['recommendations'].append(Finding('ec2.restrict-security-group', sg_arn, sg['GroupName']))
+                    
+                    if group_id in public:
+                        exposed = sorted({f"{service} ({port})" for port, service in SENSITIVE_PORTS.items()
+                                          if any(permission.covers_port(port) for permission in internet[group_id])})
+                        if exposed:
+                            results['findings'].append(Finding('ec2.exposed-sensitive-port', sg_arn, sg['GroupName'],
+                                                               ', '.join(exposed)))
+                
+                # Groups of other accounts, referenced through VPC peering
+                foreign = sorted({pair['UserId'] + '/' + pair.get('GroupId', '')
+                                  for rule in sg.get('IpPermissions', [])
+                                  for pair in rule.get('UserIdGroupPairs', [])
+                                  if pair.get('UserId') and pair['UserId'] != sg.get('OwnerId')})
+                if foreign:
+                    results['findings'].append(Finding('ec2.cross-account-reference', sg_arn, sg['GroupName'],
+                                                       ', '.join(foreign)))
+                    results['recommendations'].append(Finding('ec2.review-cross-account-reference', sg_arn, sg['GroupName']))
+                
+                # Which ports each source can reach, for groups in use
+                if group_id in attached:
+                    results['exposure'][group_id] = {
+                        'name': sg['GroupName'],
+                        'public': group_id in public,
+                        'sources': index.sources(group_id)
+                    }
             
             # Check NACLs (if applicable)
             # This would be environment-specific based on VPC configuration
             
         except Exception as e:
-            results['findings'].append(f"Error checking network security: {str(e)}")
+            results['findings'].append(Finding('check.error', name='network security', detail=str(e)))
         
         return results
     
@@ -420,13 +938,13 @@ class SecurityComplianceChecker:
         recommendations = []
         
         # Access Management
-        recommendations.append("Implement role-based access control (RBAC)")
-        recommendations.append("Regular access reviews and user access audits")
-        recommendations.append("Maintain workforce training records")
-        recommendations.append("Establish incident response procedures")
+        recommendations.append(Finding('hipaa.rbac'))
+        recommendations.append(Finding('hipaa.access-reviews'))
+        recommendations.append(Finding('hipaa.training-records'))
+        recommendations.append(Finding('hipaa.incident-response'))
         
         # Business Associate Agreements
-        recommendations.append("Ensure BAAs are in place with all third-party vendors")
+        recommendations.append(Finding('hipaa.baa'))
         
         return {'findings': findings, 'recommendations': recommendations}
     
@@ -436,8 +954,8 @@ class SecurityComplianceChecker:
         recommendations = []
         
         # AWS handles physical security for cloud resources
-        recommendations.append("Verify AWS SOC 2 Type II compliance documentation")
-        recommendations.append("Document physical security controls provided by AWS")
+        recommendations.append(Finding('hipaa.soc2'))
+        recommendations.append(Finding('hipaa.physical-controls'))
         
         return {'findings': findings, 'recommendations': recommendations}
     
@@ -447,30 +965,105 @@ class SecurityComplianceChecker:
         recommendations = []
         
         # Access Control
-        recommendations.append("Implement unique user identification")
-        recommendations.append("Establish emergency access procedures")
-        recommendations.append("Enable automatic logoff for inactive sessions")
-        recommendations.append("Implement role-based access controls")
+        recommendations.append(Finding('hipaa.unique-user-id'))
+        recommendations.append(Finding('hipaa.emergency-access'))
+        recommendations.append(Finding('hipaa.automatic-logoff'))
+        recommendations.append(Finding('hipaa.rbac'))
         
         # Audit Controls
-        recommendations.append("Enable comprehensive audit logging")
-        recommendations.append("Implement log monitoring and alerting")
-        recommendations.append("Regular audit log reviews")
+        recommendations.append(Finding('hipaa.audit-logging'))
+        recommendations.append(Finding('hipaa.log-monitoring'))
+        recommendations.append(Finding('hipaa.log-reviews'))
         
         # Integrity
-        recommendations.append("Implement electronic signature capabilities")
-        recommendations.append("Ensure data integrity through checksums/hashing")
+        recommendations.append(Finding('hipaa.electronic-signatures'))
+        recommendations.append(Finding('hipaa.integrity'))
         
         # Transmission Security
-        recommendations.append("Encrypt all data in transit using TLS 1.2 or higher")
-        recommendations.append("Implement end-to-end encryption for sensitive communications")
+        recommendations.append(Finding('hipaa.tls'))
+        recommendations.append(Finding('hipaa.e2e-encryption'))
         
         return {'findings': findings, 'recommendations': recommendations}
     
-    def generate_compliance_report(self) -> Dict[str, Any]:
-        """Generate comprehensive security and compliance report"""
+    def _deduplicate(self, result: Dict[str, Any]):
+        """Drop findings and recommendations already reported by an earlier
+        check (or earlier in this one) and index the rest"""
+        for key, values in result.items():
+            if key.endswith('findings'):
+                result[key] = self.findings.unique(values)
+            elif key.endswith('recommendations'):
+                result[key] = self.recommendations.unique(values)
+    
+    def _stream_check(self, stream: report_stream.NdjsonWriter, check_name: str,
+                      result: Dict[str, Any]) -> Dict[str, Any]:
+        """Write a check's findings and recommendations to the stream and
+        return the small per-check record kept in the report instead"""
+        for key, values in result.items():
+            if key.endswith('findings'):
+                for finding in values:
+                    stream.write('finding', check=check_name, source=key, **finding.to_dict())
+            elif key.endswith('recommendations'):
+                for finding in values:
+                    stream.write('recommendation', check=check_name, source=key, **finding.to_dict())
+        
+        check = {'status': result.get('status', 'pass'), 'finding_count': len(result.get('findings', [])),
+                 'elapsed_seconds': result.get('elapsed_seconds')}
+        if 'error' in result:
+            check['error'] = result['error']
+        stream.write('check', check=check_name, **check)
+        return check
+    
+    def _run_check(self, check_name: str, check_function, deadline: Optional[float]) -> Dict[str, Any]:
+        """Run a check, giving up on it at the deadline.
+        
+        With a deadline the check runs in a daemon thread, so a call that
+        hangs cannot hold up the report. Past the deadline the thread is
+        abandoned: its next AWS call raises CheckTimeout, and CALL_TIMEOUTS
+        bounds the call it may be blocked in. A run that still has abandoned
+        checks once its report is written exits without waiting for them.
+        Raises TimeoutError or CheckTimeout once the check has run out of time.
+        """
+        if deadline is None:
+            with aws_profiler.scope(check_name):
+                return check_function()
+        
+        future = Future()
+        
+        def run():
+            _check_deadline.set(deadline)
+            try:
+                with aws_profiler.scope(check_name):
+                    future.set_result(check_function())
+            except BaseException as e:
+                future.set_exception(e)
+        
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(run,), name=f"check: {check_name}",
+                                  daemon=True)
+        thread.start()
+        try:
+            return future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except TimeoutError:
+            logger.warning(f"Abandoning {check_name} check; it stops at its next AWS request")
+            raise
+    
+    def generate_compliance_report(self, stream: Optional[report_stream.NdjsonWriter] = None,
+                                   check_timeout: Optional[float] = None,
+                                   time_budget: Optional[float] = None) -> Dict[str, Any]:
+        """Generate comprehensive security and compliance report
+        
+        With a stream, findings are written out as each check completes and
+        the report only keeps per-check status and counts.
+        
+        Each check may run for check_timeout seconds and all of them together
+        for time_budget seconds. A check out of time is cancelled and marked
+        'timeout', and the report is marked partial.
+        """
         logger.info("Generating security and compliance report...")
         
+        # a streamed report only needs counts, not the findings written out
+        index = FindingIndex if stream is None else FindingCounts
+        self.findings = index()
+        self.recommendations = index()
         report = {
             'environment': self.environment,
             'assessment_date': datetime.datetime.now().isoformat(),
@@ -488,32 +1081,66 @@ class SecurityComplianceChecker:
         ]
         
         total_findings = 0
+        timed_out = []
+        started = time.monotonic()
+        budget_end = started + time_budget if time_budget is not None else None
         
-        for check_name, check_function in checks:
+        for i, (check_name, check_function) in enumerate(checks, 1):
             logger.info(f"Running {check_name} check...")
+            check_started = time.monotonic()
+            deadline = budget_end
+            if check_timeout is not None:
+                deadline = min(deadline or float('inf'), check_started + check_timeout)
             try:
-                result = check_function()
-                report['checks'][check_name] = result
+                if deadline is not None and deadline <= check_started:
+                    raise TimeoutError("Time budget used up before the check started")
+                result = self._run_check(check_name, check_function, deadline)
+                self._deduplicate(result)
                 
                 if result.get('findings'):
                     total_findings += len(result['findings'])
                     if result.get('status') == 'fail':
                         report['overall_status'] = 'fail'
                         
+            except (TimeoutError, CheckTimeout) as e:
+                logger.error(f"{check_name} check timed out")
+                timed_out.append(check_name)
+                result = {
+                    'status': 'timeout',
+                    'error': str(e) or f"Timed out after {time.monotonic() - check_started:.1f}s",
+                    'findings': [],
+                    'recommendations': []
+                }
             except Exception as e:
                 logger.error(f"Error in {check_name} check: {e}")
-                report['checks'][check_name] = {
+                result = {
                     'status': 'error',
                     'error': str(e),
                     'findings': [],
                     'recommendations': []
                 }
+            
+            result['elapsed_seconds'] = round(time.monotonic() - check_started, 3)
+            logger.info(f"[{i}/{len(checks)}] {check_name}: {result.get('status', 'pass')}, "
+                        f"{len(result.get('findings', []))} findings in {result['elapsed_seconds']:.1f}s")
+            
+            if stream:
+                report['checks'][check_name] = self._stream_check(stream, check_name, result)
+            else:
+                report['checks'][check_name] = result
+        
+        if timed_out:
+            report['partial'] = True
         
         # Summary
         report['summary'] = {
             'total_checks': len(checks),
             'total_findings': total_findings,
-            'compliance_score': max(0, 100 - (total_findings * 5))  # Rough scoring
+            'compliance_score': max(0, 100 - (total_findings * 5)),  # Rough scoring
+            'findings_by_severity': self.findings.counts_by_severity(),
+            'findings_by_rule': self.findings.counts_by_rule(),
+            'timed_out_checks': timed_out,
+            'elapsed_seconds': round(time.monotonic() - started, 3)
         }
         
         # Priority recommendations
@@ -530,6 +1157,83 @@ class SecurityComplianceChecker:
         
         return report
 
+def scan_target(environment: str, tags: Optional[Dict[str, str]], check_timeout: Optional[float],
+                budget_end: Optional[float], session: boto3.Session, target: aws_fanout.Target) -> Dict[str, Any]:
+    """Compliance report for one account and region; runs in a fan-out worker.
+    
+    budget_end is the wall clock time (time.time()) the whole fan-out must
+    finish by, so targets that start late get what is left of the budget.
+    """
+    checker = SecurityComplianceChecker(environment, session=session, scan_global=target.primary, tags=tags)
+    time_budget = max(0.0, budget_end - time.time()) if budget_end is not None else None
+    return checker.generate_compliance_report(check_timeout=check_timeout, time_budget=time_budget)
+
+def merge_reports(environment: str, results: Iterable[Tuple[aws_fanout.Target, Dict[str, Any]]]) -> Dict[str, Any]:
+    """Combine per-account, per-region reports into one report of the same shape.
+    
+    Findings are deduplicated across targets and each check takes its worst
+    status. A target that could not be scanned fails the overall status.
+    """
+    merged = {
+        'environment': environment,
+        'assessment_date': datetime.datetime.now().isoformat(),
+        'overall_status': 'pass',
+        'checks': {},
+        'targets': {}
+    }
+    findings = FindingIndex()
+    recommendations = FindingIndex()
+    priority_actions = []
+    timed_out = []
+    
+    for target, report in sorted(results, key=lambda result: result[0].label):
+        if 'error' in report:
+            merged['targets'][target.label] = {'overall_status': 'error', 'error': report['error']}
+            merged['overall_status'] = 'fail'
+            continue
+        
+        merged['targets'][target.label] = {'overall_status': report['overall_status'], 'summary': report['summary']}
+        if report['overall_status'] == 'fail':
+            merged['overall_status'] = 'fail'
+        if report.get('partial'):
+            merged['partial'] = True
+            timed_out.extend(f"{target.label}: {check_name}" for check_name in report['summary']['timed_out_checks'])
+        priority_actions = report['priority_actions']
+        
+        for check_name, result in report['checks'].items():
+            check = merged['checks'].setdefault(check_name, {'status': 'pass'})
+            for key, value in result.items():
+                if key.endswith('findings'):
+                    check.setdefault(key, []).extend(findings.unique(value))
+                elif key.endswith('recommendations'):
+                    check.setdefault(key, []).extend(recommendations.unique(value))
+                elif key == 'error':
+                    check.setdefault('errors', []).append(f"{target.label}: {value}")
+                elif isinstance(value, dict):
+                    # per-resource detail such as stage metrics, keyed by ARN or id
+                    check.setdefault(key, {}).update(value)
+            if result.get('status') == 'fail' or (result.get('status') in ('error', 'timeout') and check['status'] == 'pass'):
+                check['status'] = result['status']
+    
+    total_findings = sum(len(check.get('findings', [])) for check in merged['checks'].values())
+    merged['summary'] = {
+        'total_checks': len(merged['checks']),
+        'total_findings': total_findings,
+        'compliance_score': max(0, 100 - (total_findings * 5)),  # Rough scoring
+        'findings_by_severity': findings.counts_by_severity(),
+        'findings_by_rule': findings.counts_by_rule(),
+        'timed_out_checks': timed_out
+    }
+    merged['priority_actions'] = priority_actions
+    return merged
+
+def exit_status(report: Dict[str, Any]) -> int:
+    """Exit status of a run, telling CI when checks timed out"""
+    if report.get('partial'):
+        logger.error(f"Report is partial, checks timed out: {', '.join(report['summary']['timed_out_checks'])}")
+        return PARTIAL_REPORT_EXIT_CODE
+    return 0
+
 def main():
     parser = argparse.ArgumentParser(description='Security and HIPAA Compliance Checker for Medeez')
     parser.add_argument('--environment', required=True, choices=['dev', 'staging', 'prod'],
@@ -537,17 +1241,66 @@ def main():
     parser.add_argument('--output', help='Output file for report')
     parser.add_argument('--format', choices=['json', 'summary'], default='json',
                        help='Output format')
+    aws_cassette.add_arguments(parser)
+    aws_profiler.add_arguments(parser)
+    report_stream.add_arguments(parser)
+    aws_fanout.add_arguments(parser)
+    aws_discovery.add_arguments(parser)
+    parser.add_argument('--cognito-cache', metavar='PATH',
+                       help='Keep Cognito user pool descriptions in this file between runs and only '
+                            're-describe pools modified since')
+    parser.add_argument('--check-timeout', type=float, metavar='SECONDS',
+                       help='Cancel a check still running after this long and mark it timeout')
+    parser.add_argument('--time-budget', type=float, metavar='SECONDS',
+                       help='Cancel the checks still running after this long and report what finished')
     
     args = parser.parse_args()
+    if args.stream and args.format != 'json':
+        parser.error('--stream writes NDJSON and cannot be combined with --format summary')
+    aws_fanout.check_arguments(parser, args)
+    try:
+        tags = aws_discovery.parse_tags(args.tag)
+    except ValueError as e:
+        parser.error(f"--tag: {e}")
     
-    checker = SecurityComplianceChecker(args.environment)
-    report = checker.generate_compliance_report()
+    if aws_fanout.enabled(args):
+        targets = aws_fanout.build_targets(args.accounts, args.regions)
+        budget_end = time.time() + args.time_budget if args.time_budget is not None else None
+        results = aws_fanout.fan_out(functools.partial(scan_target, args.environment, tags, args.check_timeout, budget_end),
+                                     targets, max_workers=args.max_workers, rate=args.rate_limit)
+        report = merge_reports(args.environment, results)
+    else:
+        if args.rate_limit:
+            aws_fanout.RateLimiter(args.rate_limit).install(aws_fanout.default_session())
+        
+        profiler = aws_profiler.from_args(args)
+        with aws_cassette.from_args(args), report_stream.from_args(args) as stream:
+            checker = SecurityComplianceChecker(args.environment, tags=tags, cognito_cache=args.cognito_cache)
+            report = checker.generate_compliance_report(stream, check_timeout=args.check_timeout,
+                                                         time_budget=args.time_budget)
+            
+            if profiler:
+                if args.profile:
+                    report['profile'] = profiler.report()
+                if args.profile_trace:
+                    profiler.write_trace(args.profile_trace)
+            
+            if stream:
+                stream.write('summary', **report)
+                return exit_status(report)
     
     if args.format == 'json':
-        output = json.dumps(report, indent=2)
-    else:
-        # Generate summary format
-        output = f"""
+        # serialized once, straight into the file when there is one
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2, default=to_json)
+            print(f"Report saved to {args.output}")
+        else:
+            print(json.dumps(report, indent=2, default=to_json))
+        return exit_status(report)
+    
+    # Generate summary format
+    output = f"""
 Security and Compliance Report for {args.environment.upper()}
 {'=' * 50}
 
@@ -559,17 +1312,24 @@ Priority Actions:
 {chr(10).join(f"- {action}" for action in report['priority_actions'])}
 
 Detailed findings and recommendations are available in the full JSON report.
-        """.strip()
+    """.strip()
     
     if args.output:
         with open(args.output, 'w') as f:
-            if args.format == 'json':
-                json.dump(report, f, indent=2)
-            else:
-                f.write(output)
+            f.write(output)
         print(f"Report saved to {args.output}")
     else:
         print(output)
+    return exit_status(report)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    status = main()
+    if any(thread.name.startswith('check: ') for thread in threading.enumerate()):
+        # An abandoned check may still be in an AWS call on one of its pool's
+        # worker threads, which interpreter exit would wait for. The report
+        # is written, so flush what is buffered and leave within the budget
+        logging.shutdown()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+    sys.exit(status)
\ No newline at end of file